@@ -0,0 +1,214 @@
+import asyncio
+import collections
+import json
+import math
+import os
+import time
+from urllib.parse import parse_qs
+
+from db import config, metrics
+
+# Per route class concurrency limits, ahead of routing and so ahead of any
+# pooled connection. Requests over the limit wait in a bounded FIFO queue for
+# at most the class deadline; a full queue or a missed deadline answers at
+# once with Retry-After instead of piling onto Postgres.
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+
+_pool = config.DATABASE_POOL_MAX
+
+# class: (limit, queue, deadline seconds, rejection status). The database
+# bound classes split the connection pool; ADMISSION_<CLASS>_LIMIT / _QUEUE /
+# _TIMEOUT override them. Streamed listings and exports hold their slot for
+# the whole body, so they get their own class instead of starving cheap
+# reads. Login/register spend their time in the password hashing pool, not
+# on a connection, so auth admits as much as that pool accepts and leaves
+# the waiting to it. Client-driven bursts of heavy work (auth, imports,
+# streams) answer 429; the rest 503.
+_hashing = config.PASSWORD_HASH_WORKERS + config.PASSWORD_HASH_QUEUE
+
+DEFAULTS = {
+    "read": (max(1, _pool // 2), max(1, _pool // 2) * 4, 1.0, 503),
+    "search": (max(1, _pool // 3), max(1, _pool // 3) * 4, 3.0, 503),
+    "write": (max(1, _pool // 5), max(1, _pool // 5) * 4, 5.0, 503),
+    "stream": (max(1, _pool // 5), max(1, _pool // 5) * 2, 5.0, 429),
+    "import": (1, 2, 30.0, 429),
+    "auth": (_hashing, config.PASSWORD_HASH_WORKERS, 5.0, 429),
+}
+
+# Served without admission: no database work, and monitoring has to keep
+# working under overload.
+EXEMPT_PATHS = {"/metrics", "/cache/stats", "/docs", "/redoc", "/openapi.json", "/docs/oauth2-redirect"}
+
+admission_active = metrics.Gauge("admission_active_requests", "Admitted requests being served.", ("class",))
+admission_queued = metrics.Gauge("admission_queue_depth", "Requests waiting for admission.", ("class",))
+admission_rejected = metrics.Counter(
+    "admission_rejected_total", "Requests turned away by admission control.", ("class", "reason")
+)
+admission_wait = metrics.Histogram("admission_wait_seconds", "Time admitted requests spent queued.", ("class",))
+
+
+class Rejected(Exception):
+    def __init__(self, reason, retry_after):
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Gate:
+    def __init__(self, name, limit, queue, timeout, status=503):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.status = status
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        # Moving average of admitted request time, for Retry-After.
+        self.service_seconds = 0.05
+        self._waiters = collections.deque()
+
+    def retry_after(self):
+        # Seconds until the queue ahead would have drained, at least 1.
+        return max(1, math.ceil(self.service_seconds * (len(self._waiters) + 1) / max(1, self.limit)))
+
+    async def acquire(self):
+        # Slots are handed to waiters in arrival order, so a newcomer never
+        # overtakes the queue.
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return 0.0
+        if len(self._waiters) >= self.queue:
+            self.rejected += 1
+            raise Rejected("queue_full", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        admission_queued.inc((self.name,))
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # Handed a slot just as the deadline passed or the client
+                # went away.
+                self.release()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.timed_out += 1
+            raise Rejected("deadline", self.retry_after())
+        finally:
+            admission_queued.dec((self.name,))
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+        self.admitted += 1
+        return time.perf_counter() - started
+
+    def release(self, elapsed=None):
+        if elapsed is not None:
+            self.service_seconds += (elapsed - self.service_seconds) * 0.1
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # The slot passes straight to the next waiter.
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "queue": self.queue,
+            "timeout": self.timeout,
+            "active": self.active,
+            "queued": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+
+def _gate(name, limit, queue, timeout, status):
+    prefix = f"ADMISSION_{name.upper()}"
+    return Gate(
+        name,
+        limit=int(os.getenv(f"{prefix}_LIMIT", str(limit))),
+        queue=int(os.getenv(f"{prefix}_QUEUE", str(queue))),
+        timeout=float(os.getenv(f"{prefix}_TIMEOUT", str(timeout))),
+        status=status,
+    )
+
+
+gates = {name: _gate(name, *settings) for name, settings in DEFAULTS.items()}
+
+
+def route_class(method, path, query=b""):
+    path = path.rstrip("/") or "/"
+    if path in EXEMPT_PATHS:
+        return None
+    if path in ("/login", "/register"):
+        return "auth"
+    if path == "/books/import":
+        return "import"
+    if path == "/books/search":
+        return "search"
+    if method in ("GET", "HEAD"):
+        if path == "/books/export" or (path == "/books" and parse_qs(query.decode("latin-1")).get("stream")):
+            return "stream"
+        return "read"
+    return "write"
+
+
+def stats():
+    return {name: gate.stats() for name, gate in gates.items()}
+
+
+class AdmissionMiddleware:
+    # Pure ASGI and outside the router, so a rejected request never reaches
+    # a dependency (get_db, auth) and the slot is held until a streamed body
+    # has been sent in full.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ADMISSION_ENABLED:
+            return await self.app(scope, receive, send)
+        name = route_class(scope["method"], scope["path"], scope.get("query_string", b""))
+        if name is None:
+            return await self.app(scope, receive, send)
+
+        gate = gates[name]
+        labels = (name,)
+        try:
+            waited = await gate.acquire()
+        except Rejected as e:
+            if metrics.METRICS_ENABLED:
+                admission_rejected.inc((name, e.reason))
+            return await reject(send, gate.status, e.retry_after, name)
+
+        if metrics.METRICS_ENABLED:
+            admission_wait.observe(waited, labels)
+        admission_active.inc(labels)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission_active.dec(labels)
+            gate.release(time.perf_counter() - started)
+
+
+async def reject(send, status, retry_after, name):
+    body = json.dumps({"detail": f"Server busy ({name} requests), retry later"}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(retry_after).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,33 @@
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request
+
+
+def validator_headers(etag, last_modified):
+    # Timestamps come back in the session TimeZone; HTTP dates are GMT.
+    return {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified.astimezone(timezone.utc).replace(microsecond=0), usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+
+
+def is_not_modified(request: Request, etag, last_modified):
+    # If-None-Match wins over If-Modified-Since (RFC 9110, 13.2.2).
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            return False
+        return last_modified.replace(microsecond=0) <= since
+
+    return False
@@ -0,0 +1,123 @@
+import codecs
+import csv
+import io
+import json
+
+from fastapi import HTTPException
+
+from db.database import batched
+
+from .models import Book
+
+CHUNK_SIZE = 64 * 1024
+MAX_ITEM_SIZE = 1024 * 1024
+MAX_REJECTED_ROWS = 1000
+
+
+def iter_json_array(fileobj, chunk_size=CHUNK_SIZE):
+    # Yields the items of a top-level JSON array while holding at most one
+    # chunk plus one item in memory.
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer, position, eof = "", 0, False
+    state = "start"
+
+    while state != "done":
+        while position < len(buffer) and buffer[position].isspace():
+            position += 1
+
+        if position == len(buffer):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            buffer, position = buffer[position:], 0
+            chunk = fileobj.read(chunk_size)
+            eof = not chunk
+            buffer += utf8.decode(chunk, final=eof)
+            continue
+
+        char = buffer[position]
+        if state == "start":
+            if char != "[":
+                raise ValueError("Expected a JSON array")
+            position += 1
+            state = "first"
+            continue
+
+        if state in ("first", "next") and char == "]":
+            state = "done"
+            continue
+
+        if state == "next":
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' but found {char!r}")
+            position += 1
+            state = "item"
+            continue
+
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof or len(buffer) - position > MAX_ITEM_SIZE:
+                raise
+            end = None
+
+        if end is None or (end == len(buffer) and not eof):
+            # The item may continue in the next chunk (e.g. a bare number).
+            buffer, position = buffer[position:], 0
+            chunk = fileobj.read(chunk_size)
+            eof = not chunk
+            buffer += utf8.decode(chunk, final=eof)
+            continue
+
+        yield item
+        position = end
+        state = "next"
+
+
+def iter_csv_rows(fileobj):
+    text = io.TextIOWrapper(fileobj, encoding="utf-8", newline="")
+    try:
+        yield from csv.DictReader(text)
+    finally:
+        text.detach()
+
+
+def iter_valid_books(db, sources, report, batch_size):
+    # sources: (name, rows) pairs. Rows are validated a batch at a time with
+    # Book.validate_batch; invalid rows are counted in `report` instead of
+    # failing the whole upload. Accepted rows may not have reached COPY yet,
+    # so titles seen earlier in the upload (any batch, either file) are
+    # tracked here and later rows with them rejected as duplicates.
+    seen = set()
+    for name, rows in sources:
+        for batch in batched(enumerate(checked(name, rows)), batch_size):
+            offset = batch[0][0]
+            books, errors = Book.validate_batch(db, [row for _, row in batch])
+            for index, detail in errors:
+                reject(report, name, offset + index, detail)
+            for index, book in books:
+                if book.title in seen:
+                    reject(report, name, offset + index, "Book with such title already exists")
+                    continue
+                seen.add(book.title)
+                yield (
+                    book.title,
+                    book.description,
+                    book.published_year,
+                    book.price,
+                    book.genre_id,
+                    book.author_id,
+                )
+
+
+def checked(name, rows):
+    try:
+        yield from rows
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} format ({e})")
+
+
+def reject(report, name, index, detail):
+    report["rejected"] += 1
+    if len(report["rejected_rows"]) < MAX_REJECTED_ROWS:
+        report["rejected_rows"].append({"file": name, "index": index, "detail": detail})
@@ -1,151 +1,368 @@
-from dns.e164 import query
-from fastapi import FastAPI, HTTPException, status, Response, UploadFile, File
+from fastapi import Body, FastAPI, HTTPException, Query, Request, status, Response, UploadFile, File
 from fastapi.params import Depends
-from app import utils, oath2
-import csv, json, io
-from .models import Author, Genre, Book, QueryParams, Token, UserBase
-from db.database import Storage, get_db
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from app import admission, conditional, metrics, streaming, oath2
+import inspect, os, time
+from contextlib import asynccontextmanager
+from typing import Literal
+from .models import Author, Genre, Book, QueryParams, Token, UserBase, bind_validation_db
+from db import metrics as db_metrics
+from db.cache import storage_cache, user_cache
+from db import config, singleflight
+from db.database import Storage, get_db, get_dsn, get_pool
+from db.read_model import get_read_model
 from mangum import Mangum
+from psycopg2.errors import ForeignKeyViolation, UniqueViolation
 
-app = FastAPI()
-handler = Mangum(app)
+
+@asynccontextmanager
+async def lifespan(app):
+    # Starts loading the read model (when enabled) before the first request.
+    get_read_model(get_dsn())
+    yield
+    if os.getenv("DATABASE_DRIVER") == "asyncpg":
+        from db.async_database import close_async_pool
+
+        await close_async_pool()
+
+
+app = FastAPI(lifespan=lifespan)
+# Added first so it runs inside MetricsMiddleware: rejections are counted too.
+app.add_middleware(admission.AdmissionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+# Lifespan is per invocation under Mangum; the read model starts on first use
+# anyway, so warm invocations skip the startup/shutdown round.
+handler = Mangum(app, lifespan="off")
+
+# Validators check uniqueness and references before the write, but another
+# writer can get in between: the constraint then answers with the
+# validator's 400 rather than a 500.
+INTEGRITY_ERRORS = {
+    "book_title_key": "Book with such title already exists",
+    "author_firstname_lastname_key": "Author already exists",
+    "genre_name_genre_key": "Genre already exists",
+    "users_email_key": "User already exists",
+    "book_author_id_fkey": "Author not found",
+    "book_genre_id_fkey": "Genre not found",
+}
+
+
+@app.exception_handler(UniqueViolation)
+@app.exception_handler(ForeignKeyViolation)
+async def integrity_error(request: Request, e):
+    detail = INTEGRITY_ERRORS.get(e.diag.constraint_name, "Conflicts with an existing row")
+    return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"detail": detail})
+
+if config.LAMBDA:
+    # Opens the container's connection during the init phase, ahead of the
+    # first invocation. If the database is unreachable the first request
+    # retries through the pool and reports the error.
+    try:
+        get_pool()
+    except Exception:
+        pass
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+# Most ids or books accepted by one batch read, upsert or delete request.
+BULK_MAX_BOOKS = int(os.getenv("BULK_MAX_BOOKS", "1000"))
+
+if os.getenv("DATABASE_DRIVER") == "asyncpg":
+    from db.async_database import get_async_db as get_storage
+else:
+    get_storage = get_db
+# Validated writes (dependencies=[Depends(bind_validation_db)]) take get_db
+# rather than get_storage: validation, auth and the write then share the one
+# psycopg2 connection instead of also holding an asyncpg one.
+
+
+async def run_db(method, *args):
+    # Storage is blocking psycopg2, so it runs in the threadpool; AsyncStorage
+    # methods are awaited directly on the event loop.
+    if inspect.iscoroutinefunction(method):
+        return await method(*args)
+    return await run_in_threadpool(method, *args)
 
 @app.get("/books")
-async def root(query: QueryParams = Depends(), db: Storage = Depends(get_db)):
-    books = db.retrieve_books(query)
+async def root(
+    request: Request,
+    response: Response,
+    query: QueryParams = Depends(),
+    stream: Literal["json", "ndjson"] | None = None,
+    db: Storage = Depends(get_storage),
+):
+    # The catalog version changes with every write to book, so clients can
+    # revalidate any listing without the result set being fetched.
+    catalog = await run_db(db.retrieve_catalog_version)
+    headers = conditional.validator_headers(f'"c{catalog["version"]}"', catalog["updated_at"])
+    if conditional.is_not_modified(request, headers["ETag"], catalog["updated_at"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if stream:
+        return StreamingResponse(
+            streaming.stream_books(query, stream), media_type=streaming.MEDIA_TYPES[stream], headers=headers
+        )
+
+    books = await run_db(db.retrieve_books, query)
+    response.headers.update(headers)
+    return {"data": books, "next_cursor": query.next_cursor(books)}
+
+
+@app.get("/books/search")
+async def search_books(
+    q: str = Query(min_length=1),
+    limit: int = Query(default=20, gt=0, le=100),
+    offset: int = Query(default=0, ge=0),
+    db: Storage = Depends(get_storage),
+):
+    books = await run_db(db.search_books, q, limit, offset)
     return {"data": books}
 
 
+# Declared (like /books/batch) before /books/{book_id} so "export" is not
+# taken for an id.
+@app.get("/books/export")
+async def export_books(
+    query: QueryParams = Depends(),
+    format: Literal["csv", "json", "ndjson"] = "csv",
+    gzip: bool = False,
+):
+    chunks = streaming.export_books(query, format)
+    filename = f"books.{format}"
+    media_type = streaming.MEDIA_TYPES[format]
+    if gzip:
+        chunks = streaming.gzip_chunks(chunks)
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        chunks, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@app.get("/books/batch")
+async def read_books_batch(
+    ids: list[int] = Query(min_length=1, max_length=BULK_MAX_BOOKS),
+    db: Storage = Depends(get_storage),
+):
+    books = await run_db(db.retrieve_books_by_ids, ids)
+    found = {book["id"] for book in books}
+    return {"data": books, "missing": [book_id for book_id in dict.fromkeys(ids) if book_id not in found]}
+
+
 @app.get("/books/{book_id}")
-async def read_book(book_id: int, db: Storage = Depends(get_db)):
-    book = db.retrieve_book_by_id(book_id)
+async def read_book(book_id: int, request: Request, response: Response, db: Storage = Depends(get_storage)):
+    book = await run_db(db.retrieve_book_by_id, book_id)
     if book is None:
         raise HTTPException(status_code=404, detail="Book not found")
+
+    headers = conditional.validator_headers(f'"b{book["id"]}-{book["version"]}"', book["updated_at"])
+    if conditional.is_not_modified(request, headers["ETag"], book["updated_at"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    response.headers.update(headers)
     return {"data": book}
 
-@app.post("/books")
+@app.post("/books", dependencies=[Depends(bind_validation_db)])
 async def create_book(book: Book, current_user: UserBase = Depends(oath2.get_current_user_id), db: Storage = Depends(get_db)):
-    book = db.insert_book(book)
+    book = await run_db(db.insert_book, book)
     return {"book": book}
 
 @app.post("/books/import")
 async def import_books(
     json_file: UploadFile | None = File(default=None),
     csv_file: UploadFile | None = File(default=None),
+    commit_mode: Literal["atomic", "batch"] = "atomic",
     db: Storage = Depends(get_db)
 ):
     if not json_file and not csv_file:
         raise HTTPException(status_code=400, detail="Provide at least one file (JSON or CSV)")
 
-    data = []
+    # Imported here: most invocations never import, so cold starts skip it.
+    from app import importer
 
+    # Uploads are parsed incrementally, validated and flushed through COPY in
+    # IMPORT_BATCH_SIZE batches, so memory stays flat whatever the file size.
+    # Import always runs on psycopg2 in the threadpool since validation and
+    # COPY share one transaction.
+    sources = []
     if json_file:
-        content = await json_file.read()
-        try:
-            books = json.loads(content.decode("utf-8"))
-            for b in books:
-                book = Book(**b)
-                data.append((
-                    book.title,
-                    book.description,
-                    book.published_year,
-                    book.price,
-                    book.genre_id,
-                    book.author_id
-                ))
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid JSON format")
-
+        sources.append(("JSON", importer.iter_json_array(json_file.file)))
     if csv_file:
-        content = await csv_file.read()
-        reader = csv.DictReader(io.StringIO(content.decode("utf-8")))
-        for row in reader:
-            try:
-                book = Book(**row)
-                data.append((
-                    book.title,
-                    book.description,
-                    book.published_year,
-                    book.price,
-                    book.genre_id,
-                    book.author_id
-                ))
-            except Exception as e:
-                raise HTTPException(status_code=400, detail=f"Invalid CSV row: {row} ({e})")
-
-    if not data:
-        raise HTTPException(status_code=400, detail="No valid books found")
+        sources.append(("CSV", importer.iter_csv_rows(csv_file.file)))
+
+    report = {"rejected": 0, "rejected_rows": []}
+    books = importer.iter_valid_books(db, sources, report, IMPORT_BATCH_SIZE)
 
-    for book in data:
-        db.insert_book_in_bulk(book)
+    started = time.perf_counter()
+    # A title committed by a concurrent writer after validation surfaces as
+    # UniqueViolation, answered by integrity_error.
+    count = await run_db(db.copy_books, books, IMPORT_BATCH_SIZE, commit_mode == "batch")
+    elapsed = time.perf_counter() - started
+
+    if not count:
+        raise HTTPException(status_code=400, detail="No valid books found")
 
-    return {"imported": data}
+    return {
+        "count": count,
+        "rejected": report["rejected"],
+        "rejected_rows": report["rejected_rows"],
+        "rows_per_sec": round(count / elapsed, 1) if elapsed else None,
+    }
 
 
 @app.get("/books/recomendations-genre/{genre_id}")
-async def get_recommendations(genre_id, db: Storage = Depends(get_db)):
-    books = db.recommend_books_by_genre(genre_id)
+async def get_recommendations(genre_id, db: Storage = Depends(get_storage)):
+    books = await run_db(db.recommend_books_by_genre, genre_id)
     return {"data": books}
 
 @app.get("/books/recomendations-author/{author_id}")
-async def get_recommendations(author_id, db: Storage = Depends(get_db)):
-    books = db.recommend_books_by_author(author_id)
+async def get_recommendations(author_id, db: Storage = Depends(get_storage)):
+    books = await run_db(db.recommend_books_by_author, author_id)
+    return {"data": books}
+
+@app.get("/books/{book_id}/similar")
+async def get_similar_books(
+    book_id: int,
+    limit: int = Query(default=5, gt=0, le=50),
+    db: Storage = Depends(get_storage),
+):
+    books = await run_db(db.similar_books, book_id, limit)
     return {"data": books}
 
 @app.get("/authors")
-async def retrieve_author(db: Storage = Depends(get_db)):
-    authors = db.retrieve_authors()
+async def retrieve_author(db: Storage = Depends(get_storage)):
+    authors = await run_db(db.retrieve_authors)
     return {"authors": authors}
 
 
-@app.post("/authors")
+@app.post("/authors", dependencies=[Depends(bind_validation_db)])
 async def create_author(author: Author, current_user: UserBase = Depends(oath2.get_current_user_id), db: Storage = Depends(get_db)):
 
-    author = db.insert_authors(author)
+    author = await run_db(db.insert_authors, author)
     return {"author": author}
 
 
-@app.post("/genres")
+@app.post("/genres", dependencies=[Depends(bind_validation_db)])
 async def create_genre(genre: Genre, current_user: UserBase = Depends(oath2.get_current_user_id), db: Storage = Depends(get_db)):
-    genre = db.insert_genres(genre)
+    genre = await run_db(db.insert_genres, genre)
     return {"data": genre}
 
 
 @app.delete("/books/{book_id}")
-async def delete_book_id(book_id: int, current_user: UserBase = Depends(oath2.get_current_user_id), db: Storage = Depends(get_db)):
-    deleted_book = db.delete_book(book_id)
+async def delete_book_id(book_id: int, current_user: UserBase = Depends(oath2.get_current_user_id), db: Storage = Depends(get_storage)):
+    deleted_book = await run_db(db.delete_book, book_id)
     if deleted_book is None:
         raise HTTPException(status_code=404, detail=f"Book with {book_id} not found")
 
-    return Response(
-        status_code=status.HTTP_204_NO_CONTENT,
-        content={"message": f"Book was deleted successfully"},
-    )
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@app.delete("/books")
+async def delete_books(
+    ids: list[int] = Query(min_length=1, max_length=BULK_MAX_BOOKS),
+    current_user: UserBase = Depends(oath2.get_current_user_id),
+    db: Storage = Depends(get_storage),
+):
+    deleted = await run_db(db.delete_books, ids)
+    found = set(deleted)
+    return {"deleted": deleted, "missing": [book_id for book_id in dict.fromkeys(ids) if book_id not in found]}
+
+
+@app.put("/books", dependencies=[Depends(bind_validation_db)])
+async def upsert_books(
+    rows: list[dict] = Body(min_length=1, max_length=BULK_MAX_BOOKS),
+    current_user: UserBase = Depends(oath2.get_current_user_id),
+    db: Storage = Depends(get_db),
+):
+    # Books are matched on their unique title: new titles are inserted and
+    # known ones updated. Invalid rows are reported and skipped; the rest are
+    # written in one transaction. Runs on psycopg2, like /books/import.
+    books, errors = await run_db(Book.validate_batch, db, rows, True)
+    rejected_rows = [{"index": index, "detail": detail} for index, detail in errors]
+    if not books:
+        raise HTTPException(status_code=400, detail={"message": "No valid books found", "rejected_rows": rejected_rows})
 
+    values = [(b.title, b.description, b.published_year, b.price, b.genre_id, b.author_id) for _, b in books]
+    written = await run_db(db.upsert_books, values, BULK_MAX_BOOKS)
+    inserted = sum(1 for row in written if row.pop("inserted"))
+    return {
+        "inserted": inserted,
+        "updated": len(written) - inserted,
+        "unchanged": len(books) - len(written),
+        "books": written,
+        "rejected": len(errors),
+        "rejected_rows": rejected_rows,
+    }
 
-@app.put("/books/{book_id}")
+
+@app.put("/books/{book_id}", dependencies=[Depends(bind_validation_db)])
 async def update_book_id(book_id: int, book: Book, current_user: UserBase = Depends(oath2.get_current_user_id), db: Storage = Depends(get_db)):
-    updated_book = db.update_book(book_id, book)
+    updated_book = await run_db(db.update_book, book_id, book)
     if updated_book is None:
         raise HTTPException(status_code=404, detail=f"Book with {book_id} not found")
 
     return {"book": updated_book}
 
 
+@app.get("/stats")
+async def catalog_stats(db: Storage = Depends(get_storage)):
+    rows = await run_db(db.retrieve_stats, "catalog")
+    catalog = rows[0] if rows else {"book_count": 0, "price_avg": None, "price_min": None, "price_max": None}
+    return {"data": {field: catalog[field] for field in ("book_count", "price_avg", "price_min", "price_max")}}
+
+
+@app.get("/stats/{dimension}")
+async def dimension_stats(dimension: Literal["genre", "author", "year"], db: Storage = Depends(get_storage)):
+    return {"data": await run_db(db.retrieve_stats, dimension)}
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    model = get_read_model(get_dsn())
+    return {
+        "storage": storage_cache.stats(),
+        "tokens": oath2.token_cache.stats(),
+        "users": user_cache.stats(),
+        "read_model": model.stats() if model else None,
+        "coalescing": singleflight.flights.stats(),
+        "admission": admission.stats(),
+    }
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return PlainTextResponse(db_metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def with_storage(method, *args):
+    # A short-lived pooled connection, for handlers that must not hold one
+    # while they wait on the password hashing pool.
+    with Storage(pooled=True) as db:
+        return method(db, *args)
+
+
 @app.post('/register', status_code=status.HTTP_201_CREATED)
-def create_user(user: UserBase, db: Storage = Depends(get_db)):
-    hashed_password = utils.hash(user.password)
+async def create_user(user: UserBase):
+    # passlib/bcrypt load on the first register or login, not on cold start.
+    from app import utils
+
+    hashed_password = await utils.hash_async(user.password)
     user.password = hashed_password
-    new_user = db.create_user(user)
+    new_user = await run_in_threadpool(with_storage, Storage.create_user, user)
     return new_user
 
 
 @app.post("/login", response_model=Token)
-def login(user_credentials: UserBase, db: Storage = Depends(get_db)):
-    user = db.retrieve_user_by_email(user_credentials.email)
+async def login(user_credentials: UserBase):
+    from app import utils
+
+    user = await run_in_threadpool(with_storage, Storage.retrieve_user_by_email, user_credentials.email)
     if not user:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
-    if not utils.verify_password(user_credentials.password, user.get('password')):
+    verified, new_hash = await utils.verify_and_update_async(user_credentials.password, user.get('password'))
+    if not verified:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Incorrect Credentials")
+    if new_hash:
+        await run_in_threadpool(with_storage, Storage.update_user_password, user.get('id'), new_hash)
     access_token = oath2.create_access_token(data={"user_id":user.get('id')})
     return {'access_token': access_token, 'token_type': 'bearer'}
@@ -0,0 +1,65 @@
+import logging
+import os
+import time
+
+from db import metrics
+
+# Adds X-DB-Queries / X-DB-Connections to every response, for debugging and
+# the per-route budgets in the tests; off in production.
+TRACE_HEADERS = os.getenv("TRACE_HEADERS", "0") == "1"
+
+logger = logging.getLogger(__name__)
+
+http_requests = metrics.Counter("http_requests_total", "Requests by route and status.", ("method", "route", "status"))
+http_seconds = metrics.Histogram("http_request_duration_seconds", "Request latency by route.", ("method", "route"))
+http_in_flight = metrics.Gauge("http_requests_in_flight", "Requests being served.")
+
+
+def route_of(scope):
+    # The route template, not the raw path, so ids do not explode the label set.
+    route = scope.get("route")
+    return getattr(route, "path_format", None) or getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    # Pure ASGI, so streaming responses pass through untouched. Every request
+    # gets a RequestTrace that Storage queries and connections are counted
+    # into, on whichever threadpool thread they run.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        trace = metrics.RequestTrace()
+        token = metrics.current_trace.set(trace)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_trace(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if TRACE_HEADERS:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-db-queries", str(trace.queries).encode()),
+                        (b"x-db-connections", str(trace.connections).encode()),
+                    ]
+            await send(message)
+
+        http_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec()
+            metrics.current_trace.reset(token)
+            route = route_of(scope)
+            if metrics.METRICS_ENABLED:
+                http_requests.inc((scope["method"], route, str(status)))
+                http_seconds.observe(elapsed, (scope["method"], route))
+            logger.debug(
+                "%s %s %s %.1fms queries=%d connections=%d db=%.1fms",
+                scope["method"], route, status, elapsed * 1000, trace.queries, trace.connections, trace.db_seconds * 1000,
+            )
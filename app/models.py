@@ -1,11 +1,35 @@
+import json
+import math
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import date
 from traceback import print_tb
 
-from fastapi import HTTPException
-from pydantic import BaseModel, conint, field_validator, model_validator, EmailStr
-from typing import Optional
+from fastapi import Depends, HTTPException
+from pydantic import BaseModel, PrivateAttr, ValidationInfo, conint, field_validator, model_validator, EmailStr
+from typing import Literal, Optional
 
-from db.database import Storage
+from db.database import SORT_COLUMNS, Storage, get_db
+
+validation_db = ContextVar("validation_db", default=None)
+
+
+async def bind_validation_db(db: Storage = Depends(get_db)):
+    # Route dependency: resolved before the body is parsed, in the same task,
+    # so the model validators below run their checks on the request's own
+    # connection instead of opening another one.
+    validation_db.set(db)
+
+
+@contextmanager
+def validation_storage(info):
+    db = (info.context or {}).get("db") or validation_db.get()
+    if db is not None:
+        yield db
+    else:
+        with Storage(pooled=True) as db:
+            yield db
 
 
 class Author(BaseModel):
@@ -14,11 +38,11 @@ class Author(BaseModel):
 
     @model_validator(mode="before")
     @classmethod
-    def unique_validator(cls, data):
-        db = Storage()
+    def unique_validator(cls, data, info: ValidationInfo):
         firstname = data.get("firstname")
         lastname = data.get("lastname")
-        author = db.retrieve_author_for_firstname_and_lastname(firstname, lastname)
+        with validation_storage(info) as db:
+            author = db.retrieve_author_for_firstname_and_lastname(firstname, lastname)
         if author is not None:
             raise HTTPException(status_code=400, detail="Author already exists")
         return data
@@ -33,9 +57,9 @@ class Genre(BaseModel):
     name_genre: str
 
     @field_validator("name_genre")
-    def validate_name_genre(cls, value):
-        db = Storage()
-        genre = db.retrieve_genre_by_title(value)
+    def validate_name_genre(cls, value, info: ValidationInfo):
+        with validation_storage(info) as db:
+            genre = db.retrieve_genre_by_title(value)
         if genre is not None:
             raise HTTPException(status_code=400, detail="Genre already exists")
         return value
@@ -50,8 +74,10 @@ class Book(BaseModel):
     author_id: int
 
     @model_validator(mode="before")
-    def validatator(cls, values):
-        db = Storage()
+    def validatator(cls, values, info: ValidationInfo):
+        if not isinstance(values, dict):
+            return values
+
         title_name = values.get("title")
         description = values.get("description")
         author_id = values.get("author_id")
@@ -63,21 +89,73 @@ class Book(BaseModel):
         if len(description) == 0:
             raise HTTPException(status_code=400, detail="Description cannot be empty")
 
-        title_name = db.retrieve_book_for_title(title_name)
-        if title_name is not None:
+        if info.context and info.context.get("batch"):
+            # validate_batch resolves titles and foreign keys for the whole batch.
+            return values
+
+        with validation_storage(info) as db:
+            references = db.check_book_references(title_name, author_id, genre_id)
+
+        if references["title_exists"]:
             raise HTTPException(
                 status_code=400, detail="Book with such title already exists"
             )
 
-        author = db.retrieve_author_by_id(author_id)
-        if author is None:
+        if not references["author_exists"]:
             raise HTTPException(status_code=400, detail="Author not found")
 
-        genre = db.retrieve_genre(genre_id)
-        if genre is None:
+        if not references["genre_exists"]:
             raise HTTPException(status_code=400, detail="Genre not found")
         return values
 
+    @classmethod
+    def validate_batch(cls, db, rows, upsert=False):
+        # Same checks and messages as `validatator`, but with one query per
+        # table for the whole batch. Returns ([(index, book)], [(index, detail)]).
+        # With upsert, titles already in the catalog are accepted (they get
+        # updated), but each title may appear only once in the batch.
+        candidates = []
+        errors = []
+        for index, row in enumerate(rows):
+            try:
+                candidates.append((index, cls.model_validate(row, context={"batch": True})))
+            except HTTPException as e:
+                errors.append((index, e.detail))
+            except Exception as e:
+                errors.append((index, str(e)))
+
+        existing_titles = set() if upsert else set(db.retrieve_existing_titles({book.title for _, book in candidates}))
+        author_ids = db.retrieve_existing_author_ids({book.author_id for _, book in candidates})
+        genre_ids = db.retrieve_existing_genre_ids({book.genre_id for _, book in candidates})
+
+        books = []
+        for index, book in candidates:
+            if book.title in existing_titles:
+                errors.append((index, "Duplicate title in batch" if upsert else "Book with such title already exists"))
+            elif book.author_id not in author_ids:
+                errors.append((index, "Author not found"))
+            elif book.genre_id not in genre_ids:
+                errors.append((index, "Genre not found"))
+            else:
+                # Later rows with the same title count as duplicates.
+                existing_titles.add(book.title)
+                books.append((index, book))
+
+        errors.sort()
+        return books, errors
+
+
+def is_int4(value):
+    return type(value) is int and -2**31 <= value < 2**31
+
+
+def cursor_value_fits(column_type, value):
+    if column_type == "integer":
+        return is_int4(value)
+    if column_type == "real":
+        return type(value) in (int, float) and math.isfinite(value) and abs(value) <= 3.4e38
+    return type(value) is str and "\x00" not in value
+
 
 class QueryParams(BaseModel):
     title: Optional[str] = None
@@ -86,9 +164,45 @@ class QueryParams(BaseModel):
     published_year_end: Optional[int] = None
     genre_id: Optional[int] = None
     author_id: Optional[int] = None
-    sort_by: Optional[str] = None
-    limit: Optional[int] = None
-    offset: Optional[int] = None
+    sort_by: Optional[Literal["id", "title", "published_year", "price"]] = None
+    order: Literal["asc", "desc"] = "asc"
+    limit: Optional[conint(gt=0)] = None
+    offset: Optional[conint(ge=0)] = None
+    cursor: Optional[str] = None
+
+    _after: Optional[tuple] = PrivateAttr(default=None)
+
+    @model_validator(mode="after")
+    def decode_cursor(self):
+        if self.cursor is None:
+            return self
+        try:
+            sort_by, order, value, last_id = json.loads(urlsafe_b64decode(self.cursor.encode()))
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if sort_by != (self.sort_by or "id") or order != self.order:
+            raise HTTPException(status_code=400, detail="Cursor does not match sort_by and order")
+        # The values go into the keyset condition, so they must fit the
+        # column types; a null value comes from a book without that column.
+        if not (is_int4(last_id) and (value is None or cursor_value_fits(SORT_COLUMNS[sort_by], value))):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        self._after = (value, last_id)
+        return self
+
+    @property
+    def after(self):
+        return self._after
+
+    def next_cursor(self, rows):
+        return self.cursor_after(len(rows), rows[-1] if rows else None)
+
+    def cursor_after(self, count, last):
+        # Only a full page can have a next one.
+        if self.limit is None or count < self.limit:
+            return None
+        sort_by = self.sort_by or "id"
+        payload = json.dumps([sort_by, self.order, last[sort_by], last["id"]])
+        return urlsafe_b64encode(payload.encode()).decode()
 
 
 class Token(BaseModel):
@@ -1,16 +1,15 @@
+import hashlib
 import os
+import time
 
-from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from fastapi import Depends, status, HTTPException
+from starlette.concurrency import run_in_threadpool
 
+from db.cache import CACHE_ENABLED, LRUCache, user_cache
 from db.database import Storage
-from app.models import TokenData
+from app.models import TokenData, validation_db
 from fastapi.security import OAuth2PasswordBearer
-from dotenv import load_dotenv
-
-load_dotenv()
-
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
@@ -18,8 +17,19 @@ SECRET_KEY = f"{os.getenv('SECRET_KEY')}"
 ALGORITHM = f"{os.getenv('ALGORITHM')}"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(f"{os.getenv('ACCESS_TOKEN_EXPIRE_MINUTES')}")
 
+# Verified tokens keyed by their sha256 digest, so a repeat request skips the
+# signature check. Entries never outlive the token's exp claim.
+token_cache = LRUCache(
+    maxsize=int(os.getenv("TOKEN_CACHE_MAXSIZE", "4096")),
+    ttl=float(os.getenv("TOKEN_CACHE_TTL", "300")),
+)
+
 
 def create_access_token(data: dict):
+    # python-jose is imported on first use, keeping it out of cold starts
+    # that never touch a token.
+    from jose import jwt
+
     to_encode = data.copy()
 
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -30,21 +40,37 @@ def create_access_token(data: dict):
 
 
 def verify_access_token(token: str, credentials_exception):
+    digest = hashlib.sha256(token.encode()).hexdigest()
+    hit, token_data = token_cache.get(digest)
+    if hit:
+        return token_data
+
+    from jose import JWTError, jwt
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id: int = payload.get("user_id")
-        if id is None:
+        if user_id is None:
             raise credentials_exception
         token_data = TokenData(id=user_id)
     except JWTError:
         raise credentials_exception
 
+    # Only valid tokens are cached; rejected ones are re-checked every time.
+    ttl = token_cache.ttl
+    if payload.get("exp") is not None:
+        ttl = min(ttl, payload["exp"] - time.time())
+    if CACHE_ENABLED and ttl > 0:
+        token_cache.set(digest, token_data, ttl=ttl)
     return token_data
 
 
-def get_current_user_id(
-    token: str = Depends(oauth2_scheme)
-):
+def load_user(user_id):
+    with Storage(pooled=True) as db:
+        return db.retrieve_user_by_id(user_id)
+
+
+async def get_current_user_id(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -52,6 +78,15 @@ def get_current_user_id(
     )
 
     token = verify_access_token(token, credentials_exception)
-    with Storage() as db:
-        user = db.retrieve_user_by_id(token.id)
+    # A connection is only checked out when the user is not cached, and not
+    # at all on routes that already hold one for validation.
+    hit, user = user_cache.get(token.id)
+    if not hit:
+        db = validation_db.get()
+        if db is not None:
+            user = await run_in_threadpool(db.retrieve_user_by_id, token.id)
+        else:
+            user = await run_in_threadpool(load_user, token.id)
+        if CACHE_ENABLED and user is not None:
+            user_cache.set(token.id, user)
     return user
@@ -0,0 +1,143 @@
+import os
+import queue
+import threading
+import zlib
+
+import orjson
+
+from db.database import EXPORT_COLUMNS, Storage
+
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+# COPY output is regrouped into EXPORT_CHUNK_SIZE chunks; at most
+# EXPORT_QUEUE_SIZE of them wait for a slow client before COPY blocks.
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_QUEUE_SIZE = 16
+
+MEDIA_TYPES = {"csv": "text/csv", "json": "application/json", "ndjson": "application/x-ndjson"}
+
+
+def array_chunks(batches, totals=None):
+    yield b"["
+    count = 0
+    last = None
+    for rows in batches:
+        chunk = b",".join(map(orjson.dumps, rows))
+        yield chunk if not count else b"," + chunk
+        count += len(rows)
+        last = rows[-1]
+    yield b"]"
+    if totals is not None:
+        totals.update(count=count, last=last)
+
+
+def json_chunks(batches, query):
+    # Same envelope as the buffered GET /books, one chunk per batch.
+    totals = {}
+    yield b'{"data":'
+    yield from array_chunks(batches, totals)
+    yield b',"next_cursor":' + orjson.dumps(query.cursor_after(totals["count"], totals["last"])) + b"}"
+
+
+def ndjson_chunks(batches):
+    for rows in batches:
+        yield b"".join(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE) for row in rows)
+
+
+def stream_books(query, fmt):
+    # Request dependencies with yield are torn down before a streaming body
+    # is sent, so the stream checks out its own connection and returns it
+    # when the body is done (or the client goes away).
+    db = Storage(pooled=True)
+    try:
+        batches = db.stream_books(query, STREAM_BATCH_SIZE)
+        yield from json_chunks(batches, query) if fmt == "json" else ndjson_chunks(batches)
+    finally:
+        db.close()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class QueueWriter:
+    # File-like target for copy_expert that hands COPY output to the
+    # response through a bounded queue.
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= EXPORT_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+        raise ExportCancelled()
+
+
+def copy_chunks(query):
+    chunks = queue.Queue(EXPORT_QUEUE_SIZE)
+    cancelled = threading.Event()
+
+    def produce():
+        writer = QueueWriter(chunks, cancelled)
+        try:
+            with Storage(pooled=True) as db:
+                db.export_books_csv(query, writer)
+            writer.flush()
+            writer.put(None)
+        except Exception as e:
+            if not cancelled.is_set():
+                writer.put(e)
+
+    producer = threading.Thread(target=produce, name="books-export", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+        producer.join()
+
+
+def export_books(query, fmt):
+    if fmt == "csv":
+        yield from copy_chunks(query)
+        return
+
+    db = Storage(pooled=True)
+    try:
+        batches = db.stream_books(query, STREAM_BATCH_SIZE, EXPORT_COLUMNS)
+        yield from array_chunks(batches) if fmt == "json" else ndjson_chunks(batches)
+    finally:
+        db.close()
+
+
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        chunks.close()
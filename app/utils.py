@@ -1,6 +1,31 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from db import config
+
+# Hashes made with a different cost are flagged by verify_and_update, so
+# changing BCRYPT_ROUNDS rehashes each password on its next login.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt runs on its own bounded pool instead of Starlette's threadpool, so a
+# login burst queues here rather than starving every other sync dependency.
+# Lambda has no /dev/shm for multiprocessing, so it falls back to threads
+# (bcrypt releases the GIL while hashing).
+PASSWORD_HASH_EXECUTOR = os.getenv(
+    "PASSWORD_HASH_EXECUTOR", "thread" if config.LAMBDA else "process"
+)
+PASSWORD_HASH_WORKERS = config.PASSWORD_HASH_WORKERS
+PASSWORD_HASH_QUEUE = config.PASSWORD_HASH_QUEUE
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", "10"))
 
 
 def hash(password: str):
@@ -9,3 +34,117 @@ def hash(password: str):
 
 def verify_password(password_to_check, hashed_password):
     return pwd_context.verify(password_to_check, hashed_password)
+
+
+def verify_and_update(password_to_check, hashed_password):
+    # Returns (matches, new_hash); new_hash is None unless the stored hash
+    # was made with other settings and should be replaced.
+    return pwd_context.verify_and_update(password_to_check, hashed_password)
+
+
+class HashPool:
+    def __init__(self, kind, workers, queue, timeout):
+        self.kind = kind
+        self.workers = workers
+        self.limit = workers + queue
+        self.timeout = timeout
+        self.pending = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.kind == "process":
+                    self._executor = ProcessPoolExecutor(
+                        self.workers, mp_context=multiprocessing.get_context("spawn")
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="bcrypt")
+            return self._executor
+
+    def _release(self, _):
+        with self._lock:
+            self.pending -= 1
+
+    def _discard(self, executor):
+        # A worker process died: every later submit to this executor raises
+        # BrokenProcessPool, so the next call starts a fresh one.
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, fn, *args):
+        executor = self.executor()
+        try:
+            return executor, executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._discard(executor)
+        executor = self.executor()
+        return executor, executor.submit(fn, *args)
+
+    async def run(self, fn, *args):
+        # pending counts work until it actually finishes, so a timed-out hash
+        # still holds its slot and the pool can never be oversubscribed.
+        with self._lock:
+            if self.pending >= self.limit:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many concurrent password checks",
+                    headers={"Retry-After": "1"},
+                )
+            self.pending += 1
+        try:
+            executor, future = self._submit(fn, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except BrokenProcessPool:
+            self._discard(executor)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Password check failed",
+                headers={"Retry-After": "1"},
+            )
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Password check timed out",
+                headers={"Retry-After": "1"},
+            )
+
+    def stats(self):
+        with self._lock:
+            return {
+                "executor": self.kind,
+                "workers": self.workers,
+                "limit": self.limit,
+                "pending": self.pending,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+hash_pool = HashPool(PASSWORD_HASH_EXECUTOR, PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE, PASSWORD_HASH_TIMEOUT)
+
+
+async def hash_async(password: str):
+    return await hash_pool.run(hash, password)
+
+
+async def verify_and_update_async(password_to_check, hashed_password):
+    return await hash_pool.run(verify_and_update, password_to_check, hashed_password)
@@ -0,0 +1,90 @@
+"""Deterministic synthetic catalog.
+
+    python -m benchmarks.generate --size 100k
+
+Drops and recreates the schema in the database configured by DATABASE_*,
+then loads genres, authors and books derived only from --size and --seed,
+so two runs of the same size produce identical tables.
+"""
+import argparse
+import random
+import time
+
+from psycopg2.extras import execute_values
+
+from app import utils
+from db import database, recommendations
+from db.database import Storage, upgrade_schema
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+WORDS = [
+    "shadow", "river", "empire", "glass", "winter", "machine", "garden", "storm",
+    "silent", "crimson", "harbor", "echo", "iron", "paper", "lantern", "orbit",
+    "hollow", "ember", "north", "velvet", "signal", "atlas", "cinder", "meadow",
+]
+
+BENCH_USER = {"email": "bench@example.com", "password": "benchmark-password"}
+
+
+def catalog_shape(books):
+    # About 20 books per author and 1000 per genre, whatever the size.
+    return {"books": books, "authors": max(1, books // 20), "genres": max(10, books // 1000)}
+
+
+def iter_books(books, authors, genres, seed=0):
+    rng = random.Random(seed)
+    for i in range(books):
+        yield (
+            f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}",
+            " ".join(rng.choice(WORDS) for _ in range(12)),
+            rng.randint(1900, 2024),
+            round(rng.uniform(1, 100), 2),
+            rng.randint(1, genres),
+            rng.randint(1, authors),
+        )
+
+
+def generate(db, books, seed=0):
+    shape = catalog_shape(books)
+    db.drop_database()
+    upgrade_schema()
+    with db.connection.cursor() as cursor:
+        cursor.execute("""DELETE FROM users""")
+        execute_values(
+            cursor,
+            """INSERT INTO genre (name_genre) VALUES %s""",
+            [(f"Genre {i}",) for i in range(shape["genres"])],
+        )
+        execute_values(
+            cursor,
+            """INSERT INTO author (firstname, lastname) VALUES %s""",
+            [(f"First {i}", f"Last {i}") for i in range(shape["authors"])],
+        )
+        cursor.execute(
+            """INSERT INTO users (email, password) VALUES (%s, %s)""",
+            (BENCH_USER["email"], utils.hash(BENCH_USER["password"])),
+        )
+    db.connection.commit()
+
+    # One rebuild after the load instead of background refreshes of every
+    # queued book.
+    database.RECOMMENDATIONS_REFRESH = False
+    db.copy_books(iter_books(books, shape["authors"], shape["genres"], seed))
+    recommendations.rebuild(db.connection)
+    with db.connection.cursor() as cursor:
+        cursor.execute("""ANALYZE""")
+    db.connection.commit()
+    return shape
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=SIZES, default="10k")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with Storage() as db:
+        shape = generate(db, SIZES[args.size], args.seed)
+    print({**shape, "seconds": round(time.perf_counter() - started, 1)})
@@ -0,0 +1,66 @@
+import asyncio
+import statistics
+import time
+
+from db.metrics import round_trips
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(latencies, elapsed, trips, operations):
+    return {
+        "operations": operations,
+        "ops_per_sec": round(operations / elapsed, 1) if elapsed else None,
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "round_trips": round(trips / operations, 2),
+    }
+
+
+def measure(operation, iterations, warmup=5, before=None):
+    # operation(i) runs once per iteration; before(i), if given, runs
+    # untimed and uncounted ahead of it (e.g. to clear caches).
+    for i in range(warmup):
+        if before:
+            before(i)
+        operation(i)
+
+    latencies = []
+    trips = 0
+    started = time.perf_counter()
+    for i in range(iterations):
+        if before:
+            before(i)
+        trips_before = round_trips.count
+        op_started = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - op_started)
+        trips += round_trips.count - trips_before
+    elapsed = sum(latencies) if before else time.perf_counter() - started
+    return summarize(latencies, elapsed, trips, iterations)
+
+
+async def measure_async(operation, iterations, concurrency=1, warmup=5):
+    # operation(i) is a coroutine function; `concurrency` workers share the
+    # iterations, and round trips are averaged over all of them.
+    for i in range(warmup):
+        await operation(i)
+
+    latencies = []
+    remaining = iter(range(iterations))
+
+    async def worker():
+        for i in remaining:
+            op_started = time.perf_counter()
+            await operation(i)
+            latencies.append(time.perf_counter() - op_started)
+
+    trips_before = round_trips.count
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return summarize(latencies, elapsed, round_trips.count - trips_before, iterations)
@@ -0,0 +1,151 @@
+"""Lambda cold-start and warm-invocation timings from replayed API Gateway events.
+
+    python -m benchmarks.lambda_replay --cold-starts 5 --warm 200
+
+Events in the API Gateway HTTP API (payload 2.0) format are passed straight
+to app.main.handler, as the Lambda runtime does. Every cold start is a fresh
+interpreter with AWS_LAMBDA_FUNCTION_NAME set, timing the import of app.main
+(the init phase) and the first invocation. The first of them then replays
+the events --warm times each and reports latency, the queries and connection
+checkouts per invocation, and the physical connections opened meanwhile.
+Runs against the database configured by DATABASE_*.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import types
+import uuid
+
+# name: (method, path, query string)
+EVENTS = {
+    "get_books": ("GET", "/books", "limit=20"),
+    "get_book": ("GET", "/books/1", ""),
+    "get_books_by_genre": ("GET", "/books", "genre_id=1&limit=20"),
+    "stats_by_genre": ("GET", "/stats/genre", ""),
+    "recommendations_by_genre": ("GET", "/books/recomendations-genre/1", ""),
+}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def api_gateway_event(method, path, query=""):
+    now = time.time()
+    return {
+        "version": "2.0",
+        "routeKey": "$default",
+        "rawPath": path,
+        "rawQueryString": query,
+        "headers": {"host": "replay.lambda-url.localhost", "accept": "application/json", "user-agent": "lambda-replay"},
+        "requestContext": {
+            "accountId": "anonymous",
+            "apiId": "replay",
+            "domainName": "replay.lambda-url.localhost",
+            "http": {
+                "method": method,
+                "path": path,
+                "protocol": "HTTP/1.1",
+                "sourceIp": "127.0.0.1",
+                "userAgent": "lambda-replay",
+            },
+            "requestId": str(uuid.uuid4()),
+            "routeKey": "$default",
+            "stage": "$default",
+            "time": time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(now)),
+            "timeEpoch": int(now * 1000),
+        },
+        "isBase64Encoded": False,
+    }
+
+
+def lambda_context():
+    return types.SimpleNamespace(
+        function_name=os.environ["AWS_LAMBDA_FUNCTION_NAME"],
+        aws_request_id=str(uuid.uuid4()),
+        get_remaining_time_in_millis=lambda: 30000,
+    )
+
+
+def invoke(handler, name):
+    started = time.perf_counter()
+    response = handler(api_gateway_event(*EVENTS[name]), lambda_context())
+    elapsed = time.perf_counter() - started
+    headers = response.get("headers", {})
+    return elapsed, response["statusCode"], int(headers.get("x-db-queries", 0)), int(headers.get("x-db-connections", 0))
+
+
+def container(warm):
+    # One simulated container: init phase, first invocation, then warm ones.
+    started = time.perf_counter()
+    from app.main import handler
+    from db import metrics
+
+    init = time.perf_counter() - started
+    first, first_status, _, _ = invoke(handler, "get_books")
+    report = {"init_ms": round(init * 1000, 1), "first_invoke_ms": round(first * 1000, 1), "first_status": first_status}
+    if not warm:
+        return report
+
+    opened = sum(value for _, _, value in metrics.db_connections.samples())
+    results = {}
+    for name in EVENTS:
+        latencies, statuses, queries, checkouts = [], {}, 0, 0
+        for _ in range(warm):
+            elapsed, status, query_count, connection_count = invoke(handler, name)
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            queries += query_count
+            checkouts += connection_count
+        results[name] = {
+            "p50_ms": round(statistics.median(latencies) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "queries_per_invoke": round(queries / warm, 2),
+            "connections_per_invoke": round(checkouts / warm, 2),
+            "statuses": statuses,
+        }
+    report["warm"] = results
+    report["warm_connections_opened"] = sum(value for _, _, value in metrics.db_connections.samples()) - opened
+    return report
+
+
+def main(args):
+    if args.container:
+        print(json.dumps(container(args.warm)))
+        return
+
+    env = dict(os.environ, AWS_LAMBDA_FUNCTION_NAME="lambda-replay", TRACE_HEADERS="1", METRICS_ENABLED="1")
+    runs = []
+    for i in range(args.cold_starts):
+        command = [sys.executable, "-m", "benchmarks.lambda_replay", "--container", "--warm", str(args.warm if i == 0 else 0)]
+        output = subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+        print(f"cold start {i + 1}", {key: runs[-1][key] for key in ("init_ms", "first_invoke_ms")}, file=sys.stderr)
+
+    init = [run["init_ms"] for run in runs]
+    first = [run["first_invoke_ms"] for run in runs]
+    print(json.dumps({
+        "cold_start": {
+            "runs": len(runs),
+            "init_p50_ms": statistics.median(init),
+            "init_max_ms": max(init),
+            "first_invoke_p50_ms": statistics.median(first),
+            "first_invoke_max_ms": max(first),
+            "first_statuses": sorted({run["first_status"] for run in runs}),
+        },
+        "warm": runs[0].get("warm"),
+        "warm_connections_opened": runs[0].get("warm_connections_opened"),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cold-starts", type=int, default=5)
+    parser.add_argument("--warm", type=int, default=100, help="invocations per event in the first container")
+    parser.add_argument("--container", action="store_true", help=argparse.SUPPRESS)
+    main(parser.parse_args())
@@ -0,0 +1,93 @@
+"""Login throughput and latency under concurrent load.
+
+    python -m benchmarks.login --concurrency 1 8 32 64 --requests 200
+
+Runs the app in-process against the database configured by DATABASE_*, or
+against a running server with --url. Set BCRYPT_ROUNDS and
+PASSWORD_HASH_EXECUTOR/WORKERS/QUEUE to compare configurations.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import httpx
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_level(client, credentials, concurrency, requests):
+    latencies = []
+    statuses = {}
+    probe_latencies = []
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            started = time.perf_counter()
+            response = await client.post("/login", json=credentials)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    async def probe(done):
+        # A cheap request alongside the burst shows whether logins starve the
+        # rest of the app.
+        while not done.is_set():
+            started = time.perf_counter()
+            await client.get("/cache/stats")
+            probe_latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(0.01)
+
+    done = asyncio.Event()
+    probe_task = asyncio.create_task(probe(done))
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await probe_task
+
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "logins_per_sec": round(requests / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "probe_p99_ms": round(percentile(probe_latencies, 0.99) * 1000, 1) if probe_latencies else None,
+        "statuses": statuses,
+    }
+
+
+async def main(args):
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+    else:
+        from app.main import app
+
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=60)
+
+    credentials = {"email": f"bench-{uuid.uuid4().hex[:8]}@example.com", "password": "benchmark-password"}
+    async with client:
+        response = await client.post("/register", json=credentials)
+        response.raise_for_status()
+        await client.post("/login", json=credentials)
+
+        for concurrency in args.concurrency:
+            print(await run_level(client, credentials, concurrency, args.requests))
+
+    if not args.url:
+        from app import utils
+
+        print(utils.hash_pool.stats())
+        utils.hash_pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--requests", type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,80 @@
+"""Per-query latency of the hot Storage lookups, plain versus prepared.
+
+    python -m benchmarks.prepared --size 100k --iterations 2000
+
+Runs against the database configured by DATABASE_*, which must hold a
+catalog made by benchmarks.generate with the same --size. Every query runs
+on one connection, first as plain SQL (PREPARED_STATEMENTS off) and then as
+a prepared statement, with the storage cache cleared before each call so
+every call reaches Postgres. Prints both results and the p50 speedup.
+"""
+import argparse
+import json
+import random
+import sys
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from benchmarks import harness
+from benchmarks.generate import SIZES, catalog_shape
+from db import prepared
+from db.cache import storage_cache
+from db.database import Storage, get_dsn
+from db.metrics import TracingConnection
+
+
+def scenarios(db, shape):
+    rng = random.Random(3)
+    ids = [rng.randint(1, shape["books"]) for _ in range(1000)]
+    authors = [rng.randint(1, shape["authors"]) for _ in range(1000)]
+    genres = [rng.randint(1, shape["genres"]) for _ in range(1000)]
+    with db.connection.cursor() as cursor:
+        cursor.execute("""SELECT title FROM book WHERE id = ANY(%s)""", (ids,))
+        titles = [row["title"] for row in cursor.fetchall()]
+        cursor.execute("""SELECT id FROM users LIMIT 100""")
+        users = [row["id"] for row in cursor.fetchall()] or [1]
+    db.connection.commit()
+
+    def pick(values, i):
+        return values[i % len(values)]
+
+    return {
+        "retrieve_book_by_id": lambda i: db.retrieve_book_by_id(pick(ids, i)),
+        "retrieve_book_for_title": lambda i: db.retrieve_book_for_title(pick(titles, i)),
+        "check_book_references": lambda i: db.check_book_references(pick(titles, i), pick(authors, i), pick(genres, i)),
+        "retrieve_author_by_id": lambda i: db.retrieve_author_by_id(pick(authors, i)),
+        "retrieve_genre": lambda i: db.retrieve_genre(pick(genres, i)),
+        "retrieve_user_by_id": lambda i: db.retrieve_user_by_id(pick(users, i)),
+        "recommend_books_by_genre": lambda i: db.recommend_books_by_genre(pick(genres, i)),
+        "recommend_books_by_author": lambda i: db.recommend_books_by_author(pick(authors, i)),
+        "similar_books": lambda i: db.similar_books(pick(ids, i)),
+    }
+
+
+def main(args):
+    shape = catalog_shape(SIZES[args.size])
+    connection = psycopg2.connect(get_dsn(), cursor_factory=RealDictCursor, connection_factory=TracingConnection)
+    db = Storage(connection=connection)
+
+    results = {}
+    for name, operation in scenarios(db, shape).items():
+        results[name] = {}
+        for mode in ("plain", "prepared"):
+            prepared.PREPARED_STATEMENTS = mode == "prepared"
+            results[name][mode] = harness.measure(
+                operation, args.iterations, before=lambda i: storage_cache.clear()
+            )
+            connection.rollback()
+        results[name]["p50_speedup"] = round(results[name]["plain"]["p50_ms"] / results[name]["prepared"]["p50_ms"], 2)
+        print(name, results[name], file=sys.stderr)
+    db.close()
+
+    print(json.dumps({"meta": {"size": args.size, "iterations": args.iterations}, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=SIZES, default="10k")
+    parser.add_argument("--iterations", type=int, default=2000)
+    main(parser.parse_args())
@@ -0,0 +1,235 @@
+"""Storage- and endpoint-level benchmarks with a baseline regression check.
+
+    python -m benchmarks.generate --size 100k
+    python -m benchmarks.run --size 100k --save benchmarks/baseline-100k.json
+    python -m benchmarks.run --size 100k --compare benchmarks/baseline-100k.json
+
+Runs against the database configured by DATABASE_*, which must hold a
+catalog made by benchmarks.generate with the same --size. Every scenario
+records throughput, p50/p95/p99 latency and Postgres round trips per
+operation. --compare exits non-zero when a scenario is slower than the
+baseline by more than --tolerance, or needs more round trips.
+"""
+import argparse
+import asyncio
+import io
+import json
+import platform
+import random
+import sys
+import time
+
+import httpx
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from app.models import Book, QueryParams
+from benchmarks import harness
+from benchmarks.generate import BENCH_USER, SIZES, WORDS, catalog_shape, iter_books
+from db import database
+from db.cache import storage_cache
+from db.database import ConnectionPool, Storage, get_dsn
+from db.metrics import TracingConnection
+
+
+def deep_cursor(books):
+    # A keyset cursor 90% of the way through the catalog by price.
+    return QueryParams(sort_by="price", limit=1).cursor_after(1, {"price": 90.0, "id": int(books * 0.9)})
+
+
+def storage_scenarios(shape):
+    rng = random.Random(1)
+    ids = [rng.randint(1, shape["books"]) for _ in range(1000)]
+    genres = [rng.randint(1, shape["genres"]) for _ in range(1000)]
+    terms = [f"{rng.choice(WORDS)} {rng.choice(WORDS)}" for _ in range(1000)]
+    deep = deep_cursor(shape["books"])
+
+    def pick(values, i):
+        return values[i % len(values)]
+
+    def insert_and_delete(db, i):
+        book = Book.model_construct(
+            title=f"bench-insert-{time.time_ns()}",
+            description="benchmark",
+            published_year=2000,
+            price=10.0,
+            genre_id=pick(genres, i),
+            author_id=1,
+        )
+        db.delete_book(db.insert_book(book)["id"])
+
+    return {
+        "retrieve_books_first_page": lambda db, i: db.retrieve_books(QueryParams(limit=20)),
+        "retrieve_books_by_price": lambda db, i: db.retrieve_books(QueryParams(sort_by="price", limit=20)),
+        "retrieve_books_deep_keyset": lambda db, i: db.retrieve_books(QueryParams(sort_by="price", limit=20, cursor=deep)),
+        "retrieve_books_by_genre": lambda db, i: db.retrieve_books(QueryParams(genre_id=pick(genres, i), limit=20)),
+        "retrieve_book_by_id": lambda db, i: db.retrieve_book_by_id(pick(ids, i)),
+        "search_books": lambda db, i: db.search_books(pick(terms, i)),
+        "recommend_books_by_genre": lambda db, i: db.recommend_books_by_genre(pick(genres, i)),
+        "similar_books": lambda db, i: db.similar_books(pick(ids, i)),
+        "retrieve_stats_by_author": lambda db, i: db.retrieve_stats("author"),
+        "insert_and_delete_book": insert_and_delete,
+    }
+
+
+def endpoint_scenarios(shape):
+    rng = random.Random(2)
+    ids = [rng.randint(1, shape["books"]) for _ in range(1000)]
+    genres = [rng.randint(1, shape["genres"]) for _ in range(1000)]
+    terms = [f"{rng.choice(WORDS)} {rng.choice(WORDS)}" for _ in range(1000)]
+    deep = deep_cursor(shape["books"])
+
+    def pick(values, i):
+        return values[i % len(values)]
+
+    def import_csv(i):
+        buffer = io.StringIO()
+        buffer.write("title,description,published_year,price,genre_id,author_id\n")
+        for title, description, year, price, genre_id, author_id in iter_books(1000, shape["authors"], shape["genres"], seed=i):
+            buffer.write(f"bench-import-{time.time_ns()}-{title},{description},{year},{price},{genre_id},{author_id}\n")
+        return buffer.getvalue()
+
+    # (method, path, params or body builder, iterations)
+    return {
+        "get_books_first_page": ("GET", lambda i: ("/books", {"limit": 20}), 1),
+        "get_books_deep_keyset": ("GET", lambda i: ("/books", {"sort_by": "price", "limit": 20, "cursor": deep}), 1),
+        "get_book": ("GET", lambda i: (f"/books/{pick(ids, i)}", None), 1),
+        "search_books": ("GET", lambda i: ("/books/search", {"q": pick(terms, i)}), 1),
+        "recommendations_by_genre": ("GET", lambda i: (f"/books/recomendations-genre/{pick(genres, i)}", None), 1),
+        "similar_books": ("GET", lambda i: (f"/books/{pick(ids, i)}/similar", None), 1),
+        "stats_by_genre": ("GET", lambda i: ("/stats/genre", None), 1),
+        "stream_genre_ndjson": ("GET", lambda i: ("/books", {"genre_id": pick(genres, i), "stream": "ndjson"}), 0.2),
+        "export_genre_csv": ("GET", lambda i: ("/books/export", {"genre_id": pick(genres, i)}), 0.2),
+        "import_1000_books_csv": ("IMPORT", import_csv, 0.05),
+        "login": ("LOGIN", None, 0.1),
+    }
+
+
+def run_storage(shape, iterations):
+    connection = psycopg2.connect(get_dsn(), cursor_factory=RealDictCursor, connection_factory=TracingConnection)
+    db = Storage(connection=connection)
+    results = {}
+    for name, operation in storage_scenarios(shape).items():
+        try:
+            # Caches are cleared before every call so each one reaches Postgres.
+            results[name] = harness.measure(
+                lambda i: operation(db, i), iterations, before=lambda i: storage_cache.clear()
+            )
+        except Exception as e:
+            connection.rollback()
+            results[name] = {"error": f"{type(e).__name__}: {e}".strip()}
+        print(f"storage.{name}", results[name], file=sys.stderr)
+    db.close()
+    return results
+
+
+async def run_endpoints(shape, iterations, concurrency):
+    from app.main import app
+
+    storage_cache.clear()
+    transport = httpx.ASGITransport(app=app)
+    results = {}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        for name, (method, build, share) in endpoint_scenarios(shape).items():
+            count = max(5, int(iterations * share))
+
+            async def operation(i):
+                if method == "GET":
+                    path, params = build(i)
+                    response = await client.get(path, params=params)
+                elif method == "IMPORT":
+                    files = {"csv_file": ("books.csv", build(i), "text/csv")}
+                    response = await client.post("/books/import", files=files)
+                else:
+                    response = await client.post("/login", json=BENCH_USER)
+                if response.status_code >= 400:
+                    raise RuntimeError(f"{response.status_code} {response.text[:200]}")
+
+            try:
+                results[name] = await harness.measure_async(operation, count, concurrency)
+            except Exception as e:
+                results[name] = {"error": f"{type(e).__name__}: {e}".strip()}
+            print(f"endpoint.{name}", results[name], file=sys.stderr)
+
+    with Storage() as db, db.connection.cursor() as cursor:
+        cursor.execute("""DELETE FROM book WHERE title LIKE %s""", ("bench-import-%",))
+    return results
+
+
+def compare(current, baseline, tolerance):
+    regressions = []
+    for name, base in baseline["results"].items():
+        result = current["results"].get(name)
+        if result is None or "error" in base:
+            continue
+        if "error" in result:
+            regressions.append(f"{name}: {result['error']}")
+            continue
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if result["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['ops_per_sec']} ops/s vs baseline {base['ops_per_sec']} ops/s")
+        # Round trips are deterministic for a given catalog, so any increase counts.
+        if result["round_trips"] > base["round_trips"]:
+            regressions.append(f"{name}: {result['round_trips']} round trips vs baseline {base['round_trips']}")
+    return regressions
+
+
+def main(args):
+    shape = catalog_shape(SIZES[args.size])
+    # Pooled connections (request dependencies, streams, auth) count their
+    # round trips too.
+    database._pool = ConnectionPool(get_dsn(), maxconn=max(10, args.concurrency), connection_factory=TracingConnection)
+
+    with Storage() as db, db.connection.cursor() as cursor:
+        cursor.execute("""SELECT count(*) AS books, current_setting('server_version') AS server_version FROM book""")
+        row = cursor.fetchone()
+    if row["books"] < shape["books"]:
+        sys.exit(f"expected a {args.size} catalog, found {row['books']} books; run benchmarks.generate --size {args.size}")
+
+    results = {}
+    if args.suite in ("all", "storage"):
+        results.update({f"storage.{name}": result for name, result in run_storage(shape, args.iterations).items()})
+    if args.suite in ("all", "endpoint"):
+        endpoint_results = asyncio.run(run_endpoints(shape, args.iterations, args.concurrency))
+        results.update({f"endpoint.{name}": result for name, result in endpoint_results.items()})
+
+    report = {
+        "meta": {
+            "size": args.size,
+            **shape,
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+            "python": platform.python_version(),
+            "postgres": row["server_version"],
+            "machine": platform.machine(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=SIZES, default="10k")
+    parser.add_argument("--suite", choices=["all", "storage", "endpoint"], default="all")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--save", help="write the results as a baseline JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    main(parser.parse_args())
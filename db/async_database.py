@@ -0,0 +1,346 @@
+import asyncio
+import itertools
+import os
+import re
+import weakref
+
+import asyncpg
+
+from db import config, metrics
+from db.cache import cached, storage_cache
+from db.database import BOOK_DOCUMENT, CATALOG_VERSION, STATS_NAMES, book_query, book_query_key, get_dsn, schedule_recommendations
+from db.read_model import Unsupported, get_read_model
+from db.singleflight import coalesced
+
+_pool = None
+_pool_loop = None
+# Per loop, so concurrent first requests wait for one pool instead of each
+# creating (and leaking) their own.
+_pool_locks = weakref.WeakKeyDictionary()
+
+# Seconds a replaced pool gets to close gracefully before it is terminated.
+POOL_CLOSE_TIMEOUT = 5
+
+
+async def get_async_pool():
+    # asyncpg pools are bound to the loop they were created on, so a new loop
+    # (e.g. a fresh Mangum invocation loop) gets a new pool.
+    global _pool, _pool_loop
+    loop = asyncio.get_running_loop()
+    if _pool is not None and _pool_loop is loop:
+        return _pool
+    async with _pool_locks.setdefault(loop, asyncio.Lock()):
+        if _pool is None or _pool_loop is not loop:
+            if _pool is not None:
+                stale, stale_loop = _pool, _pool_loop
+                _pool = None
+                await _close_pool(stale, stale_loop)
+            _pool = await asyncpg.create_pool(
+                host=os.getenv("DATABASE_HOST"),
+                database=os.getenv("DATABASE_NAME"),
+                user=os.getenv("DATABASE_USER"),
+                password=os.getenv("DATABASE_PASSWORD"),
+                min_size=config.DATABASE_POOL_MIN,
+                max_size=config.DATABASE_POOL_MAX,
+                max_inactive_connection_lifetime=config.DATABASE_POOL_MAX_IDLE,
+                init=_init_connection,
+            )
+            _pool_loop = loop
+        return _pool
+
+
+async def _init_connection(connection):
+    # REAL (price) in text format, as psycopg2 reads it: 9.99 rather than
+    # the binary float4 widened to 9.989999771118164.
+    await connection.set_type_codec("float4", schema="pg_catalog", encoder=str, decoder=float, format="text")
+
+
+async def _close_pool(pool, loop):
+    # A pool can only be closed on its own loop: via that loop's thread while
+    # it runs, or by running it from a worker thread while it is idle. Once
+    # the loop is closed no I/O is possible and the sockets go when the pool
+    # is collected.
+    async def close():
+        try:
+            await asyncio.wait_for(pool.close(), POOL_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Connections still checked out on the old loop.
+            pool.terminate()
+
+    if loop is asyncio.get_running_loop():
+        await close()
+    elif loop.is_closed():
+        return
+    elif loop.is_running():
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(close(), loop))
+    else:
+        await asyncio.to_thread(loop.run_until_complete, close())
+
+
+async def close_async_pool():
+    global _pool, _pool_loop
+    if _pool is not None:
+        pool, loop = _pool, _pool_loop
+        _pool = _pool_loop = None
+        await _close_pool(pool, loop)
+
+
+def numbered(query_sql):
+    # The shared query builders emit psycopg2 %s placeholders; asyncpg wants $n.
+    counter = itertools.count(1)
+    return re.sub(r"%s", lambda _: f"${next(counter)}", query_sql)
+
+
+def _row(record):
+    return dict(record) if record is not None else None
+
+
+def _rows(records):
+    return [dict(record) for record in records]
+
+
+@metrics.instrument
+class AsyncStorage:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def _read_model(self, *tables):
+        model = get_read_model(get_dsn())
+        if model is not None and model.fresh(*tables):
+            return model
+        return None
+
+    async def insert_book(self, book):
+        record = await self.connection.fetchrow(
+            """INSERT INTO book (title, description, published_year, price, genre_id, author_id) VALUES ($1, $2, $3, $4, $5, $6) RETURNING *""",
+            book.title,
+            book.description,
+            book.published_year,
+            book.price,
+            book.genre_id,
+            book.author_id,
+        )
+        result = _row(record)
+        storage_cache.invalidate("book")
+        schedule_recommendations()
+        return result
+
+    @cached("book")
+    async def retrieve_book_for_title(self, title):
+        model = self._read_model("book")
+        if model is not None:
+            return model.retrieve_book_for_title(title)
+        return _row(await self.connection.fetchrow("""SELECT * FROM book WHERE title = $1""", title))
+
+    async def create_user(self, user):
+        record = await self.connection.fetchrow(
+            """INSERT INTO users (email, password) VALUES ($1, $2) RETURNING email""",
+            user.email,
+            user.password,
+        )
+        return _row(record)
+
+    async def retrieve_user_by_id(self, id):
+        return _row(await self.connection.fetchrow("""SELECT * FROM users WHERE id = $1""", int(id)))
+
+    async def retrieve_user_by_email(self, email):
+        return _row(await self.connection.fetchrow("""SELECT * FROM users WHERE email = $1""", email))
+
+    @cached("book", "book_rank")
+    @coalesced("book", "book_rank")
+    async def recommend_books_by_genre(self, genre_id, limit=5):
+        model = self._read_model("book", "book_rank")
+        if model is not None:
+            return model.recommend_books("genre_id", genre_id, limit)
+        records = await self.connection.fetch(
+            """SELECT book.* FROM book_rank JOIN book ON book.id = book_rank.book_id
+            WHERE book_rank.genre_id = $1 ORDER BY book_rank.score DESC, book_rank.book_id LIMIT $2""",
+            int(genre_id),
+            limit,
+        )
+        return _rows(records)
+
+    @cached("book", "book_rank")
+    @coalesced("book", "book_rank")
+    async def recommend_books_by_author(self, author_id, limit=5):
+        model = self._read_model("book", "book_rank")
+        if model is not None:
+            return model.recommend_books("author_id", author_id, limit)
+        records = await self.connection.fetch(
+            """SELECT book.* FROM book_rank JOIN book ON book.id = book_rank.book_id
+            WHERE book_rank.author_id = $1 ORDER BY book_rank.score DESC, book_rank.book_id LIMIT $2""",
+            int(author_id),
+            limit,
+        )
+        return _rows(records)
+
+    @cached("book", "book_rank")
+    async def similar_books(self, book_id, limit=5):
+        records = await self.connection.fetch(
+            """SELECT book.*, book_similarity.score AS similarity FROM book_similarity
+            JOIN book ON book.id = book_similarity.similar_book_id
+            WHERE book_similarity.book_id = $1 ORDER BY book_similarity.rank LIMIT $2""",
+            int(book_id),
+            limit,
+        )
+        return _rows(records)
+
+    async def retrieve_catalog_version(self):
+        model = self._read_model("book")
+        if model is not None:
+            return model.retrieve_catalog_version()
+        return _row(await self.connection.fetchrow(CATALOG_VERSION))
+
+    @coalesced("book", key=book_query_key)
+    async def retrieve_books(self, query_set):
+        model = self._read_model("book")
+        if model is not None:
+            try:
+                return model.retrieve_books(query_set)
+            except Unsupported:
+                pass
+        query_sql, params = book_query(query_set)
+        return _rows(await self.connection.fetch(numbered(query_sql), *params))
+
+    @cached("book")
+    @coalesced("book")
+    async def retrieve_book_by_id(self, book_id):
+        model = self._read_model("book")
+        if model is not None:
+            return model.retrieve_book_by_id(book_id)
+        return _row(await self.connection.fetchrow("""SELECT * FROM book WHERE id = $1""", int(book_id)))
+
+    async def retrieve_books_by_ids(self, book_ids):
+        model = self._read_model("book")
+        if model is not None:
+            return model.retrieve_books_by_ids(book_ids)
+        records = await self.connection.fetch("""SELECT * FROM book WHERE id = ANY($1)""", list(book_ids))
+        books = {row["id"]: row for row in _rows(records)}
+        return [books[book_id] for book_id in dict.fromkeys(book_ids) if book_id in books]
+
+    async def search_books(self, term, limit=20, offset=0):
+        records = await self.connection.fetch(
+            f"""SELECT book.*, ts_rank({BOOK_DOCUMENT}, query) + similarity(title, $1) AS score
+            FROM book, websearch_to_tsquery('english', $1) query
+            WHERE {BOOK_DOCUMENT} @@ query
+            OR title % $1
+            OR title ILIKE $2
+            ORDER BY score DESC, id
+            LIMIT $3 OFFSET $4""",
+            term,
+            f"%{term}%",
+            limit,
+            offset,
+        )
+        return _rows(records)
+
+    @cached("book", "author", "genre")
+    async def retrieve_stats(self, dimension):
+        name, join = STATS_NAMES.get(dimension, ("NULL::text", ""))
+        records = await self.connection.fetch(
+            f"""SELECT book_stats.key, {name} AS name,
+            book_stats.book_count,
+            round(book_stats.price_sum / nullif(book_stats.priced_count, 0), 2)::float AS price_avg,
+            book_stats.price_min, book_stats.price_max
+            FROM book_stats_read($1, $2) book_stats {join}
+            ORDER BY book_stats.key""",
+            dimension,
+            not getattr(self, "writing", False),
+        )
+        return _rows(records)
+
+    @cached("author")
+    async def retrieve_authors(self):
+        model = self._read_model("author")
+        if model is not None:
+            return model.retrieve_authors()
+        return _rows(await self.connection.fetch("""SELECT * FROM author"""))
+
+    @cached("author")
+    async def retrieve_author_by_id(self, author_id):
+        model = self._read_model("author")
+        if model is not None:
+            return model.retrieve_author_by_id(author_id)
+        return _row(await self.connection.fetchrow("""SELECT * FROM author WHERE id = $1""", int(author_id)))
+
+    async def retrieve_author_for_firstname_and_lastname(self, firstname, lastname):
+        model = self._read_model("author")
+        if model is not None:
+            return model.retrieve_author_for_firstname_and_lastname(firstname, lastname)
+        record = await self.connection.fetchrow(
+            """SELECT * FROM author WHERE firstname = $1 AND lastname = $2""",
+            firstname,
+            lastname,
+        )
+        return _row(record)
+
+    @cached("genre")
+    async def retrieve_genre(self, genre_id):
+        model = self._read_model("genre")
+        if model is not None:
+            return model.retrieve_genre(genre_id)
+        return _row(await self.connection.fetchrow("""SELECT * FROM genre WHERE id = $1""", int(genre_id)))
+
+    async def retrieve_genre_by_title(self, genre_name):
+        model = self._read_model("genre")
+        if model is not None:
+            return model.retrieve_genre_by_title(genre_name)
+        return _row(await self.connection.fetchrow("""SELECT * FROM genre WHERE name_genre = $1""", genre_name))
+
+    async def insert_authors(self, author):
+        await self.connection.fetchrow(
+            """INSERT INTO author (firstname, lastname) VALUES ($1, $2) RETURNING *;""",
+            author.firstname,
+            author.lastname,
+        )
+        storage_cache.invalidate("author")
+        return author
+
+    async def insert_genres(self, genre):
+        await self.connection.fetchrow(
+            """INSERT INTO genre (name_genre) VALUES ($1) RETURNING name_genre;""",
+            genre.name_genre,
+        )
+        storage_cache.invalidate("genre")
+        return genre
+
+    async def delete_book(self, book_id):
+        result = _row(await self.connection.fetchrow("""DELETE FROM book WHERE id = $1 RETURNING *""", int(book_id)))
+        storage_cache.invalidate("book")
+        if result:
+            schedule_recommendations()
+        return result
+
+    async def delete_books(self, book_ids):
+        records = await self.connection.fetch("""DELETE FROM book WHERE id = ANY($1) RETURNING id""", list(book_ids))
+        deleted = sorted(record["id"] for record in records)
+        storage_cache.invalidate("book")
+        if deleted:
+            schedule_recommendations()
+        return deleted
+
+    async def update_book(self, book_id, book):
+        record = await self.connection.fetchrow(
+            """UPDATE book SET title = $1, description = $2, published_year = $3, price = $4, genre_id = $5, author_id = $6
+            WHERE id = $7 RETURNING *""",
+            book.title,
+            book.description,
+            book.published_year,
+            book.price,
+            book.genre_id,
+            book.author_id,
+            int(book_id),
+        )
+        result = _row(record)
+        storage_cache.invalidate("book")
+        if result:
+            schedule_recommendations()
+        return result
+
+
+async def get_async_db():
+    # asyncpg runs in autocommit mode outside an explicit transaction, which
+    # matches Storage committing after every write.
+    pool = await get_async_pool()
+    async with pool.acquire() as connection:
+        yield AsyncStorage(connection)
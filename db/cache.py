@@ -0,0 +1,145 @@
+import copy
+import functools
+import inspect
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from db import config  # noqa: F401 - loads .env before the settings below are read
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._generations = {}
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def generation(self, tables):
+        return tuple(self._generations.get(table, 0) for table in tables)
+
+    def invalidate(self, *tables):
+        # Entries are keyed by the generation of every table they read, so
+        # bumping a generation orphans them in O(1); LRU eviction reclaims
+        # the space. A read racing with a write can only store its result
+        # under the old generation, where nobody looks it up again.
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+        for callback in self._subscribers:
+            callback(tables)
+
+    def subscribe(self, callback):
+        # callback(tables) runs after every invalidate, e.g. so the read model
+        # knows which tables this process just wrote.
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generations.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") == "1"
+
+storage_cache = LRUCache(
+    maxsize=int(os.getenv("CACHE_MAXSIZE", "1024")),
+    ttl=float(os.getenv("CACHE_TTL", "60")),
+)
+
+# Users looked up by the auth dependency, keyed by id. The TTL is short
+# because user rows can change outside this process; writes to a user in
+# this process call invalidate_user.
+user_cache = LRUCache(
+    maxsize=int(os.getenv("USER_CACHE_MAXSIZE", "1024")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "30")),
+)
+
+
+def invalidate_user(user_id):
+    user_cache.delete(int(user_id))
+
+
+def cached(*tables):
+    # Read-through caching for Storage/AsyncStorage read methods that depend
+    # on `tables`; write methods call storage_cache.invalidate(...). Callers
+    # get their own copy of the value, and a storage holding uncommitted
+    # writes reads past the cache, like `coalesced`.
+    def decorator(method):
+        if not CACHE_ENABLED:
+            return method
+
+        def cache_key(args, kwargs):
+            return (method.__name__, storage_cache.generation(tables), args, tuple(sorted(kwargs.items())))
+
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(self, *args, **kwargs):
+                if getattr(self, "writing", False):
+                    return await method(self, *args, **kwargs)
+                key = cache_key(args, kwargs)
+                hit, value = storage_cache.get(key)
+                if not hit:
+                    value = await method(self, *args, **kwargs)
+                    storage_cache.set(key, value)
+                return copy.deepcopy(value)
+
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if getattr(self, "writing", False):
+                return method(self, *args, **kwargs)
+            key = cache_key(args, kwargs)
+            hit, value = storage_cache.get(key)
+            if not hit:
+                value = method(self, *args, **kwargs)
+                storage_cache.set(key, value)
+            return copy.deepcopy(value)
+
+        return wrapper
+
+    return decorator
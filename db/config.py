@@ -0,0 +1,27 @@
+import os
+
+from dotenv import load_dotenv
+
+# Settings shared by the app and db packages. .env is read once, here, and
+# never overrides the real environment; modules that read settings at import
+# time import this module first so .env applies to them too.
+load_dotenv()
+
+# Set by the Lambda runtime. One container serves one invocation at a time,
+# so it keeps a single database connection across warm invocations.
+LAMBDA = bool(os.getenv("AWS_LAMBDA_FUNCTION_NAME"))
+
+DATABASE_POOL_MIN = int(os.getenv("DATABASE_POOL_MIN", "1"))
+DATABASE_POOL_MAX = int(os.getenv("DATABASE_POOL_MAX", "1" if LAMBDA else "10"))
+DATABASE_POOL_MAX_IDLE = float(os.getenv("DATABASE_POOL_MAX_IDLE", "300"))
+DATABASE_POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", "30"))
+# A connection returned to the pool more recently than this is handed out
+# again without a `SELECT 1` round trip first. That trades safety for
+# latency: a backend dropped within the window surfaces as a failed request.
+# Off by default.
+DATABASE_POOL_CHECK_AFTER = float(os.getenv("DATABASE_POOL_CHECK_AFTER", "0"))
+
+# Register/login password hashing pool (app.utils); admission control sizes
+# the auth route class from it too.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", str(PASSWORD_HASH_WORKERS * 8)))
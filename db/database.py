@@ -1,24 +1,293 @@
+import argparse
+import csv
+import io
 import os
+import threading
+import time
+from itertools import islice
+
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from dotenv import load_dotenv
+from psycopg2 import extensions, pool
+from psycopg2.extras import RealDictCursor, execute_values
+
+from db import config, metrics
+from db.cache import cached, invalidate_user, storage_cache
+from db.prepared import Statement
+from db.read_model import CATALOG_VERSION, Unsupported, get_read_model
+from db.singleflight import coalesced
+
+
+
+BOOK_DOCUMENT = "to_tsvector('english', coalesce(title, '') || ' ' || coalesce(description, ''))"
+
+
+# Sortable columns and the type their cursor values are cast to; price is
+# REAL, so comparing it against a float8 parameter would skip rows.
+SORT_COLUMNS = {"id": "integer", "title": "varchar", "published_year": "integer", "price": "real"}
+
+# book_stats groups: each book counts once per dimension; the catalog
+# dimension has the single key 0.
+STATS_DIMENSIONS = ("catalog", "genre", "author", "year")
+
+# dimension: (name expression, join) for dimensions whose groups have names.
+STATS_NAMES = {
+    "genre": ("genre.name_genre", "LEFT JOIN genre ON genre.id = book_stats.key"),
+    "author": ("author.firstname || ' ' || author.lastname", "LEFT JOIN author ON author.id = book_stats.key"),
+}
+
+BOOK_STATS_DIMENSIONS = """CROSS JOIN LATERAL (VALUES
+    ('catalog', 0), ('genre', {rows}.genre_id), ('author', {rows}.author_id), ('year', {rows}.published_year)
+) dimensions (dimension, key) WHERE dimensions.key IS NOT NULL"""
+
+
+# Advisory lock book_stats_fold holds; rebuild_stats takes it too.
+STATS_FOLD_LOCK = 0x73746174
+
 
-load_dotenv()
+def book_stats_aggregate(rows):
+    return f"""SELECT dimension, key, count(*) AS book_count, count(price) AS priced_count,
+        coalesce(sum(price::numeric), 0) AS price_sum, min(price) AS price_min, max(price) AS price_max
+        FROM {rows} {BOOK_STATS_DIMENSIONS.format(rows=rows)}
+        GROUP BY dimension, key"""
 
 
+# Columns written by /books/export; the same layout books/import reads.
+EXPORT_COLUMNS = "id, title, description, published_year, price, genre_id, author_id"
+
+# Refresh precomputed recommendations from a thread in this process after
+# book writes. Off by default: the queued books are refreshed by a separate
+# `python -m db.recommendations --worker` or a scheduled `--drain`. Never on
+# Lambda, where the thread is frozen between invocations.
+RECOMMENDATIONS_REFRESH = os.getenv("RECOMMENDATIONS_REFRESH", "0") == "1" and not config.LAMBDA
+
+def book_filters(query_set):
+    conditions = []
+    params = []
+
+    if query_set.title is not None:
+        conditions.append("title LIKE %s")
+        params.append(f"%{query_set.title}%")
+
+    if query_set.description is not None:
+        conditions.append("description LIKE %s")
+        params.append(f"%{query_set.description}%")
+
+    if query_set.published_year_start is not None:
+        conditions.append("published_year >= %s")
+        params.append(query_set.published_year_start)
+
+    if query_set.published_year_end is not None:
+        conditions.append("published_year <= %s")
+        params.append(query_set.published_year_end)
+
+    if query_set.author_id is not None:
+        conditions.append("author_id = %s")
+        params.append(query_set.author_id)
+
+    if query_set.genre_id is not None:
+        conditions.append("genre_id = %s")
+        params.append(query_set.genre_id)
+
+    return conditions, params
+
+
+def book_query(query_set, columns="*"):
+    # Keyset pagination: rows are always ordered by (sort column, id), and a
+    # cursor continues strictly after the last (value, id) seen, so any page
+    # costs one index range scan however deep it is.
+    conditions, params = book_filters(query_set)
+    sort_by = query_set.sort_by or "id"
+    direction = "DESC" if query_set.order == "desc" else "ASC"
+
+    if query_set.after is not None:
+        value, last_id = query_set.after
+        operator = "<" if direction == "DESC" else ">"
+        if sort_by == "id":
+            conditions.append(f"id {operator} %s")
+            params.append(last_id)
+        else:
+            conditions.append(f"({sort_by}, id) {operator} (%s::{SORT_COLUMNS[sort_by]}, %s)")
+            params.extend([value, last_id])
+
+    query_sql = f"SELECT {columns} FROM book"
+    if conditions:
+        query_sql = query_sql + " WHERE " + " AND ".join(conditions)
+
+    if sort_by == "id":
+        query_sql = query_sql + f" ORDER BY id {direction}"
+    else:
+        query_sql = query_sql + f" ORDER BY {sort_by} {direction}, id {direction}"
+
+    if query_set.limit is not None:
+        query_sql = query_sql + " LIMIT %s"
+        params.append(query_set.limit)
+
+    if query_set.offset is not None:
+        query_sql = query_sql + " OFFSET %s"
+        params.append(query_set.offset)
+
+    return query_sql, params
+
+
+def book_query_key(query_set):
+    # Query sets that build the same SQL and parameters ask for the same rows.
+    query_sql, params = book_query(query_set)
+    return query_sql, tuple(params)
+
+
+# Point lookups on the hot path, prepared once per connection.
+BOOK_BY_ID = Statement("storage_book_by_id", "SELECT * FROM book WHERE id = $1")
+BOOK_BY_TITLE = Statement("storage_book_by_title", "SELECT * FROM book WHERE title = $1")
+AUTHOR_BY_ID = Statement("storage_author_by_id", "SELECT * FROM author WHERE id = $1")
+GENRE_BY_ID = Statement("storage_genre_by_id", "SELECT * FROM genre WHERE id = $1")
+USER_BY_ID = Statement("storage_user_by_id", "SELECT * FROM users WHERE id = $1")
+BOOK_REFERENCES = Statement(
+    "storage_book_references",
+    """SELECT EXISTS(SELECT 1 FROM book WHERE title = $1) AS title_exists,
+    EXISTS(SELECT 1 FROM author WHERE id = $2) AS author_exists,
+    EXISTS(SELECT 1 FROM genre WHERE id = $3) AS genre_exists""",
+)
+RECOMMEND_BY_GENRE = Statement(
+    "storage_recommend_by_genre",
+    """SELECT book.* FROM book_rank JOIN book ON book.id = book_rank.book_id
+    WHERE book_rank.genre_id = $1 ORDER BY book_rank.score DESC, book_rank.book_id LIMIT $2""",
+)
+RECOMMEND_BY_AUTHOR = Statement(
+    "storage_recommend_by_author",
+    """SELECT book.* FROM book_rank JOIN book ON book.id = book_rank.book_id
+    WHERE book_rank.author_id = $1 ORDER BY book_rank.score DESC, book_rank.book_id LIMIT $2""",
+)
+SIMILAR_BOOKS = Statement(
+    "storage_similar_books",
+    """SELECT book.*, book_similarity.score AS similarity FROM book_similarity
+    JOIN book ON book.id = book_similarity.similar_book_id
+    WHERE book_similarity.book_id = $1 ORDER BY book_similarity.rank LIMIT $2""",
+)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def get_dsn():
+    return (
+        f"host={os.getenv('DATABASE_HOST')} "
+        f"dbname={os.getenv('DATABASE_NAME')} "
+        f"user={os.getenv('DATABASE_USER')} "
+        f"password={os.getenv('DATABASE_PASSWORD')}"
+    )
+
+
+class ConnectionPool:
+    def __init__(self, dsn, minconn=1, maxconn=10, max_idle=300, timeout=30, check_after=0, connection_factory=None):
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.timeout = timeout
+        self._pool = pool.ThreadedConnectionPool(
+            minconn, maxconn, dsn, cursor_factory=RealDictCursor, connection_factory=connection_factory
+        )
+        # ThreadedConnectionPool raises as soon as it is exhausted, so callers
+        # queue on the semaphore instead and only fail after `timeout`.
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._returned_at = {}
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise pool.PoolError("timed out waiting for a database connection")
+        try:
+            with metrics.checkout():
+                # Idle connections tend to die together (a server restart,
+                # a failover), so each replacement is checked as well; once
+                # the idle ones run out the pool opens fresh connections.
+                attempts = self._pool.maxconn + 1
+                connection = self._pool.getconn()
+                while not self._is_usable(connection):
+                    self._pool.putconn(connection, close=True)
+                    attempts -= 1
+                    if not attempts:
+                        raise pool.PoolError("no usable database connection")
+                    connection = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        return connection
+
+    def putconn(self, connection):
+        try:
+            if not connection.closed:
+                if connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                self._returned_at[id(connection)] = time.monotonic()
+            self._pool.putconn(connection, close=bool(connection.closed))
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+        self._returned_at.clear()
+
+    def _is_usable(self, connection):
+        if connection.closed:
+            return False
+        returned_at = self._returned_at.pop(id(connection), None)
+        if returned_at is not None:
+            idle = time.monotonic() - returned_at
+            if idle > self.max_idle:
+                return False
+            # Back-to-back requests (warm Lambda invocations, busy servers)
+            # reuse a connection that was healthy a moment ago as is. This
+            # trades safety for latency, so check_after defaults to 0.
+            if idle < self.check_after:
+                return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    # Module level so the pool outlives a single request and, on Lambda,
+    # is reused by every warm invocation of the same container.
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    get_dsn(),
+                    minconn=config.DATABASE_POOL_MIN,
+                    maxconn=config.DATABASE_POOL_MAX,
+                    max_idle=config.DATABASE_POOL_MAX_IDLE,
+                    timeout=config.DATABASE_POOL_TIMEOUT,
+                    check_after=config.DATABASE_POOL_CHECK_AFTER,
+                    connection_factory=metrics.TracingConnection,
+                )
+    return _pool
+
+
+@metrics.instrument
 class Storage:
-    def __init__(self, dsn=None, connection=None):
+    def __init__(self, dsn=None, connection=None, pooled=False):
+        self.pool = None
+        self.writing = False
         if connection:
             self.connection = connection
+        elif pooled and dsn is None:
+            self.pool = get_pool()
+            self.connection = self.pool.getconn()
         else:
             self.connection = psycopg2.connect(
-                dsn or (
-                    f"host={os.getenv('DATABASE_HOST')} "
-                    f"dbname={os.getenv('DATABASE_NAME')} "
-                    f"user={os.getenv('DATABASE_USER')} "
-                    f"password={os.getenv('DATABASE_PASSWORD')}"
-                ),
+                dsn or get_dsn(),
                 cursor_factory=RealDictCursor,
+                connection_factory=metrics.TracingConnection,
             )
 
     def __enter__(self):
@@ -29,52 +298,40 @@ class Storage:
             self.connection.commit()
         else:
             self.connection.rollback()
-        self.connection.close()
+        self.close()
 
     def close(self):
-        self.connection.close()
+        if self.pool is not None:
+            self.pool.putconn(self.connection)
+            self.pool = None
+        else:
+            self.connection.close()
+
+    def _read_model(self, *tables):
+        # The in-process read model when it is enabled and current for
+        # `tables`. Never while this connection holds uncommitted writes:
+        # copy_books validates each batch against the batches before it.
+        if self.writing:
+            return None
+        model = get_read_model(get_dsn())
+        if model is not None and model.fresh(*tables):
+            return model
+        return None
 
     def drop_database(self):
         with self.connection.cursor() as cursor:
             cursor.execute("DROP TABLE IF EXISTS author CASCADE")
             cursor.execute("DROP TABLE IF EXISTS genre CASCADE")
             cursor.execute("DROP TABLE IF EXISTS book CASCADE")
+            cursor.execute("DROP TABLE IF EXISTS book_catalog_changes")
+            cursor.execute("DROP TABLE IF EXISTS book_similarity")
+            cursor.execute("DROP TABLE IF EXISTS book_rank")
+            cursor.execute("DROP TABLE IF EXISTS book_recommendation_queue")
+            cursor.execute("DROP TABLE IF EXISTS book_stats CASCADE")
+            cursor.execute("DROP TABLE IF EXISTS book_stats_delta")
+            cursor.execute("DROP TABLE IF EXISTS alembic_version")
             self.connection.commit()
-
-    def create_tables_if_not_exist(self):
-        with self.connection.cursor() as cursor:
-            cursor.execute("""CREATE TABLE IF NOT EXISTS author (
-                Id SERIAL PRIMARY KEY,
-                firstname VARCHAR(255),
-                lastname VARCHAR(255),
-                UNIQUE(firstname, lastname)
-            );""")
-
-            cursor.execute("""CREATE TABLE IF NOT EXISTS genre (
-                Id SERIAL PRIMARY KEY,
-                name_genre VARCHAR(255) UNIQUE
-            );""")
-
-            cursor.execute("""CREATE TABLE IF NOT EXISTS book (
-            Id SERIAL PRIMARY KEY,
-            title VARCHAR(255) UNIQUE,
-            description TEXT,
-            published_year INTEGER,
-            price REAL,
-            genre_id INTEGER,
-            author_id INTEGER,
-            FOREIGN KEY(author_id) REFERENCES author(id),
-            FOREIGN KEY(genre_id) REFERENCES genre(id)
-            );""")
-
-            cursor.execute("""CREATE TABLE IF NOT EXISTS users (
-                Id SERIAL PRIMARY KEY,
-                email VARCHAR(255) UNIQUE,
-                password VARCHAR(255)
-            );""")
-
-            print('successfully created tables')
-            self.connection.commit()
+        storage_cache.clear()
 
     def insert_book(self, book):
         with self.connection.cursor() as cursor:
@@ -91,29 +348,67 @@ class Storage:
             )
             book = cursor.fetchone()
         self.connection.commit()
+        storage_cache.invalidate("book")
+        schedule_recommendations()
         return book
 
-    def insert_book_in_bulk(self, book):
-        with self.connection.cursor() as cursor:
-            cursor.execute(
-                """INSERT INTO book (title, description, published_year, price, genre_id, author_id) VALUES (%s, %s, %s, %s, %s, %s)""",
-                (
-                    f"{book[0]}",
-                    f"{book[1]}",
-                    f"{book[2]}",
-                    f"{book[3]}",
-                    f"{book[4]}",
-                    f"{book[5]}",
-                ),
-            )
-        self.connection.commit()
-
+    def copy_books(self, books, batch_size=5000, commit_each_batch=False):
+        # Streams (title, description, published_year, price, genre_id, author_id)
+        # tuples through COPY. By default everything lands in one transaction;
+        # commit_each_batch keeps the batches that loaded before a failure.
+        count = 0
+        self.writing = True
+        try:
+            with self.connection.cursor() as cursor:
+                for batch in batched(books, batch_size):
+                    buffer = io.StringIO()
+                    csv.writer(buffer).writerows(batch)
+                    buffer.seek(0)
+                    cursor.copy_expert(
+                        """COPY book (title, description, published_year, price, genre_id, author_id) FROM STDIN WITH (FORMAT csv)""",
+                        buffer,
+                    )
+                    count += len(batch)
+                    if commit_each_batch:
+                        self.connection.commit()
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            self.writing = False
+            storage_cache.invalidate("book")
+            schedule_recommendations()
+        return count
+
+    @cached("book")
     def retrieve_book_for_title(self, title):
+        model = self._read_model("book")
+        if model is not None:
+            return model.retrieve_book_for_title(title)
         with self.connection.cursor() as cursor:
-            cursor.execute("""SELECT * FROM book WHERE title = %s""", (title,))
+            BOOK_BY_TITLE.execute(cursor, (title,))
             book = cursor.fetchone()
         return book
 
+    def check_book_references(self, title, author_id, genre_id):
+        model = self._read_model("book", "author", "genre")
+        if model is not None:
+            return model.check_book_references(title, author_id, genre_id)
+        with self.connection.cursor() as cursor:
+            BOOK_REFERENCES.execute(cursor, (title, author_id, genre_id))
+            result = cursor.fetchone()
+        return result
+
+    def retrieve_existing_titles(self, titles):
+        model = self._read_model("book")
+        if model is not None:
+            return model.retrieve_existing_titles(titles)
+        with self.connection.cursor() as cursor:
+            cursor.execute("""SELECT title FROM book WHERE title = ANY(%s)""", (list(titles),))
+            results = cursor.fetchall()
+        return {row["title"] for row in results}
+
     def create_user(self, user):
         with self.connection.cursor() as cursor:
             cursor.execute("""INSERT INTO users (email, password) VALUES (%s, %s) RETURNING email""", (user.email, user.password))
@@ -123,106 +418,250 @@ class Storage:
 
     def retrieve_user_by_id(self, id):
         with self.connection.cursor() as cursor:
-            cursor.execute("""SELECT * FROM users WHERE id = %s""", (str(id),))
+            USER_BY_ID.execute(cursor, (str(id),))
             user = cursor.fetchone()
         return user
 
     def retrieve_user_by_email(self, email):
         with self.connection.cursor() as cursor:
-            cursor.execute("""SELECT * FROM users WHERE email LIKE %s""", (f'{email}',))
+            cursor.execute("""SELECT * FROM users WHERE email = %s""", (f'{email}',))
             user = cursor.fetchone()
         return user
 
-    def insert_many_books(self, books):
+    def update_user_password(self, user_id, password):
         with self.connection.cursor() as cursor:
-            cursor.executemany(
+            cursor.execute("""UPDATE users SET password = %s WHERE id = %s""", (password, user_id))
+        self.connection.commit()
+        invalidate_user(user_id)
+
+    def insert_many_books(self, books, page_size=1000):
+        with self.connection.cursor() as cursor:
+            result = execute_values(
+                cursor,
                 """
                 INSERT INTO book (title, description, published_year, price, genre_id, author_id)
-                VALUES (%s, %s, %s, %s, %s, %s) RETURNING *;
+                VALUES %s RETURNING *;
                 """,
-                books
+                books,
+                page_size=page_size,
+                fetch=True,
             )
-            result = cursor.fetchall()
         self.connection.commit()
+        storage_cache.invalidate("book")
+        schedule_recommendations()
+        return result
+
+    def upsert_books(self, books, page_size=1000):
+        # (title, description, published_year, price, genre_id, author_id)
+        # tuples with distinct titles; a title already in the catalog is
+        # updated in place. One statement per page, all in one transaction.
+        # Rows that would not change are skipped, so their versions (and
+        # ETags) stay put; only inserted and updated rows are returned, each
+        # flagged by `inserted`.
+        with self.connection.cursor() as cursor:
+            result = execute_values(
+                cursor,
+                """
+                INSERT INTO book (title, description, published_year, price, genre_id, author_id)
+                VALUES %s
+                ON CONFLICT (title) DO UPDATE SET
+                    description = EXCLUDED.description,
+                    published_year = EXCLUDED.published_year,
+                    price = EXCLUDED.price,
+                    genre_id = EXCLUDED.genre_id,
+                    author_id = EXCLUDED.author_id
+                WHERE (book.description, book.published_year, book.price, book.genre_id, book.author_id)
+                    IS DISTINCT FROM (EXCLUDED.description, EXCLUDED.published_year, EXCLUDED.price, EXCLUDED.genre_id, EXCLUDED.author_id)
+                RETURNING *, xmax = 0 AS inserted;
+                """,
+                books,
+                page_size=page_size,
+                fetch=True,
+            )
+        if result:
+            self.connection.commit()
+        storage_cache.invalidate("book")
+        schedule_recommendations()
         return result
 
+    @cached("book", "book_rank")
+    @coalesced("book", "book_rank")
     def recommend_books_by_genre(self, genre_id, limit=5):
+        model = self._read_model("book", "book_rank")
+        if model is not None:
+            return model.recommend_books("genre_id", genre_id, limit)
         with self.connection.cursor() as cursor:
-            cursor.execute("""SELECT * FROM book WHERE genre_id = %s LIMIT %s""", (genre_id, limit))
+            RECOMMEND_BY_GENRE.execute(cursor, (genre_id, limit))
             recommendations = cursor.fetchall()
         return recommendations
 
+    @cached("book", "book_rank")
+    @coalesced("book", "book_rank")
     def recommend_books_by_author(self, author_id, limit=5):
+        model = self._read_model("book", "book_rank")
+        if model is not None:
+            return model.recommend_books("author_id", author_id, limit)
         with self.connection.cursor() as cursor:
-            cursor.execute("""SELECT * FROM book WHERE author_id = %s LIMIT %s""", (author_id, limit))
+            RECOMMEND_BY_AUTHOR.execute(cursor, (author_id, limit))
             recommendations = cursor.fetchall()
         return recommendations
 
-    def retrieve_books(self, query_set):
+    @cached("book", "book_rank")
+    def similar_books(self, book_id, limit=5):
         with self.connection.cursor() as cursor:
-            conditions = []
-            params = []
-            query_sql = """SELECT * FROM book"""
-
-            if query_set.title is not None:
-                conditions.append("title LIKE %s")
-                params.append(f"%{query_set.title}%")
-
-            if query_set.description is not None:
-                conditions.append("description LIKE %s")
-                params.append(f"%{query_set.description}%")
-
-            if query_set.published_year_start is not None:
-                conditions.append("published_year >= %s")
-                params.append(query_set.published_year_start)
-
-            if query_set.published_year_end is not None:
-                conditions.append("published_year <= %s")
-                params.append(query_set.published_year_end)
-
-            if query_set.author_id is not None:
-                conditions.append("author_id = %s")
-                params.append(query_set.author_id)
-
-            if query_set.genre_id is not None:
-                conditions.append("genre_id = %s")
-                params.append(query_set.genre_id)
+            SIMILAR_BOOKS.execute(cursor, (book_id, limit))
+            results = cursor.fetchall()
+        return results
 
-            if conditions:
-                query_sql = query_sql + " WHERE " + " AND ".join(conditions)
+    def retrieve_catalog_version(self):
+        model = self._read_model("book")
+        if model is not None:
+            return model.retrieve_catalog_version()
+        with self.connection.cursor() as cursor:
+            cursor.execute(CATALOG_VERSION)
+            result = cursor.fetchone()
+        return result
 
-            if query_set.sort_by is not None:
-                query_sql = query_sql + " ORDER BY " + query_set.sort_by
+    @coalesced("book", key=book_query_key)
+    def retrieve_books(self, query_set):
+        model = self._read_model("book")
+        if model is not None:
+            try:
+                return model.retrieve_books(query_set)
+            except Unsupported:
+                pass
+        query_sql, params = book_query(query_set)
+        with self.connection.cursor() as cursor:
+            cursor.execute(query_sql, params)
+            results = cursor.fetchall()
+        return results
 
-            if query_set.limit is not None:
-                query_sql = query_sql + " LIMIT " + str(query_set.limit)
+    def stream_books(self, query_set, batch_size=1000, columns="*"):
+        # Named (server-side) cursor: rows cross the wire batch_size at a
+        # time, so memory stays flat however many rows match.
+        query_sql, params = book_query(query_set, columns)
+        with self.connection.cursor(name="stream_books", cursor_factory=RealDictCursor) as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(query_sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+    def export_books_csv(self, query_set, fileobj):
+        # COPY has no bind parameters, so the query is rendered client-side
+        # with the same escaping execute() uses.
+        query_sql, params = book_query(query_set, EXPORT_COLUMNS)
+        with self.connection.cursor() as cursor:
+            query_sql = cursor.mogrify(query_sql, params).decode()
+            cursor.copy_expert(f"COPY ({query_sql}) TO STDOUT WITH (FORMAT csv, HEADER)", fileobj)
 
-            if query_set.offset is not None:
-                query_sql = query_sql + " OFFSET " + str(query_set.offset)
+    def search_books(self, term, limit=20, offset=0):
+        # Ranked by full-text relevance plus title similarity, so typos and
+        # partial words still match through the trigram index.
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"""SELECT book.*, ts_rank({BOOK_DOCUMENT}, query) + similarity(title, %(term)s) AS score
+                FROM book, websearch_to_tsquery('english', %(term)s) query
+                WHERE {BOOK_DOCUMENT} @@ query
+                OR title %% %(term)s
+                OR title ILIKE %(pattern)s
+                ORDER BY score DESC, id
+                LIMIT %(limit)s OFFSET %(offset)s""",
+                {"term": term, "pattern": f"%{term}%", "limit": limit, "offset": offset},
+            )
+            results = cursor.fetchall()
+        return results
 
-            cursor.execute(query_sql, params)
+    @cached("book", "author", "genre")
+    def retrieve_stats(self, dimension):
+        # O(groups): served from book_stats, never from book, and joined only
+        # to the table naming this dimension's groups. book_stats_read folds
+        # the pending deltas in first, except inside a write.
+        name, join = STATS_NAMES.get(dimension, ("NULL::text", ""))
+        fold = not getattr(self, "writing", False)
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"""SELECT book_stats.key, {name} AS name,
+                book_stats.book_count,
+                round(book_stats.price_sum / nullif(book_stats.priced_count, 0), 2)::float AS price_avg,
+                book_stats.price_min, book_stats.price_max
+                FROM book_stats_read(%s, %s) book_stats {join}
+                ORDER BY book_stats.key""",
+                (dimension, fold),
+            )
             results = cursor.fetchall()
+        if fold:
+            self.connection.commit()
         return results
 
+    def rebuild_stats(self):
+        # Recomputes book_stats from scratch; the triggers keep it current
+        # from then on.
+        with self.connection.cursor() as cursor:
+            cursor.execute("""SELECT pg_advisory_xact_lock(%s)""", (STATS_FOLD_LOCK,))
+            cursor.execute("""DELETE FROM book_stats_delta""")
+            cursor.execute("""DELETE FROM book_stats""")
+            cursor.execute(f"""INSERT INTO book_stats {book_stats_aggregate("book")}""")
+        self.connection.commit()
+        storage_cache.invalidate("book")
+
+    @cached("book")
+    @coalesced("book")
     def retrieve_book_by_id(self, book_id):
+        model = self._read_model("book")
+        if model is not None:
+            return model.retrieve_book_by_id(book_id)
         with self.connection.cursor() as cursor:
-            cursor.execute("""SELECT * FROM book WHERE id = %s""", (str(book_id),))
+            BOOK_BY_ID.execute(cursor, (str(book_id),))
             book = cursor.fetchone()
         return book
 
+    def retrieve_books_by_ids(self, book_ids):
+        # One `= ANY` query for the batch, in the order of `book_ids`;
+        # unknown ids are left out.
+        model = self._read_model("book")
+        if model is not None:
+            return model.retrieve_books_by_ids(book_ids)
+        with self.connection.cursor() as cursor:
+            cursor.execute("""SELECT * FROM book WHERE id = ANY(%s)""", (list(book_ids),))
+            books = {row["id"]: row for row in cursor.fetchall()}
+        return [books[book_id] for book_id in dict.fromkeys(book_ids) if book_id in books]
+
+    @cached("author")
     def retrieve_authors(self):
+        model = self._read_model("author")
+        if model is not None:
+            return model.retrieve_authors()
         with self.connection.cursor() as cursor:
             cursor.execute("""SELECT * FROM author""")
             results = cursor.fetchall()
         return results
 
+    @cached("author")
     def retrieve_author_by_id(self, author_id):
+        model = self._read_model("author")
+        if model is not None:
+            return model.retrieve_author_by_id(author_id)
         with self.connection.cursor() as cursor:
-            cursor.execute("""SELECT * FROM author WHERE id = %s""", (str(author_id),))
+            AUTHOR_BY_ID.execute(cursor, (str(author_id),))
             results = cursor.fetchone()
         return results
 
+    def retrieve_existing_author_ids(self, author_ids):
+        model = self._read_model("author")
+        if model is not None:
+            return model.retrieve_existing_author_ids(author_ids)
+        with self.connection.cursor() as cursor:
+            cursor.execute("""SELECT id FROM author WHERE id = ANY(%s)""", (list(author_ids),))
+            results = cursor.fetchall()
+        return {row["id"] for row in results}
+
     def retrieve_author_for_firstname_and_lastname(self, firstname, lastname):
+        model = self._read_model("author")
+        if model is not None:
+            return model.retrieve_author_for_firstname_and_lastname(firstname, lastname)
         with self.connection.cursor() as cursor:
             cursor.execute(
                 """SELECT * FROM author WHERE firstname = %s AND lastname = %s""",
@@ -231,13 +670,29 @@ class Storage:
             results = cursor.fetchone()
         return results
 
+    @cached("genre")
     def retrieve_genre(self, genre_id):
+        model = self._read_model("genre")
+        if model is not None:
+            return model.retrieve_genre(genre_id)
         with self.connection.cursor() as cursor:
-            cursor.execute("""SELECT * FROM genre WHERE id = %s""", (str(genre_id),))
+            GENRE_BY_ID.execute(cursor, (str(genre_id),))
             results = cursor.fetchone()
         return results
 
+    def retrieve_existing_genre_ids(self, genre_ids):
+        model = self._read_model("genre")
+        if model is not None:
+            return model.retrieve_existing_genre_ids(genre_ids)
+        with self.connection.cursor() as cursor:
+            cursor.execute("""SELECT id FROM genre WHERE id = ANY(%s)""", (list(genre_ids),))
+            results = cursor.fetchall()
+        return {row["id"] for row in results}
+
     def retrieve_genre_by_title(self, genre_name):
+        model = self._read_model("genre")
+        if model is not None:
+            return model.retrieve_genre_by_title(genre_name)
         with self.connection.cursor() as cursor:
             cursor.execute(
                 """SELECT * FROM genre WHERE name_genre = %s""", (genre_name,)
@@ -253,6 +708,7 @@ class Storage:
             )
             cursor.fetchone()
         self.connection.commit()
+        storage_cache.invalidate("author")
         return author
 
     def insert_genres(self, genre):
@@ -263,6 +719,7 @@ class Storage:
             )
             cursor.fetchone()
         self.connection.commit()
+        storage_cache.invalidate("genre")
         return genre
 
     def delete_book(self, book_id):
@@ -272,15 +729,32 @@ class Storage:
             )
             deleted_book = cursor.fetchone()
         self.connection.commit()
+        storage_cache.invalidate("book")
+        if deleted_book:
+            schedule_recommendations()
         return deleted_book
 
+    def delete_books(self, book_ids):
+        # Returns the (sorted) ids that existed and were deleted.
+        with self.connection.cursor() as cursor:
+            cursor.execute("""DELETE FROM book WHERE id = ANY(%s) RETURNING id""", (list(book_ids),))
+            deleted = sorted(row["id"] for row in cursor.fetchall())
+        self.connection.commit()
+        storage_cache.invalidate("book")
+        if deleted:
+            schedule_recommendations()
+        return deleted
+
     def update_book(self, book_id, book):
         with self.connection.cursor() as cursor:
             cursor.execute(
-                """UPDATE book SET title = %s, published_year = %s, genre_id = %s, author_id = %s WHERE id = %s RETURNING *""",
+                """UPDATE book SET title = %s, description = %s, published_year = %s, price = %s, genre_id = %s, author_id = %s
+                WHERE id = %s RETURNING *""",
                 (
                     book.title,
+                    book.description,
                     book.published_year,
+                    book.price,
                     book.genre_id,
                     book.author_id,
                     str(book_id),
@@ -288,16 +762,39 @@ class Storage:
             )
             book_updated = cursor.fetchone()
         self.connection.commit()
+        storage_cache.invalidate("book")
+        if book_updated:
+            schedule_recommendations()
         return book_updated
 
+def schedule_recommendations():
+    # After a committed book write: the trigger queued the changed books,
+    # the in-process refresher (when enabled) recomputes them.
+    if RECOMMENDATIONS_REFRESH:
+        from db import recommendations
+
+        recommendations.get_refresher(get_dsn()).wake()
+
+
 def get_db():
-    db = Storage()
+    db = Storage(pooled=True)
     try:
         yield db
     finally:
         db.close()
 
+def upgrade_schema(dsn=None):
+    # The Alembic migrations are the only definition of the schema; tests,
+    # benchmarks and local setups build it through them as well.
+    from alembic import command
+    from alembic.config import Config
+
+    alembic_config = Config(os.path.join(os.path.dirname(__file__), "..", "alembic.ini"))
+    if dsn is not None:
+        # Read by migrations/env.py, as `alembic -x dsn=...` would pass it.
+        alembic_config.cmd_opts = argparse.Namespace(x=[f"dsn={dsn}"])
+    command.upgrade(alembic_config, "head")
+
+
 if __name__ == "__main__":
-    db = Storage()
-    db.drop_database()
-    db.create_tables_if_not_exist()
+    upgrade_schema()
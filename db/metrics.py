@@ -0,0 +1,321 @@
+import contextlib
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from psycopg2 import extensions
+
+from db import config  # noqa: F401 - loads .env before the settings below are read
+
+# In-process metrics in the Prometheus text format, plus per-request DB
+# tracing. Everything is plain counters under a lock, cheap enough to leave on.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# Statements slower than this are logged with their SQL (0 disables).
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(__name__)
+
+registry = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in sorted(self._values.items())]
+
+    def label_names(self, sample_name):
+        return self.labels
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        # Per-bucket (not cumulative) counts, then sum and count.
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [0] * (len(self.buckets) + 3)
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = sorted((labels, list(entry)) for labels, entry in self._values.items())
+        for labels, entry in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), entry):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append((f"{self.name}_bucket", labels + (le,), cumulative))
+            samples.append((f"{self.name}_sum", labels, entry[-2]))
+            samples.append((f"{self.name}_count", labels, entry[-1]))
+        return samples
+
+    def label_names(self, sample_name):
+        return self.labels + ("le",) if sample_name.endswith("_bucket") else self.labels
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            if labels:
+                pairs = ",".join(f'{label}="{_escape(text)}"' for label, text in zip(metric.label_names(name), labels))
+                name = f"{name}{{{pairs}}}"
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+db_queries = Counter("db_queries_total", "Statements sent to Postgres.")
+db_query_seconds = Histogram("db_query_duration_seconds", "Statement latency.")
+db_slow_queries = Counter("db_slow_queries_total", "Statements slower than SLOW_QUERY_MS.")
+db_connections = Counter("db_connections_opened_total", "Physical connections opened.")
+db_checkouts = Counter("db_pool_checkouts_total", "Connections checked out of the pool.")
+storage_seconds = Histogram("storage_method_duration_seconds", "Storage method latency.", ("method",))
+storage_queries = Counter("storage_method_queries_total", "Statements issued by Storage methods, nested calls included.", ("method",))
+storage_rows = Counter("storage_method_rows_total", "Rows returned by Storage methods.", ("method",))
+storage_errors = Counter("storage_method_errors_total", "Storage methods that raised.", ("method",))
+
+
+class RequestTrace:
+    # DB work attributed to one request: statements and connections (opened
+    # or checked out of the pool), whichever thread they ran on.
+    __slots__ = ("queries", "connections", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.connections = 0
+        self.db_seconds = 0.0
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class RoundTrips:
+    # Statements, server-side cursor fetches and commits sent to Postgres by
+    # TracingConnection, across all threads (the benchmarks read this).
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, n=1):
+        with self._lock:
+            self.count += n
+
+
+round_trips = RoundTrips()
+
+_local = threading.local()
+
+
+def _record(started, statements, sql):
+    elapsed = time.perf_counter() - started
+    round_trips.add(statements)
+    _local.queries = getattr(_local, "queries", 0) + statements
+    trace = current_trace.get()
+    if trace is not None:
+        trace.queries += statements
+        trace.db_seconds += elapsed
+    if METRICS_ENABLED:
+        db_queries.inc(amount=statements)
+        db_query_seconds.observe(elapsed)
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            db_slow_queries.inc()
+            if isinstance(sql, bytes):
+                sql = sql.decode(errors="replace")
+            logger.warning("slow query (%.1f ms): %s", elapsed * 1000, " ".join(str(sql).split())[:500])
+
+
+def count_connection(checkout=False):
+    # A connection the pool opens while handing it out counts once for the
+    # request, as the checkout.
+    trace = current_trace.get()
+    if trace is not None and (checkout or not getattr(_local, "checking_out", False)):
+        trace.connections += 1
+    if METRICS_ENABLED:
+        (db_checkouts if checkout else db_connections).inc()
+
+
+@contextlib.contextmanager
+def checkout():
+    _local.checking_out = True
+    try:
+        yield
+    finally:
+        _local.checking_out = False
+    count_connection(checkout=True)
+
+
+_tracing_cursors = {}
+
+
+def tracing_cursor(factory):
+    if factory not in _tracing_cursors:
+        def execute(self, query, vars=None):
+            started = time.perf_counter()
+            try:
+                return factory.execute(self, query, vars)
+            finally:
+                _record(started, 1, query)
+
+        def executemany(self, query, vars_list):
+            vars_list = list(vars_list)
+            started = time.perf_counter()
+            try:
+                return factory.executemany(self, query, vars_list)
+            finally:
+                _record(started, len(vars_list), query)
+
+        def copy_expert(self, sql, file, size=8192):
+            started = time.perf_counter()
+            try:
+                return factory.copy_expert(self, sql, file, size)
+            finally:
+                _record(started, 1, sql)
+
+        def fetchmany(self, size=None):
+            if not self.name:
+                return factory.fetchmany(self, size) if size is not None else factory.fetchmany(self)
+            started = time.perf_counter()
+            try:
+                return factory.fetchmany(self, size) if size is not None else factory.fetchmany(self)
+            finally:
+                _record(started, 1, self.query)
+
+        _tracing_cursors[factory] = type(
+            f"Tracing{factory.__name__}",
+            (factory,),
+            {"execute": execute, "executemany": executemany, "copy_expert": copy_expert, "fetchmany": fetchmany},
+        )
+    return _tracing_cursors[factory]
+
+
+class TracingConnection(extensions.connection):
+    # Wraps whatever cursor class a caller asks for, so named cursors and
+    # explicit cursor_factory= arguments are traced too. Commits and
+    # rollbacks count as round trips but not as queries.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        count_connection()
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.pop("cursor_factory", None) or self.cursor_factory or extensions.cursor
+        return super().cursor(*args, cursor_factory=tracing_cursor(factory), **kwargs)
+
+    def commit(self):
+        if self.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            round_trips.add()
+        return super().commit()
+
+    def rollback(self):
+        if self.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            round_trips.add()
+        return super().rollback()
+
+
+def _row_count(result):
+    if result is None or isinstance(result, (bool, int, float, str)):
+        return 0
+    if isinstance(result, (list, tuple, set)):
+        return len(result)
+    return 1
+
+
+def instrument(cls):
+    # Times every public method of a storage class and counts the statements
+    # (on TracingConnection) and rows behind it. Generators are left alone:
+    # their work happens after the call returns.
+    if not METRICS_ENABLED:
+        return cls
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.isfunction(method) or inspect.isgeneratorfunction(method):
+            continue
+        setattr(cls, name, _instrumented(name, method))
+    return cls
+
+
+def _instrumented(name, method):
+    labels = (name,)
+
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = await method(*args, **kwargs)
+            except Exception:
+                storage_errors.inc(labels)
+                raise
+            finally:
+                storage_seconds.observe(time.perf_counter() - started, labels)
+            storage_rows.inc(labels, _row_count(result))
+            return result
+
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        queries = getattr(_local, "queries", 0)
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            storage_errors.inc(labels)
+            raise
+        finally:
+            storage_seconds.observe(time.perf_counter() - started, labels)
+            storage_queries.inc(labels, getattr(_local, "queries", 0) - queries)
+        storage_rows.inc(labels, _row_count(result))
+        return result
+
+    return wrapper
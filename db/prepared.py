@@ -0,0 +1,79 @@
+import os
+import re
+import weakref
+
+from psycopg2 import errors, extensions
+
+from db import config  # noqa: F401 - loads .env before the settings below are read
+
+# Hot point lookups run as server-side prepared statements, so Postgres parses
+# and plans them once per connection instead of on every call. Off for
+# poolers in transaction mode (PgBouncer and the like), where consecutive
+# transactions may land on different server connections.
+PREPARED_STATEMENTS = os.getenv("PREPARED_STATEMENTS", "1") == "1"
+
+# connection -> (backend pid, statements prepared on it). The pid catches a
+# connection object that has been reconnected under us.
+_prepared = weakref.WeakKeyDictionary()
+
+
+class Statement:
+    # `sql` uses $1, $2, ... placeholders, as PREPARE does.
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.params = len(set(re.findall(r"\$(\d+)", sql)))
+        # The same query for psycopg2's client-side binding, used when
+        # prepared statements are disabled.
+        self.plain_sql = re.sub(r"\$(\d+)", r"%(p\1)s", sql)
+        self.execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * self.params)})" if self.params else f"EXECUTE {name}"
+
+    def execute(self, cursor, params=()):
+        if not PREPARED_STATEMENTS:
+            cursor.execute(self.plain_sql, {f"p{i}": value for i, value in enumerate(params, 1)})
+            return
+        connection = cursor.connection
+        statements = _statements(connection)
+        if statements.get(self.name):
+            # Whether this call opens the transaction, so nothing else is
+            # lost when a failure is rolled back.
+            opens_transaction = connection.info.transaction_status == extensions.TRANSACTION_STATUS_IDLE
+            try:
+                cursor.execute(self.execute_sql, params)
+                return
+            except errors.InvalidSqlStatementName:
+                # Gone from the server: DISCARD ALL, or a pooler that switched
+                # server connections.
+                del statements[self.name]
+                if not opens_transaction:
+                    raise
+            except errors.FeatureNotSupported as e:
+                # A schema change altered the statement's result columns; it
+                # still exists but has to be prepared again.
+                if "cached plan must not change result type" not in str(e):
+                    raise
+                statements[self.name] = False
+                if not opens_transaction:
+                    raise
+            connection.rollback()
+        if self.name in statements and statements[self.name] is None:
+            # An earlier PREPARE failed or was followed by a failed EXECUTE;
+            # PREPARE is not undone by a rollback, so look it up.
+            cursor.execute("""SELECT name FROM pg_prepared_statements WHERE name = %s""", (self.name,))
+            if cursor.fetchone() is None:
+                del statements[self.name]
+        # Prepared (again) and executed in one round trip.
+        deallocate = f"DEALLOCATE {self.name}; " if self.name in statements else ""
+        statements[self.name] = None
+        cursor.execute(f"{deallocate}PREPARE {self.name} AS {self.sql}; {self.execute_sql}", params)
+        statements[self.name] = True
+
+
+def _statements(connection):
+    # {name: state} for the statements prepared on `connection`: True when
+    # usable, False when stale but still on the server, None when unknown.
+    pid = connection.get_backend_pid()
+    entry = _prepared.get(connection)
+    if entry is None or entry[0] != pid:
+        entry = _prepared[connection] = (pid, {})
+    return entry[1]
@@ -0,0 +1,463 @@
+import heapq
+import json
+import logging
+import os
+import select
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice, takewhile
+
+import psycopg2
+
+from db.cache import storage_cache
+
+# Optional in-process copy of book, author, genre and book_rank. It loads once,
+# then follows catalog_changes notifications; Storage falls back to SQL
+# whenever it is not known to be current.
+READ_MODEL_ENABLED = os.getenv("READ_MODEL_ENABLED", "0") == "1"
+# Upper bound on how stale a write made by another process can be when served
+# from memory; the listener proves its connection alive at twice this rate.
+READ_MODEL_MAX_LAG = float(os.getenv("READ_MODEL_MAX_LAG", "5"))
+# Writes made in this process keep their tables on SQL until the listener has
+# polled this long after the commit, so the notification has arrived.
+READ_MODEL_NOTIFY_SLACK = float(os.getenv("READ_MODEL_NOTIFY_SLACK", "0.05"))
+
+CHANNEL = "catalog_changes"
+
+# Notifying tables and the key column their notifications carry.
+NOTIFY_KEYS = {"book": "id", "author": "id", "genre": "id", "book_rank": "book_id"}
+
+# Writes invalidate storage_cache by table; book writes also change book_rank
+# and book_catalog_changes, which the model tracks under "book".
+DEPENDENT_TABLES = {"book": ("book", "book_rank")}
+
+# The catalog version is the number of book statements committed so far,
+# spread over the few rows of book_catalog_changes.
+CATALOG_VERSION = """SELECT sum(changes)::bigint AS version, max(updated_at) AS updated_at FROM book_catalog_changes"""
+
+ORDERED_COLUMNS = ("id", "title", "published_year", "price")
+
+# Filtered reads sort the matching set only when it is under 1/NARROW_FRACTION
+# of the catalog.
+NARROW_FRACTION = 32
+
+logger = logging.getLogger(__name__)
+
+
+class ReadModel:
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.loaded = False
+        self.synced_at = 0.0
+        self.reloads = 0
+        self.notifications = 0
+        # SQL orders varchar by the database collation; titles are only
+        # sorted in memory when that is byte order.
+        self.byte_order_titles = False
+        self.catalog = None
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_w, False)
+        self._thread = None
+        self.columns = []
+        self._reset_books([])
+        self.scores = {}
+        self.authors = Table()
+        self.genres = Table()
+
+    # Sync
+
+    def start(self):
+        storage_cache.subscribe(self.mark_dirty)
+        self._thread = threading.Thread(target=self.run, name="read-model", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        storage_cache.unsubscribe(self.mark_dirty)
+        self._stopped.set()
+        self._wake()
+        if self._thread is not None:
+            self._thread.join()
+
+    def mark_dirty(self, tables):
+        now = time.monotonic()
+        with self._lock:
+            for table in tables:
+                for dependent in DEPENDENT_TABLES.get(table, (table,)):
+                    self._dirty[dependent] = now
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"x")
+        except BlockingIOError:
+            pass
+
+    def fresh(self, *tables):
+        if not self.loaded or time.monotonic() - self.synced_at > READ_MODEL_MAX_LAG:
+            return False
+        with self._lock:
+            return not any(table in self._dirty for table in tables)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                connection = psycopg2.connect(self.dsn)
+                try:
+                    connection.autocommit = True
+                    self.listen(connection)
+                finally:
+                    connection.close()
+            except psycopg2.Error:
+                logger.exception("read model listener failed, serving from SQL")
+                self.synced_at = 0.0
+                self._stopped.wait(1)
+
+    def listen(self, connection):
+        with connection.cursor() as cursor:
+            # LISTEN before loading, so nothing committed during the load is
+            # missed; applying a change twice is harmless.
+            cursor.execute(f"LISTEN {CHANNEL}")
+            self.reload(cursor, NOTIFY_KEYS)
+            self.loaded = True
+            while not self._stopped.is_set():
+                started = time.monotonic()
+                ready, _, _ = select.select([connection, self._wake_r], [], [], self._timeout(started))
+                if self._wake_r in ready:
+                    os.read(self._wake_r, 4096)
+                if not ready:
+                    # Heartbeat: proves the connection alive while idle.
+                    cursor.execute("SELECT 1")
+                connection.poll()
+
+                changes = {}
+                while connection.notifies:
+                    payload = json.loads(connection.notifies.pop(0).payload)
+                    self.notifications += 1
+                    table, ids = payload["table"], payload["ids"]
+                    if ids is None or changes.get(table, set()) is None:
+                        changes[table] = None
+                    else:
+                        changes.setdefault(table, set()).update(ids)
+
+                reload = [table for table, ids in changes.items() if ids is None or table in ("author", "genre")]
+                if reload:
+                    self.reload(cursor, reload)
+                if changes.get("book"):
+                    self.refresh_books(cursor, changes["book"])
+                if changes.get("book_rank"):
+                    self.refresh_scores(cursor, changes["book_rank"])
+
+                self.synced_at = started
+                with self._lock:
+                    for table, marked in list(self._dirty.items()):
+                        if marked + READ_MODEL_NOTIFY_SLACK <= started:
+                            del self._dirty[table]
+
+    def _timeout(self, now):
+        timeout = READ_MODEL_MAX_LAG / 2
+        with self._lock:
+            for marked in self._dirty.values():
+                timeout = min(timeout, max(0.0, marked + READ_MODEL_NOTIFY_SLACK - now))
+        return timeout
+
+    def reload(self, cursor, tables):
+        self.reloads += 1
+        if "book" in tables:
+            cursor.execute("""SELECT datcollate FROM pg_database WHERE datname = current_database()""")
+            self.byte_order_titles = cursor.fetchone()[0] in ("C", "POSIX")
+            cursor.execute("""SELECT * FROM book""")
+            columns = [column.name for column in cursor.description]
+            rows = cursor.fetchall()
+            catalog = self._fetch_catalog(cursor)
+            with self._lock:
+                self.columns = columns
+                self._reset_books(rows)
+                self.catalog = catalog
+        if "book_rank" in tables:
+            cursor.execute("""SELECT book_id, score FROM book_rank""")
+            scores = dict(cursor.fetchall())
+            with self._lock:
+                self.scores = scores
+        for table in ("author", "genre"):
+            if table in tables:
+                cursor.execute(f"""SELECT * FROM {table}""")
+                loaded = Table([column.name for column in cursor.description], cursor.fetchall())
+                with self._lock:
+                    setattr(self, f"{table}s", loaded)
+
+    def refresh_books(self, cursor, ids):
+        cursor.execute("""SELECT * FROM book WHERE id = ANY(%s)""", (list(ids),))
+        rows = cursor.fetchall()
+        catalog = self._fetch_catalog(cursor)
+        with self._lock:
+            for book_id in ids:
+                self._remove_book(book_id)
+            for row in rows:
+                self._add_book(row)
+            self.catalog = catalog
+
+    def refresh_scores(self, cursor, ids):
+        cursor.execute("""SELECT book_id, score FROM book_rank WHERE book_id = ANY(%s)""", (list(ids),))
+        rows = dict(cursor.fetchall())
+        with self._lock:
+            for book_id in ids:
+                if book_id in rows:
+                    self.scores[book_id] = rows[book_id]
+                else:
+                    self.scores.pop(book_id, None)
+
+    @staticmethod
+    def _fetch_catalog(cursor):
+        cursor.execute(CATALOG_VERSION)
+        row = cursor.fetchone()
+        return {"version": row[0], "updated_at": row[1]} if row else None
+
+    # Book indexes. Rows are the tuples SELECT * returns; each ordered column
+    # keeps a sorted list of (is_null, value, id) keys, which puts NULLs last
+    # ascending and first descending, as Postgres does.
+
+    def _reset_books(self, rows):
+        self.position = {column: index for index, column in enumerate(self.columns)}
+        self.books = {}
+        self.title_ids = {}
+        self.by_genre = {}
+        self.by_author = {}
+        self.orders = {column: [] for column in ORDERED_COLUMNS}
+        for row in rows:
+            self._add_book(row, sort=False)
+        for order in self.orders.values():
+            order.sort()
+
+    def _key(self, row, column):
+        value = row[self.position[column]]
+        return (value is None, value, row[0])
+
+    def _add_book(self, row, sort=True):
+        book_id = row[0]
+        self.books[book_id] = row
+        self.title_ids[row[self.position["title"]]] = book_id
+        self.by_genre.setdefault(row[self.position["genre_id"]], set()).add(book_id)
+        self.by_author.setdefault(row[self.position["author_id"]], set()).add(book_id)
+        for column, order in self.orders.items():
+            if sort:
+                insort(order, self._key(row, column))
+            else:
+                order.append(self._key(row, column))
+
+    def _remove_book(self, book_id):
+        row = self.books.pop(book_id, None)
+        if row is None:
+            return
+        title = row[self.position["title"]]
+        if self.title_ids.get(title) == book_id:
+            del self.title_ids[title]
+        self.by_genre[row[self.position["genre_id"]]].discard(book_id)
+        self.by_author[row[self.position["author_id"]]].discard(book_id)
+        for column, order in self.orders.items():
+            del order[bisect_left(order, self._key(row, column))]
+
+    def _book(self, row):
+        return dict(zip(self.columns, row)) if row is not None else None
+
+    # Reads. Each returns what the matching Storage method would, or raises
+    # Unsupported when the answer could differ from SQL.
+
+    def retrieve_catalog_version(self):
+        return dict(self.catalog) if self.catalog else None
+
+    def retrieve_book_by_id(self, book_id):
+        with self._lock:
+            return self._book(self.books.get(int(book_id)))
+
+    def retrieve_books_by_ids(self, book_ids):
+        with self._lock:
+            rows = (self.books.get(int(book_id)) for book_id in dict.fromkeys(book_ids))
+            return [self._book(row) for row in rows if row is not None]
+
+    def retrieve_book_for_title(self, title):
+        with self._lock:
+            return self._book(self.books.get(self.title_ids.get(title)))
+
+    def retrieve_existing_titles(self, titles):
+        with self._lock:
+            return {title for title in titles if title in self.title_ids}
+
+    def check_book_references(self, title, author_id, genre_id):
+        with self._lock:
+            return {
+                "title_exists": title in self.title_ids,
+                "author_exists": author_id in self.authors.rows,
+                "genre_exists": genre_id in self.genres.rows,
+            }
+
+    def recommend_books(self, column, key, limit=5):
+        index = self.by_genre if column == "genre_id" else self.by_author
+        with self._lock:
+            ranked = [book_id for book_id in index.get(int(key), ()) if book_id in self.scores]
+            best = heapq.nsmallest(limit, ranked, key=lambda book_id: (-self.scores[book_id], book_id))
+            return [self._book(self.books[book_id]) for book_id in best]
+
+    def retrieve_books(self, query_set):
+        sort_by = query_set.sort_by or "id"
+        if sort_by == "title" and not self.byte_order_titles:
+            raise Unsupported("title order depends on the database collation")
+        for pattern in (query_set.title, query_set.description):
+            if pattern is not None and any(character in pattern for character in "%_\\"):
+                raise Unsupported("LIKE wildcards in the filter")
+
+        descending = query_set.order == "desc"
+        matches = book_matcher(query_set, self.position)
+        with self._lock:
+            try:
+                return self._retrieve_books(query_set, sort_by, descending, matches)
+            except TypeError:
+                # A cursor value of the wrong type; SQL reports it properly.
+                raise Unsupported("cursor value does not match the sort column")
+
+    def _retrieve_books(self, query_set, sort_by, descending, matches):
+        order = self._ordered_keys(query_set, sort_by)
+        keys = reversed(order) if descending else order
+        if query_set.after is not None:
+            value, last_id = query_set.after
+            if value is None and sort_by != "id":
+                return []
+            bound = (False, last_id if sort_by == "id" else value, last_id)
+            if descending:
+                keys = (order[index] for index in reversed(range(bisect_left(order, bound))))
+            else:
+                # Row comparisons with NULL are never true, so NULL keys
+                # (sorted last) end an ascending page.
+                keys = takewhile(lambda key: not key[0], (order[index] for index in range(bisect_right(order, bound), len(order))))
+
+        rows = (self.books[key[2]] for key in keys)
+        rows = islice(filter(matches, rows), query_set.offset or 0, None)
+        if query_set.limit is not None:
+            rows = islice(rows, query_set.limit)
+        return [self._book(row) for row in rows]
+
+    def _ordered_keys(self, query_set, sort_by):
+        # Sorting a genre/author set (or a year range) beats walking the
+        # column's full order only while it is a small slice of the catalog;
+        # book_matcher applies every filter either way.
+        ids = None
+        if query_set.genre_id is not None:
+            ids = self.by_genre.get(query_set.genre_id, set())
+        if query_set.author_id is not None:
+            author_ids = self.by_author.get(query_set.author_id, set())
+            ids = author_ids if ids is None else ids & author_ids
+        if ids is None and (query_set.published_year_start is not None or query_set.published_year_end is not None):
+            years = self.orders["published_year"]
+            start = bisect_left(years, (False, query_set.published_year_start)) if query_set.published_year_start is not None else 0
+            end = bisect_left(years, (False, query_set.published_year_end + 1)) if query_set.published_year_end is not None else bisect_left(years, (True,))
+            ids = [key[2] for key in years[start:end]]
+        if ids is None or len(ids) * NARROW_FRACTION > len(self.books):
+            return self.orders[sort_by]
+        return sorted(self._key(self.books[book_id], sort_by) for book_id in ids)
+
+    def retrieve_authors(self):
+        with self._lock:
+            return self.authors.all()
+
+    def retrieve_author_by_id(self, author_id):
+        with self._lock:
+            return self.authors.get(int(author_id))
+
+    def retrieve_existing_author_ids(self, author_ids):
+        with self._lock:
+            return {author_id for author_id in author_ids if author_id in self.authors.rows}
+
+    def retrieve_author_for_firstname_and_lastname(self, firstname, lastname):
+        with self._lock:
+            return self.authors.find(firstname=firstname, lastname=lastname)
+
+    def retrieve_genre(self, genre_id):
+        with self._lock:
+            return self.genres.get(int(genre_id))
+
+    def retrieve_existing_genre_ids(self, genre_ids):
+        with self._lock:
+            return {genre_id for genre_id in genre_ids if genre_id in self.genres.rows}
+
+    def retrieve_genre_by_title(self, genre_name):
+        with self._lock:
+            return self.genres.find(name_genre=genre_name)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "books": len(self.books),
+                "authors": len(self.authors.rows),
+                "genres": len(self.genres.rows),
+                "lag": round(time.monotonic() - self.synced_at, 3) if self.synced_at else None,
+                "dirty": sorted(self._dirty),
+                "notifications": self.notifications,
+                "reloads": self.reloads,
+            }
+
+
+class Table:
+    # author and genre are small and rarely written, so any change reloads
+    # them whole.
+    def __init__(self, columns=(), rows=()):
+        self.columns = list(columns)
+        self.rows = {row[0]: row for row in rows}
+
+    def get(self, key):
+        row = self.rows.get(key)
+        return dict(zip(self.columns, row)) if row is not None else None
+
+    def all(self):
+        return [dict(zip(self.columns, row)) for row in self.rows.values()]
+
+    def find(self, **values):
+        for row in self.rows.values():
+            found = dict(zip(self.columns, row))
+            if all(found[column] == value for column, value in values.items()):
+                return found
+        return None
+
+
+class Unsupported(Exception):
+    pass
+
+
+def book_matcher(query_set, position):
+    # The in-memory twin of database.book_filters.
+    checks = []
+    if query_set.title is not None:
+        checks.append((position["title"], lambda value, pattern=query_set.title: value is not None and pattern in value))
+    if query_set.description is not None:
+        checks.append((position["description"], lambda value, pattern=query_set.description: value is not None and pattern in value))
+    if query_set.published_year_start is not None:
+        checks.append((position["published_year"], lambda value, start=query_set.published_year_start: value is not None and value >= start))
+    if query_set.published_year_end is not None:
+        checks.append((position["published_year"], lambda value, end=query_set.published_year_end: value is not None and value <= end))
+    if query_set.author_id is not None:
+        checks.append((position["author_id"], lambda value, author_id=query_set.author_id: value == author_id))
+    if query_set.genre_id is not None:
+        checks.append((position["genre_id"], lambda value, genre_id=query_set.genre_id: value == genre_id))
+    return lambda row: all(check(row[index]) for index, check in checks)
+
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_read_model(dsn):
+    # None unless READ_MODEL_ENABLED. The first call starts the listener;
+    # until the initial load finishes every read goes to SQL.
+    global _model
+    if not READ_MODEL_ENABLED:
+        return None
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                model = ReadModel(dsn)
+                model.start()
+                _model = model
+    return _model
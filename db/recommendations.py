@@ -0,0 +1,352 @@
+import csv
+import io
+import itertools
+import logging
+import os
+import threading
+
+import numpy as np
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import execute_values
+
+from db.cache import storage_cache
+
+TOP_K = int(os.getenv("RECOMMENDATIONS_TOP_K", "10"))
+
+# Book writes only queue the changed ids (a trigger fills
+# book_recommendation_queue); a Refresher recomputes them in its own
+# transactions, so a write never pays for its genre's recompute. The delay
+# lets a burst of writes queue up first; the interval picks up ids queued by
+# other processes.
+REFRESH_DELAY = float(os.getenv("RECOMMENDATIONS_REFRESH_DELAY", "0.5"))
+REFRESH_INTERVAL = float(os.getenv("RECOMMENDATIONS_REFRESH_INTERVAL", "30"))
+REFRESH_BATCH = int(os.getenv("RECOMMENDATIONS_REFRESH_BATCH", "1000"))
+
+# pg_advisory_xact_lock key: one drain transaction at a time across
+# processes, since overlapping refreshes rewrite the same books' rows.
+DRAIN_LOCK = 0x626F6F6B
+
+logger = logging.getLogger(__name__)
+
+# A shared genre or author always outweighs year and price, so a book's
+# neighbours come from its own genre/author whenever there are enough of them.
+GENRE_WEIGHT = 0.4
+AUTHOR_WEIGHT = 0.3
+YEAR_WEIGHT = 0.2
+PRICE_WEIGHT = 0.1
+YEAR_SCALE = 10.0
+
+# Upper bound on cells in one (targets x candidates) score matrix.
+MATRIX_BUDGET = 2_000_000
+
+FEATURES_SQL = """SELECT id, coalesce(genre_id, 0), coalesce(author_id, 0),
+    coalesce(published_year, 0), coalesce(price, 0) FROM book"""
+
+
+class Features:
+    def __init__(self, rows):
+        data = np.asarray(rows, dtype=np.float64).reshape(-1, 5)
+        self.id = data[:, 0].astype(np.int64)
+        self.genre = data[:, 1].astype(np.int64)
+        self.author = data[:, 2].astype(np.int64)
+        self.year = data[:, 3]
+        # Price bands are powers of two, so 9.99 and 12.50 share a band.
+        self.band = np.floor(np.log2(np.maximum(data[:, 4], 0.01)))
+
+    def __len__(self):
+        return len(self.id)
+
+    def take(self, index):
+        subset = Features.__new__(Features)
+        for name in ("id", "genre", "author", "year", "band"):
+            setattr(subset, name, getattr(self, name)[index])
+        return subset
+
+
+def load(cursor, where="", params=()):
+    cursor.execute(FEATURES_SQL + where, params)
+    return Features(cursor.fetchall())
+
+
+def score(targets, candidates):
+    scores = GENRE_WEIGHT * (targets.genre[:, None] == candidates.genre[None, :])
+    scores += AUTHOR_WEIGHT * (targets.author[:, None] == candidates.author[None, :])
+    scores += YEAR_WEIGHT * np.exp(-np.abs(targets.year[:, None] - candidates.year[None, :]) / YEAR_SCALE)
+    scores += PRICE_WEIGHT * (targets.band[:, None] == candidates.band[None, :])
+    scores[targets.id[:, None] == candidates.id[None, :]] = -np.inf
+    return scores
+
+
+def best_scores(targets, candidates):
+    # Each target's best score against candidates, in budget-sized chunks.
+    best = np.full(len(targets), -np.inf)
+    if len(candidates):
+        chunk = max(1, MATRIX_BUDGET // len(candidates))
+        for start in range(0, len(targets), chunk):
+            best[start:start + chunk] = score(targets.take(slice(start, start + chunk)), candidates).max(axis=1)
+    return best
+
+
+def top_k(targets, candidates, k=TOP_K):
+    # Returns {book_id: [(similar_book_id, score), ...]} best first.
+    neighbours = {}
+    if not len(targets) or not len(candidates):
+        return {book_id: [] for book_id in targets.id.tolist()}
+
+    chunk = max(1, MATRIX_BUDGET // len(candidates))
+    for start in range(0, len(targets), chunk):
+        part = targets.take(slice(start, start + chunk))
+        scores = score(part, candidates)
+        kk = min(k, scores.shape[1])
+        if kk < scores.shape[1]:
+            index = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+        else:
+            index = np.tile(np.arange(scores.shape[1]), (len(part), 1))
+        best = np.take_along_axis(scores, index, axis=1)
+        order = np.argsort(-best, axis=1, kind="stable")
+        index = np.take_along_axis(index, order, axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+        for row, book_id in enumerate(part.id.tolist()):
+            keep = np.isfinite(best[row])
+            neighbours[book_id] = list(zip(
+                candidates.id[index[row][keep]].tolist(),
+                best[row][keep].tolist(),
+            ))
+    return neighbours
+
+
+def recompute(cursor, book_ids, catalog=None):
+    # Returns the full-catalog features if they had to be loaded, so callers
+    # walking many chunks load them once.
+    targets = load(cursor, " WHERE id = ANY(%s)", (list(book_ids),))
+    if not len(targets):
+        return catalog
+
+    candidates = load(
+        cursor,
+        " WHERE genre_id = ANY(%s) OR author_id = ANY(%s)",
+        (np.unique(targets.genre).tolist(), np.unique(targets.author).tolist()),
+    )
+    neighbours = top_k(targets, candidates)
+
+    # Books whose genre and author together have fewer than TOP_K other
+    # books need the rest of the catalog to fill their list.
+    short = [
+        index for index, book_id in enumerate(targets.id.tolist())
+        if len(neighbours[book_id]) < TOP_K or neighbours[book_id][-1][1] <= AUTHOR_WEIGHT
+    ]
+    if short:
+        if catalog is None:
+            catalog = load(cursor)
+        neighbours.update(top_k(targets.take(short), catalog))
+
+    save(cursor, targets, neighbours)
+    return catalog
+
+
+def recompute_all(cursor, book_ids=None, chunk_size=1000):
+    # One genre per chunk: the candidate set is then that genre plus the
+    # chunk's authors rather than most of the catalog.
+    if book_ids is None:
+        cursor.execute("""SELECT id, genre_id FROM book ORDER BY genre_id, id""")
+    else:
+        cursor.execute("""SELECT id, genre_id FROM book WHERE id = ANY(%s) ORDER BY genre_id, id""", (list(book_ids),))
+    catalog = None
+    for _, rows in itertools.groupby(cursor.fetchall(), key=lambda row: row[1]):
+        ids = [row[0] for row in rows]
+        for start in range(0, len(ids), chunk_size):
+            catalog = recompute(cursor, ids[start:start + chunk_size], catalog)
+
+
+def save(cursor, targets, neighbours):
+    cursor.execute("""DELETE FROM book_similarity WHERE book_id = ANY(%s)""", (targets.id.tolist(),))
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        (book_id, rank, similar_id, similarity)
+        for book_id, items in neighbours.items()
+        for rank, (similar_id, similarity) in enumerate(items)
+    )
+    buffer.seek(0)
+    cursor.copy_expert(
+        """COPY book_similarity (book_id, rank, similar_book_id, score) FROM STDIN WITH (FORMAT csv)""",
+        buffer,
+    )
+    # A book's rank score is the mean similarity of its neighbours: books
+    # typical of their genre/author come first in the genre/author lists.
+    execute_values(
+        cursor,
+        """INSERT INTO book_rank (book_id, genre_id, author_id, score) VALUES %s
+        ON CONFLICT (book_id) DO UPDATE SET genre_id = EXCLUDED.genre_id,
+        author_id = EXCLUDED.author_id, score = EXCLUDED.score""",
+        [
+            (
+                book_id,
+                int(targets.genre[index]) or None,
+                int(targets.author[index]) or None,
+                float(np.mean([similarity for _, similarity in neighbours[book_id]] or [0.0])),
+            )
+            for index, book_id in enumerate(targets.id.tolist())
+        ],
+    )
+
+
+def refresh(connection, book_ids):
+    # Incremental refresh after book_ids were inserted, updated or deleted;
+    # runs in the caller's transaction.
+    # Recomputed: the changed books themselves, books that listed one of
+    # them, and books that would now rank a changed book above their current
+    # K-th neighbour. Deleted books' own rows go with ON DELETE CASCADE.
+    # Only books sharing a genre or author are checked for the last case;
+    # anything else scores at most AUTHOR_WEIGHT against a changed book and
+    # is picked up by the next rebuild.
+    book_ids = list(book_ids)
+    if not book_ids:
+        return
+
+    with connection.cursor(cursor_factory=extensions.cursor) as cursor:
+        changed = load(cursor, " WHERE id = ANY(%s)", (book_ids,))
+        cursor.execute(
+            """SELECT DISTINCT book_id FROM book_similarity WHERE similar_book_id = ANY(%s)""",
+            (book_ids,),
+        )
+        stale = {row[0] for row in cursor.fetchall()}
+
+        if len(changed):
+            neighbourhood = load(
+                cursor,
+                " WHERE genre_id = ANY(%s) OR author_id = ANY(%s)",
+                (np.unique(changed.genre).tolist(), np.unique(changed.author).tolist()),
+            )
+            cursor.execute(
+                """SELECT book_id, min(score), count(*) FROM book_similarity
+                WHERE book_id = ANY(%s) GROUP BY book_id""",
+                (neighbourhood.id.tolist(),),
+            )
+            floors = {book_id: lowest for book_id, lowest, count in cursor.fetchall() if count >= TOP_K}
+            full = np.array([book_id in floors for book_id in neighbourhood.id.tolist()], dtype=bool)
+            stale.update(neighbourhood.id[~full].tolist())
+            # Only books with a full list need scoring against the changes.
+            checked = neighbourhood.take(full)
+            for book_id, candidate in zip(checked.id.tolist(), best_scores(checked, changed).tolist()):
+                if candidate > floors[book_id]:
+                    stale.add(book_id)
+
+        recompute_all(cursor, stale.union(changed.id.tolist()))
+
+
+def rebuild(connection):
+    with connection.cursor(cursor_factory=extensions.cursor) as cursor:
+        cursor.execute("""SELECT pg_advisory_xact_lock(%s)""", (DRAIN_LOCK,))
+        cursor.execute("""DELETE FROM book_recommendation_queue""")
+        cursor.execute("""DELETE FROM book_similarity""")
+        recompute_all(cursor)
+    connection.commit()
+    storage_cache.invalidate("book_rank")
+
+
+def drain(connection, batch_size=REFRESH_BATCH):
+    # Refreshes queued books, a batch per transaction, until the queue is
+    # empty. A failed batch rolls back into the queue. Returns the number of
+    # books refreshed.
+    total = 0
+    while True:
+        try:
+            with connection.cursor(cursor_factory=extensions.cursor) as cursor:
+                cursor.execute("""SELECT pg_advisory_xact_lock(%s)""", (DRAIN_LOCK,))
+                cursor.execute(
+                    """DELETE FROM book_recommendation_queue WHERE id IN (
+                        SELECT id FROM book_recommendation_queue ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+                    ) RETURNING book_id""",
+                    (batch_size,),
+                )
+                book_ids = sorted({row[0] for row in cursor.fetchall()})
+            if book_ids:
+                refresh(connection, book_ids)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        if not book_ids:
+            return total
+        total += len(book_ids)
+        storage_cache.invalidate("book_rank")
+
+
+class Refresher:
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.refreshed = 0
+        self.failures = 0
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="recommendations", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        connection = None
+        while not self._stopped.is_set():
+            self._wake.wait(REFRESH_INTERVAL)
+            if self._stopped.wait(REFRESH_DELAY):
+                break
+            self._wake.clear()
+            try:
+                if connection is None or connection.closed:
+                    connection = psycopg2.connect(self.dsn)
+                self.refreshed += drain(connection)
+            except Exception:
+                self.failures += 1
+                logger.exception("recommendation refresh failed, retrying later")
+                if connection is not None and connection.closed:
+                    connection = None
+        if connection is not None:
+            connection.close()
+
+
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def get_refresher(dsn):
+    # The first call starts the background thread.
+    global _refresher
+    if _refresher is None:
+        with _refresher_lock:
+            if _refresher is None:
+                refresher = Refresher(dsn)
+                refresher.start()
+                _refresher = refresher
+    return _refresher
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from db.database import Storage, get_dsn
+
+    parser = argparse.ArgumentParser(description="Recompute precomputed book recommendations.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--drain", action="store_true", help="only refresh the queued books, not the whole catalog")
+    mode.add_argument("--worker", action="store_true", help="keep draining the queue every RECOMMENDATIONS_REFRESH_INTERVAL")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.worker:
+        Refresher(get_dsn()).run()
+    else:
+        with Storage() as db:
+            if args.drain:
+                logger.info("refreshed %d books", drain(db.connection))
+            else:
+                rebuild(db.connection)
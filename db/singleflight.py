@@ -0,0 +1,133 @@
+import asyncio
+import functools
+import inspect
+import os
+import threading
+
+from db import metrics
+from db.cache import storage_cache
+
+# Concurrent identical reads share one in-flight query: the first caller
+# runs it, the rest wait for its result (or its exception).
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "1") == "1"
+
+coalesced_calls = metrics.Counter(
+    "storage_coalesced_calls_total", "Storage reads answered by another caller's in-flight query.", ("method",)
+)
+
+
+class _Flight:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._flights = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def _join(self, flights, key, create, name):
+        # Returns (flight, leader).
+        with self._lock:
+            self.calls += 1
+            flight = flights.get(key)
+            if flight is None:
+                flight = flights[key] = create()
+                return flight, True
+            self.shared += 1
+        if metrics.METRICS_ENABLED:
+            coalesced_calls.inc((name,))
+        return flight, False
+
+    def do(self, key, fn, name=""):
+        flight, leader = self._join(self._flights, key, _Flight, name)
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+    async def do_async(self, key, fn, name=""):
+        loop = asyncio.get_running_loop()
+        # Tasks belong to one event loop, so the loop is part of the key.
+        task, leader = self._join(self._tasks, (loop, key), lambda: loop.create_task(fn()), name)
+        if leader:
+            task.add_done_callback(lambda _: self._forget((loop, key), task))
+            # Cancelling the leader cancels the query, which runs on its
+            # connection.
+            return await task
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+        # The leader went away mid-query; run it on this caller's connection.
+        return await fn()
+
+    def _forget(self, key, task):
+        with self._lock:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "shared": self.shared,
+                "in_flight": len(self._flights) + len(self._tasks),
+                "coalescing_ratio": round(self.shared / self.calls, 4) if self.calls else None,
+            }
+
+
+flights = SingleFlight()
+
+
+def coalesced(*tables, key=None):
+    # For Storage/AsyncStorage read methods that depend on `tables`. Calls
+    # with equal arguments (after `key(*args)`, when given) under the same
+    # table generations share one query; a write bumps the generation, so
+    # callers arriving after it start a fresh one. Never while the storage
+    # holds uncommitted writes of its own.
+    def decorator(method):
+        if not COALESCE_ENABLED:
+            return method
+        name = method.__name__
+
+        def flight_key(args):
+            return (name, storage_cache.generation(tables), key(*args) if key else args)
+
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(self, *args):
+                if getattr(self, "writing", False):
+                    return await method(self, *args)
+                return await flights.do_async(flight_key(args), lambda: method(self, *args), name)
+
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            if getattr(self, "writing", False):
+                return method(self, *args)
+            return flights.do(flight_key(args), lambda: method(self, *args), name)
+
+        return wrapper
+
+    return decorator
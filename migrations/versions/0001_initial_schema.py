@@ -0,0 +1,75 @@
+"""initial schema with filter, sort and search indexes
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BOOK_DOCUMENT = "to_tsvector('english', coalesce(title, '') || ' ' || coalesce(description, ''))"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # IF NOT EXISTS everywhere so databases created by the old
+    # create_tables_if_not_exist bootstrap can be stamped forward in place.
+    op.execute("""CREATE TABLE IF NOT EXISTS author (
+        Id SERIAL PRIMARY KEY,
+        firstname VARCHAR(255),
+        lastname VARCHAR(255),
+        UNIQUE(firstname, lastname)
+    )""")
+    op.execute("""CREATE TABLE IF NOT EXISTS genre (
+        Id SERIAL PRIMARY KEY,
+        name_genre VARCHAR(255) UNIQUE
+    )""")
+    op.execute("""CREATE TABLE IF NOT EXISTS book (
+        Id SERIAL PRIMARY KEY,
+        title VARCHAR(255) UNIQUE,
+        description TEXT,
+        published_year INTEGER,
+        price REAL,
+        genre_id INTEGER,
+        author_id INTEGER,
+        FOREIGN KEY(author_id) REFERENCES author(id),
+        FOREIGN KEY(genre_id) REFERENCES genre(id)
+    )""")
+    op.execute("""CREATE TABLE IF NOT EXISTS users (
+        Id SERIAL PRIMARY KEY,
+        email VARCHAR(255) UNIQUE,
+        password VARCHAR(255)
+    )""")
+
+    # Filters, recommendations and keyset pages: every one ends in `id` so
+    # ORDER BY <column>, id and the (column, id) cursor comparison are
+    # served straight from the index.
+    op.execute("CREATE INDEX IF NOT EXISTS book_genre_id_idx ON book (genre_id, id)")
+    op.execute("CREATE INDEX IF NOT EXISTS book_author_id_idx ON book (author_id, id)")
+    op.execute("CREATE INDEX IF NOT EXISTS book_published_year_idx ON book (published_year, id)")
+    op.execute("CREATE INDEX IF NOT EXISTS book_genre_id_published_year_idx ON book (genre_id, published_year)")
+    op.execute("CREATE INDEX IF NOT EXISTS book_price_idx ON book (price, id)")
+    op.execute("CREATE INDEX IF NOT EXISTS book_title_idx ON book (title, id)")
+
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.execute(f"CREATE INDEX IF NOT EXISTS book_document_idx ON book USING GIN ({BOOK_DOCUMENT})")
+    op.execute("CREATE INDEX IF NOT EXISTS book_title_trgm_idx ON book USING GIN (title gin_trgm_ops)")
+    op.execute("CREATE INDEX IF NOT EXISTS book_description_trgm_idx ON book USING GIN (description gin_trgm_ops)")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE IF EXISTS users")
+    op.execute("DROP TABLE IF EXISTS book")
+    op.execute("DROP TABLE IF EXISTS genre")
+    op.execute("DROP TABLE IF EXISTS author")
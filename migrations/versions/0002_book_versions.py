@@ -0,0 +1,66 @@
+"""book row versions and catalog version for conditional requests
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, Sequence[str], None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Every row change draws from one sequence, so a row's version is unique
+    # and the catalog version (bumped once per statement that touches book,
+    # deletes included) only ever grows.
+    op.execute("CREATE SEQUENCE IF NOT EXISTS book_version_seq")
+    op.execute("ALTER TABLE book ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('book_version_seq')")
+    op.execute("ALTER TABLE book ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now()")
+    op.execute("""CREATE TABLE IF NOT EXISTS book_catalog (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        version BIGINT NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL
+    )""")
+    op.execute("""INSERT INTO book_catalog (version, updated_at)
+        VALUES (nextval('book_version_seq'), now()) ON CONFLICT DO NOTHING""")
+
+    op.execute("""CREATE OR REPLACE FUNCTION book_touch_row() RETURNS trigger AS $$
+    BEGIN
+        NEW.version := nextval('book_version_seq');
+        NEW.updated_at := now();
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql""")
+    op.execute("DROP TRIGGER IF EXISTS book_touch_row ON book")
+    op.execute("""CREATE TRIGGER book_touch_row BEFORE UPDATE ON book
+        FOR EACH ROW EXECUTE FUNCTION book_touch_row()""")
+
+    op.execute("""CREATE OR REPLACE FUNCTION book_touch_catalog() RETURNS trigger AS $$
+    BEGIN
+        UPDATE book_catalog SET version = nextval('book_version_seq'), updated_at = now();
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""")
+    op.execute("DROP TRIGGER IF EXISTS book_touch_catalog ON book")
+    op.execute("""CREATE TRIGGER book_touch_catalog AFTER INSERT OR UPDATE OR DELETE ON book
+        FOR EACH STATEMENT EXECUTE FUNCTION book_touch_catalog()""")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TRIGGER IF EXISTS book_touch_catalog ON book")
+    op.execute("DROP TRIGGER IF EXISTS book_touch_row ON book")
+    op.execute("DROP FUNCTION IF EXISTS book_touch_catalog()")
+    op.execute("DROP FUNCTION IF EXISTS book_touch_row()")
+    op.execute("DROP TABLE IF EXISTS book_catalog")
+    op.execute("ALTER TABLE book DROP COLUMN IF EXISTS updated_at")
+    op.execute("ALTER TABLE book DROP COLUMN IF EXISTS version")
+    op.execute("DROP SEQUENCE IF EXISTS book_version_seq")
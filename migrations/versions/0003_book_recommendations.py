@@ -0,0 +1,49 @@
+"""precomputed book similarity and recommendation rank
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, Sequence[str], None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Top-K neighbours per book, maintained by db/recommendations.py (0006
+    # queues the books already in the catalog for it). A
+    # book's own rows cascade with it; rows pointing at a deleted book are
+    # recomputed by the refresh, so similar_book_id carries no foreign key.
+    op.execute("""CREATE TABLE IF NOT EXISTS book_similarity (
+        book_id INTEGER NOT NULL REFERENCES book(id) ON DELETE CASCADE,
+        rank SMALLINT NOT NULL,
+        similar_book_id INTEGER NOT NULL,
+        score REAL NOT NULL,
+        PRIMARY KEY (book_id, rank)
+    )""")
+    op.execute("CREATE INDEX IF NOT EXISTS book_similarity_similar_book_id_idx ON book_similarity (similar_book_id)")
+
+    op.execute("""CREATE TABLE IF NOT EXISTS book_rank (
+        book_id INTEGER PRIMARY KEY REFERENCES book(id) ON DELETE CASCADE,
+        genre_id INTEGER,
+        author_id INTEGER,
+        score REAL NOT NULL
+    )""")
+    op.execute("CREATE INDEX IF NOT EXISTS book_rank_genre_idx ON book_rank (genre_id, score DESC, book_id)")
+    op.execute("CREATE INDEX IF NOT EXISTS book_rank_author_idx ON book_rank (author_id, score DESC, book_id)")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE IF EXISTS book_rank")
+    op.execute("DROP TABLE IF EXISTS book_similarity")
@@ -0,0 +1,122 @@
+"""per-genre, per-author and per-year book aggregates
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, Sequence[str], None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Each book counts once per dimension; the catalog dimension has the single
+# key 0.
+DIMENSIONS = """CROSS JOIN LATERAL (VALUES
+    ('catalog', 0), ('genre', {rows}.genre_id), ('author', {rows}.author_id), ('year', {rows}.published_year)
+) dimensions (dimension, key) WHERE dimensions.key IS NOT NULL"""
+
+
+def aggregate(rows):
+    return f"""SELECT dimension, key, count(*) AS book_count, count(price) AS priced_count,
+        coalesce(sum(price::numeric), 0) AS price_sum, min(price) AS price_min, max(price) AS price_max
+        FROM {rows} {DIMENSIONS.format(rows=rows)}
+        GROUP BY dimension, key"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("""CREATE TABLE IF NOT EXISTS book_stats (
+        dimension VARCHAR(16) NOT NULL,
+        key INTEGER NOT NULL,
+        book_count INTEGER NOT NULL,
+        priced_count INTEGER NOT NULL,
+        price_sum NUMERIC NOT NULL,
+        price_min REAL,
+        price_max REAL,
+        PRIMARY KEY (dimension, key)
+    )""")
+
+    # Statement-level triggers apply each statement's changed rows as deltas,
+    # so COPY imports and multi-row writes cost one pass over the changed
+    # rows. Sums are NUMERIC so repeated add/subtract never drifts; a
+    # removed min or max is recomputed from the rest of its group only.
+    op.execute(f"""CREATE OR REPLACE FUNCTION book_stats_apply() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            WITH removed AS ({aggregate("old_rows")}),
+            stale AS (
+                SELECT removed.dimension, removed.key FROM removed
+                JOIN book_stats ON book_stats.dimension = removed.dimension AND book_stats.key = removed.key
+                WHERE removed.price_min <= book_stats.price_min OR removed.price_max >= book_stats.price_max
+            ),
+            bounds AS (
+                SELECT 'catalog' AS dimension, 0 AS key, min(price) AS price_min, max(price) AS price_max FROM book
+                WHERE EXISTS (SELECT 1 FROM stale WHERE dimension = 'catalog')
+                UNION ALL
+                SELECT 'genre', genre_id, min(price), max(price) FROM book
+                WHERE genre_id IN (SELECT key FROM stale WHERE dimension = 'genre') GROUP BY genre_id
+                UNION ALL
+                SELECT 'author', author_id, min(price), max(price) FROM book
+                WHERE author_id IN (SELECT key FROM stale WHERE dimension = 'author') GROUP BY author_id
+                UNION ALL
+                SELECT 'year', published_year, min(price), max(price) FROM book
+                WHERE published_year IN (SELECT key FROM stale WHERE dimension = 'year') GROUP BY published_year
+            )
+            UPDATE book_stats SET
+                book_count = book_stats.book_count - removed.book_count,
+                priced_count = book_stats.priced_count - removed.priced_count,
+                price_sum = book_stats.price_sum - removed.price_sum,
+                price_min = CASE WHEN bounds.dimension IS NULL THEN book_stats.price_min ELSE bounds.price_min END,
+                price_max = CASE WHEN bounds.dimension IS NULL THEN book_stats.price_max ELSE bounds.price_max END
+            FROM removed
+            LEFT JOIN bounds ON bounds.dimension = removed.dimension AND bounds.key = removed.key
+            WHERE book_stats.dimension = removed.dimension AND book_stats.key = removed.key;
+
+            DELETE FROM book_stats USING old_rows {DIMENSIONS.format(rows="old_rows")}
+            AND book_stats.dimension = dimensions.dimension AND book_stats.key = dimensions.key
+            AND book_stats.book_count <= 0;
+        END IF;
+
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO book_stats (dimension, key, book_count, priced_count, price_sum, price_min, price_max)
+            {aggregate("new_rows")} ORDER BY dimension, key
+            ON CONFLICT (dimension, key) DO UPDATE SET
+                book_count = book_stats.book_count + EXCLUDED.book_count,
+                priced_count = book_stats.priced_count + EXCLUDED.priced_count,
+                price_sum = book_stats.price_sum + EXCLUDED.price_sum,
+                price_min = least(book_stats.price_min, EXCLUDED.price_min),
+                price_max = greatest(book_stats.price_max, EXCLUDED.price_max);
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""")
+
+    # Transition tables need one trigger per event.
+    op.execute("DROP TRIGGER IF EXISTS book_stats_insert ON book")
+    op.execute("""CREATE TRIGGER book_stats_insert AFTER INSERT ON book
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION book_stats_apply()""")
+    op.execute("DROP TRIGGER IF EXISTS book_stats_update ON book")
+    op.execute("""CREATE TRIGGER book_stats_update AFTER UPDATE ON book
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION book_stats_apply()""")
+    op.execute("DROP TRIGGER IF EXISTS book_stats_delete ON book")
+    op.execute("""CREATE TRIGGER book_stats_delete AFTER DELETE ON book
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION book_stats_apply()""")
+
+    op.execute("DELETE FROM book_stats")
+    op.execute(f"INSERT INTO book_stats {aggregate('book')}")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TRIGGER IF EXISTS book_stats_delete ON book")
+    op.execute("DROP TRIGGER IF EXISTS book_stats_update ON book")
+    op.execute("DROP TRIGGER IF EXISTS book_stats_insert ON book")
+    op.execute("DROP FUNCTION IF EXISTS book_stats_apply()")
+    op.execute("DROP TABLE IF EXISTS book_stats")
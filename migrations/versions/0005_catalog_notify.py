@@ -0,0 +1,68 @@
+"""catalog change notifications for the in-process read model
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, Sequence[str], None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Notifying tables and the key column their notifications carry.
+KEYS = {"book": "id", "author": "id", "genre": "id", "book_rank": "book_id"}
+
+EVENTS = (
+    ("insert", "NEW TABLE AS new_rows"),
+    ("update", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+    ("delete", "OLD TABLE AS old_rows"),
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # One notification per statement with the changed keys; past 500 keys the
+    # keys are null (reload the table), keeping under the 8000-byte payload
+    # limit.
+    op.execute("""CREATE OR REPLACE FUNCTION catalog_notify() RETURNS trigger AS $$
+    DECLARE
+        ids INTEGER[];
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            EXECUTE format('SELECT array_agg(DISTINCT %I) FROM old_rows', TG_ARGV[0]) INTO ids;
+        ELSIF TG_OP = 'UPDATE' THEN
+            EXECUTE format('SELECT array_agg(DISTINCT key) FROM (SELECT %1$I AS key FROM old_rows
+                UNION ALL SELECT %1$I FROM new_rows) changed', TG_ARGV[0]) INTO ids;
+        ELSE
+            EXECUTE format('SELECT array_agg(DISTINCT %I) FROM new_rows', TG_ARGV[0]) INTO ids;
+        END IF;
+        IF ids IS NOT NULL THEN
+            PERFORM pg_notify('catalog_changes', json_build_object(
+                'table', TG_TABLE_NAME, 'ids', CASE WHEN cardinality(ids) <= 500 THEN ids END
+            )::text);
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""")
+
+    # Transition tables need one trigger per event.
+    for table, key in KEYS.items():
+        for event, transitions in EVENTS:
+            op.execute(f"DROP TRIGGER IF EXISTS {table}_notify_{event} ON {table}")
+            op.execute(f"""CREATE TRIGGER {table}_notify_{event} AFTER {event.upper()} ON {table}
+                REFERENCING {transitions} FOR EACH STATEMENT EXECUTE FUNCTION catalog_notify('{key}')""")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for table in KEYS:
+        for event, _ in EVENTS:
+            op.execute(f"DROP TRIGGER IF EXISTS {table}_notify_{event} ON {table}")
+    op.execute("DROP FUNCTION IF EXISTS catalog_notify()")
@@ -0,0 +1,72 @@
+"""queue book recommendation refreshes instead of running them in the write
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0006'
+down_revision: Union[str, Sequence[str], None] = '0005'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+EVENTS = (
+    ("insert", "NEW TABLE AS new_rows"),
+    ("update", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+    ("delete", "OLD TABLE AS old_rows"),
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Drained by db/recommendations.py. No unique key on book_id, so a write
+    # never waits on a refresh that is draining the same book.
+    op.execute("""CREATE TABLE IF NOT EXISTS book_recommendation_queue (
+        id BIGSERIAL PRIMARY KEY,
+        book_id INTEGER NOT NULL
+    )""")
+
+    # Inserted and deleted books, and updated books whose genre, author, year
+    # or price changed.
+    op.execute("""CREATE OR REPLACE FUNCTION book_recommendation_enqueue() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO book_recommendation_queue (book_id) SELECT id FROM new_rows;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO book_recommendation_queue (book_id) SELECT id FROM old_rows;
+        ELSE
+            INSERT INTO book_recommendation_queue (book_id)
+            SELECT new_rows.id FROM new_rows JOIN old_rows ON old_rows.id = new_rows.id
+            WHERE (new_rows.genre_id, new_rows.author_id, new_rows.published_year, new_rows.price)
+                IS DISTINCT FROM (old_rows.genre_id, old_rows.author_id, old_rows.published_year, old_rows.price);
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""")
+
+    # Transition tables need one trigger per event.
+    for event, transitions in EVENTS:
+        op.execute(f"DROP TRIGGER IF EXISTS book_recommendation_{event} ON book")
+        op.execute(f"""CREATE TRIGGER book_recommendation_{event} AFTER {event.upper()} ON book
+            REFERENCING {transitions} FOR EACH STATEMENT EXECUTE FUNCTION book_recommendation_enqueue()""")
+
+    # Books without recommendations yet (everything, right after 0003) are
+    # queued for the next drain. Plain SQL, so this migration does not
+    # change when db/recommendations.py does.
+    op.execute("""INSERT INTO book_recommendation_queue (book_id)
+        SELECT id FROM book WHERE NOT EXISTS (SELECT 1 FROM book_rank WHERE book_rank.book_id = book.id)
+        ORDER BY id""")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for event, _ in EVENTS:
+        op.execute(f"DROP TRIGGER IF EXISTS book_recommendation_{event} ON book")
+    op.execute("DROP FUNCTION IF EXISTS book_recommendation_enqueue()")
+    op.execute("DROP TABLE IF EXISTS book_recommendation_queue")
@@ -0,0 +1,275 @@
+"""append-only catalog version and stats deltas, so book writes share no row
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0007'
+down_revision: Union[str, Sequence[str], None] = '0006'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+EVENTS = (
+    ("insert", "NEW TABLE AS new_rows"),
+    ("update", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+    ("delete", "OLD TABLE AS old_rows"),
+)
+
+# Each book counts once per dimension; the catalog dimension has the single
+# key 0.
+DIMENSIONS = """CROSS JOIN LATERAL (VALUES
+    ('catalog', 0), ('genre', {rows}.genre_id), ('author', {rows}.author_id), ('year', {rows}.published_year)
+) dimensions (dimension, key) WHERE dimensions.key IS NOT NULL"""
+
+# Advisory lock key that serializes book_stats_fold runs.
+STATS_FOLD_LOCK = 0x73746174
+
+
+def aggregate(rows, sign="", source=None):
+    return f"""SELECT dimension, key, {sign}count(*) AS book_count, {sign}count(price) AS priced_count,
+        {sign}coalesce(sum(price::numeric), 0) AS price_sum, min(price) AS price_min, max(price) AS price_max
+        FROM {source or rows} {DIMENSIONS.format(rows=rows)}
+        GROUP BY dimension, key"""
+
+
+# Rows of an UPDATE whose stats columns changed, as `side` was.
+CHANGED = """(SELECT {side}.* FROM old_rows JOIN new_rows ON new_rows.id = old_rows.id
+    WHERE (new_rows.genre_id, new_rows.author_id, new_rows.published_year, new_rows.price)
+        IS DISTINCT FROM (old_rows.genre_id, old_rows.author_id, old_rows.published_year, old_rows.price)) {side}"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # The single book_catalog row and the ('catalog', 0) book_stats row were
+    # updated by every book statement and locked until its commit, so all
+    # book writes (a whole atomic import included) ran one at a time.
+
+    # Catalog version: one row per statement that changed book, never an
+    # update. The version is the number of such statements a snapshot sees,
+    # which grows with every commit whatever order ids were drawn in. Each
+    # statement folds the rows nobody else holds into its own, SKIP LOCKED,
+    # so the table stays a few rows long and no writer waits on another.
+    op.execute("""CREATE TABLE IF NOT EXISTS book_catalog_changes (
+        id BIGSERIAL PRIMARY KEY,
+        changes BIGINT NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL
+    )""")
+    op.execute("""INSERT INTO book_catalog_changes (changes, updated_at)
+        SELECT version, updated_at FROM book_catalog""")
+    op.execute("""CREATE OR REPLACE FUNCTION book_catalog_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM FROM old_rows LIMIT 1;
+        ELSE
+            PERFORM FROM new_rows LIMIT 1;
+        END IF;
+        IF NOT FOUND THEN
+            RETURN NULL;
+        END IF;
+        WITH folded AS (
+            DELETE FROM book_catalog_changes WHERE id IN (
+                SELECT id FROM book_catalog_changes FOR UPDATE SKIP LOCKED
+            ) RETURNING changes, updated_at
+        )
+        INSERT INTO book_catalog_changes (changes, updated_at)
+        SELECT 1 + coalesce(sum(changes), 0), greatest(max(updated_at), now()) FROM folded;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""")
+    op.execute("DROP TRIGGER IF EXISTS book_touch_catalog ON book")
+    op.execute("DROP FUNCTION IF EXISTS book_touch_catalog()")
+    op.execute("DROP TABLE IF EXISTS book_catalog")
+    for event, transitions in EVENTS:
+        op.execute(f"DROP TRIGGER IF EXISTS book_catalog_{event} ON book")
+        op.execute(f"""CREATE TRIGGER book_catalog_{event} AFTER {event.upper()} ON book
+            REFERENCING {transitions} FOR EACH STATEMENT EXECUTE FUNCTION book_catalog_change()""")
+
+    # Stats: statements append their changed rows' aggregates as deltas
+    # (removed rows negative, without bounds), so writers only insert.
+    # book_stats_fold moves them into book_stats, one fold at a time, and
+    # recomputes the folded groups' bounds from book; only readers run it.
+    op.execute("""CREATE TABLE IF NOT EXISTS book_stats_delta (
+        id BIGSERIAL PRIMARY KEY,
+        dimension VARCHAR(16) NOT NULL,
+        key INTEGER NOT NULL,
+        book_count INTEGER NOT NULL,
+        priced_count INTEGER NOT NULL,
+        price_sum NUMERIC NOT NULL,
+        price_min REAL,
+        price_max REAL
+    )""")
+    op.execute("CREATE INDEX IF NOT EXISTS book_stats_delta_dimension_idx ON book_stats_delta (dimension, key)")
+    op.execute(f"""CREATE OR REPLACE FUNCTION book_stats_apply() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            INSERT INTO book_stats_delta (dimension, key, book_count, priced_count, price_sum)
+            SELECT dimension, key, book_count, priced_count, price_sum FROM ({aggregate("old_rows", "-")}) removed;
+        ELSIF TG_OP = 'INSERT' THEN
+            INSERT INTO book_stats_delta (dimension, key, book_count, priced_count, price_sum, price_min, price_max)
+            {aggregate("new_rows")};
+        ELSE
+            INSERT INTO book_stats_delta (dimension, key, book_count, priced_count, price_sum)
+            SELECT dimension, key, book_count, priced_count, price_sum
+            FROM ({aggregate("old_rows", "-", CHANGED.format(side="old_rows"))}) removed;
+            INSERT INTO book_stats_delta (dimension, key, book_count, priced_count, price_sum, price_min, price_max)
+            {aggregate("new_rows", source=CHANGED.format(side="new_rows"))};
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""")
+
+    op.execute(f"""CREATE OR REPLACE FUNCTION book_stats_fold() RETURNS INTEGER AS $$
+    DECLARE
+        folded INTEGER;
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM book_stats_delta) THEN
+            RETURN 0;
+        END IF;
+        PERFORM pg_advisory_xact_lock({STATS_FOLD_LOCK});
+        WITH taken AS (
+            DELETE FROM book_stats_delta RETURNING dimension, key, book_count, priced_count, price_sum
+        ),
+        changes AS (
+            SELECT dimension, key, sum(book_count) AS book_count, sum(priced_count) AS priced_count,
+                sum(price_sum) AS price_sum
+            FROM taken GROUP BY dimension, key
+        ),
+        bounds AS (
+            SELECT 'catalog' AS dimension, 0 AS key, min(price) AS price_min, max(price) AS price_max FROM book
+            WHERE EXISTS (SELECT 1 FROM changes WHERE dimension = 'catalog')
+            UNION ALL
+            SELECT 'genre', genre_id, min(price), max(price) FROM book
+            WHERE genre_id IN (SELECT key FROM changes WHERE dimension = 'genre') GROUP BY genre_id
+            UNION ALL
+            SELECT 'author', author_id, min(price), max(price) FROM book
+            WHERE author_id IN (SELECT key FROM changes WHERE dimension = 'author') GROUP BY author_id
+            UNION ALL
+            SELECT 'year', published_year, min(price), max(price) FROM book
+            WHERE published_year IN (SELECT key FROM changes WHERE dimension = 'year') GROUP BY published_year
+        )
+        INSERT INTO book_stats (dimension, key, book_count, priced_count, price_sum, price_min, price_max)
+        SELECT changes.dimension, changes.key, changes.book_count, changes.priced_count, changes.price_sum,
+            bounds.price_min, bounds.price_max
+        FROM changes LEFT JOIN bounds ON bounds.dimension = changes.dimension AND bounds.key = changes.key
+        ORDER BY changes.dimension, changes.key
+        ON CONFLICT (dimension, key) DO UPDATE SET
+            book_count = book_stats.book_count + EXCLUDED.book_count,
+            priced_count = book_stats.priced_count + EXCLUDED.priced_count,
+            price_sum = book_stats.price_sum + EXCLUDED.price_sum,
+            price_min = EXCLUDED.price_min,
+            price_max = EXCLUDED.price_max;
+        GET DIAGNOSTICS folded = ROW_COUNT;
+        DELETE FROM book_stats WHERE book_count <= 0;
+        RETURN folded;
+    END $$ LANGUAGE plpgsql""")
+
+    # One dimension's groups, folded first when asked to. The read runs after
+    # the fold, in a snapshot of its own; deltas committed since are added
+    # in, and only a removal among them can leave its group's bounds wide
+    # until the next fold. A write transaction reads without folding, so it
+    # never holds the fold lock until its commit.
+    op.execute("""CREATE OR REPLACE FUNCTION book_stats_read(wanted VARCHAR, fold BOOLEAN) RETURNS SETOF book_stats AS $$
+    BEGIN
+        IF fold THEN
+            PERFORM book_stats_fold();
+        END IF;
+        RETURN QUERY
+        SELECT parts.dimension, parts.key, sum(parts.book_count)::integer, sum(parts.priced_count)::integer,
+            sum(parts.price_sum), min(parts.price_min), max(parts.price_max)
+        FROM (
+            SELECT book_stats.dimension, book_stats.key, book_stats.book_count, book_stats.priced_count,
+                book_stats.price_sum, book_stats.price_min, book_stats.price_max
+            FROM book_stats WHERE book_stats.dimension = wanted
+            UNION ALL
+            SELECT book_stats_delta.dimension, book_stats_delta.key, book_stats_delta.book_count,
+                book_stats_delta.priced_count, book_stats_delta.price_sum, book_stats_delta.price_min,
+                book_stats_delta.price_max
+            FROM book_stats_delta WHERE book_stats_delta.dimension = wanted
+        ) parts
+        GROUP BY parts.dimension, parts.key HAVING sum(parts.book_count) > 0;
+    END $$ LANGUAGE plpgsql""")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("SELECT book_stats_fold()")
+    op.execute("DROP FUNCTION IF EXISTS book_stats_read(VARCHAR, BOOLEAN)")
+    op.execute("DROP FUNCTION IF EXISTS book_stats_fold()")
+    op.execute("DROP TABLE IF EXISTS book_stats_delta")
+    # 0004's in-place version.
+    op.execute(f"""CREATE OR REPLACE FUNCTION book_stats_apply() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            WITH removed AS ({aggregate("old_rows")}),
+            stale AS (
+                SELECT removed.dimension, removed.key FROM removed
+                JOIN book_stats ON book_stats.dimension = removed.dimension AND book_stats.key = removed.key
+                WHERE removed.price_min <= book_stats.price_min OR removed.price_max >= book_stats.price_max
+            ),
+            bounds AS (
+                SELECT 'catalog' AS dimension, 0 AS key, min(price) AS price_min, max(price) AS price_max FROM book
+                WHERE EXISTS (SELECT 1 FROM stale WHERE dimension = 'catalog')
+                UNION ALL
+                SELECT 'genre', genre_id, min(price), max(price) FROM book
+                WHERE genre_id IN (SELECT key FROM stale WHERE dimension = 'genre') GROUP BY genre_id
+                UNION ALL
+                SELECT 'author', author_id, min(price), max(price) FROM book
+                WHERE author_id IN (SELECT key FROM stale WHERE dimension = 'author') GROUP BY author_id
+                UNION ALL
+                SELECT 'year', published_year, min(price), max(price) FROM book
+                WHERE published_year IN (SELECT key FROM stale WHERE dimension = 'year') GROUP BY published_year
+            )
+            UPDATE book_stats SET
+                book_count = book_stats.book_count - removed.book_count,
+                priced_count = book_stats.priced_count - removed.priced_count,
+                price_sum = book_stats.price_sum - removed.price_sum,
+                price_min = CASE WHEN bounds.dimension IS NULL THEN book_stats.price_min ELSE bounds.price_min END,
+                price_max = CASE WHEN bounds.dimension IS NULL THEN book_stats.price_max ELSE bounds.price_max END
+            FROM removed
+            LEFT JOIN bounds ON bounds.dimension = removed.dimension AND bounds.key = removed.key
+            WHERE book_stats.dimension = removed.dimension AND book_stats.key = removed.key;
+
+            DELETE FROM book_stats USING old_rows {DIMENSIONS.format(rows="old_rows")}
+            AND book_stats.dimension = dimensions.dimension AND book_stats.key = dimensions.key
+            AND book_stats.book_count <= 0;
+        END IF;
+
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO book_stats (dimension, key, book_count, priced_count, price_sum, price_min, price_max)
+            {aggregate("new_rows")} ORDER BY dimension, key
+            ON CONFLICT (dimension, key) DO UPDATE SET
+                book_count = book_stats.book_count + EXCLUDED.book_count,
+                priced_count = book_stats.priced_count + EXCLUDED.priced_count,
+                price_sum = book_stats.price_sum + EXCLUDED.price_sum,
+                price_min = least(book_stats.price_min, EXCLUDED.price_min),
+                price_max = greatest(book_stats.price_max, EXCLUDED.price_max);
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""")
+
+    for event, _ in EVENTS:
+        op.execute(f"DROP TRIGGER IF EXISTS book_catalog_{event} ON book")
+    op.execute("DROP FUNCTION IF EXISTS book_catalog_change()")
+    # 0002's single catalog row.
+    op.execute("""CREATE TABLE IF NOT EXISTS book_catalog (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        version BIGINT NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL
+    )""")
+    op.execute("""INSERT INTO book_catalog (version, updated_at)
+        SELECT greatest(sum(changes), nextval('book_version_seq')), coalesce(max(updated_at), now())
+        FROM book_catalog_changes ON CONFLICT DO NOTHING""")
+    op.execute("DROP TABLE IF EXISTS book_catalog_changes")
+    op.execute("""CREATE OR REPLACE FUNCTION book_touch_catalog() RETURNS trigger AS $$
+    BEGIN
+        UPDATE book_catalog SET version = nextval('book_version_seq'), updated_at = now();
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""")
+    op.execute("""CREATE TRIGGER book_touch_catalog AFTER INSERT OR UPDATE OR DELETE ON book
+        FOR EACH STATEMENT EXECUTE FUNCTION book_touch_catalog()""")
@@ -0,0 +1,132 @@
+import random
+
+import psycopg2
+import pytest
+from psycopg2.extras import RealDictCursor
+
+from app.models import QueryParams
+from db.cache import storage_cache
+from db.database import Storage, upgrade_schema
+
+TEST_DSN = "host=localhost dbname=test_db user=testuser password=1234"
+
+BOOKS = 20000
+AUTHORS = 2000
+GENRES = 200
+# A sequential scan over a table with more rows than this fails the test.
+SEQ_SCAN_THRESHOLD = 1000
+
+WORDS = [
+    "shadow", "river", "empire", "glass", "winter", "machine", "garden", "storm",
+    "silent", "crimson", "harbor", "echo", "iron", "paper", "lantern", "orbit",
+]
+
+
+class ExplainCursor(RealDictCursor):
+    # Runs EXPLAIN instead of the statement, so any Storage read method can
+    # be pointed at it unchanged; the plans are collected on the class.
+    plans = []
+
+    def execute(self, query, vars=None):
+        if query.startswith(("PREPARE", "DEALLOCATE")):
+            # A prepared statement's first use: set it up, explain the EXECUTE.
+            prepare, query = query.rsplit("; ", 1)
+            super().execute(prepare)
+        super().execute("EXPLAIN (FORMAT JSON) " + query, vars)
+        ExplainCursor.plans.append(super().fetchone()["QUERY PLAN"][0]["Plan"])
+
+
+@pytest.fixture(scope="module")
+def seeded_db():
+    conn = psycopg2.connect(TEST_DSN, cursor_factory=RealDictCursor)
+    db = Storage(connection=conn)
+    db.drop_database()
+    upgrade_schema(TEST_DSN)
+
+    rng = random.Random(0)
+    with conn.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO genre (name_genre) VALUES (%s)",
+            [(f"Genre {i}",) for i in range(GENRES)],
+        )
+        cursor.executemany(
+            "INSERT INTO author (firstname, lastname) VALUES (%s, %s)",
+            [(f"First {i}", f"Last {i}") for i in range(AUTHORS)],
+        )
+    conn.commit()
+
+    db.copy_books(
+        (
+            f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}",
+            f"{rng.choice(WORDS)} {rng.choice(WORDS)} {rng.choice(WORDS)}",
+            rng.randint(1900, 2024),
+            round(rng.uniform(1, 100), 2),
+            rng.randint(1, GENRES),
+            rng.randint(1, AUTHORS),
+        )
+        for i in range(BOOKS)
+    )
+    with conn.cursor() as cursor:
+        cursor.execute("ANALYZE")
+        cursor.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'")
+        sizes = {row["relname"]: row["reltuples"] for row in cursor.fetchall()}
+    conn.commit()
+    conn.close()
+
+    conn = psycopg2.connect(TEST_DSN, cursor_factory=ExplainCursor)
+    yield Storage(connection=conn), sizes
+    conn.close()
+    ExplainCursor.plans.clear()
+
+
+def seq_scans(plan):
+    if plan["Node Type"] == "Seq Scan":
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from seq_scans(child)
+
+
+QUERIES = {
+    "retrieve_book_by_id": lambda db: db.retrieve_book_by_id(123),
+    "retrieve_book_for_title": lambda db: db.retrieve_book_for_title("glass orbit 77"),
+    "check_book_references": lambda db: db.check_book_references("glass orbit 77", 12, 3),
+    "retrieve_existing_titles": lambda db: db.retrieve_existing_titles(["glass orbit 77", "echo storm 5"]),
+    "retrieve_existing_author_ids": lambda db: db.retrieve_existing_author_ids([1, 2, 3]),
+    "retrieve_existing_genre_ids": lambda db: db.retrieve_existing_genre_ids([1, 2, 3]),
+    "retrieve_author_by_id": lambda db: db.retrieve_author_by_id(12),
+    "retrieve_genre": lambda db: db.retrieve_genre(3),
+    "retrieve_user_by_email": lambda db: db.retrieve_user_by_email("test@test.com"),
+    "recommend_books_by_genre": lambda db: db.recommend_books_by_genre(3),
+    "recommend_books_by_author": lambda db: db.recommend_books_by_author(12),
+    "similar_books": lambda db: db.similar_books(123),
+    "retrieve_stats": lambda db: db.retrieve_stats("genre"),
+    "search_books": lambda db: db.search_books("glass orbit 77"),
+    "retrieve_books_by_genre": lambda db: db.retrieve_books(QueryParams(genre_id=3)),
+    "retrieve_books_by_author": lambda db: db.retrieve_books(QueryParams(author_id=12)),
+    "retrieve_books_by_year": lambda db: db.retrieve_books(
+        QueryParams(published_year_start=1950, published_year_end=1950)
+    ),
+    "retrieve_books_by_title": lambda db: db.retrieve_books(QueryParams(title="orbit 77")),
+    "retrieve_books_page": lambda db: db.retrieve_books(QueryParams(sort_by="price", limit=20)),
+    "retrieve_books_deep_page": lambda db: db.retrieve_books(
+        QueryParams(
+            sort_by="price",
+            limit=20,
+            cursor=QueryParams(sort_by="price", limit=1).next_cursor([{"id": 15000, "price": 75.0}]),
+        )
+    ),
+}
+
+
+@pytest.mark.parametrize("name", QUERIES)
+def test_query_uses_indexes(seeded_db, name):
+    db, sizes = seeded_db
+    ExplainCursor.plans.clear()
+    storage_cache.clear()
+    QUERIES[name](db)
+    db.connection.rollback()
+
+    assert ExplainCursor.plans
+    for plan in ExplainCursor.plans:
+        large = [table for table in seq_scans(plan) if sizes.get(table, 0) > SEQ_SCAN_THRESHOLD]
+        assert not large, f"{name} scans {large} sequentially"
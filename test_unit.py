@@ -1,32 +1,66 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import threading
+import time
+import types
+from base64 import urlsafe_b64encode
+
 import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
 
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from db.database import Storage
-from db.database import get_db
+from db.database import ConnectionPool, Storage
+from db.database import get_db, upgrade_schema
+from db.cache import LRUCache, storage_cache
 from unittest.mock import MagicMock
 
-from app.main import app
+import asyncpg
+import httpx
+
+from app.main import app, handler
+from benchmarks.lambda_replay import api_gateway_event
 
-from app import oath2
+from app import admission, main, metrics, oath2, streaming, utils
+from app.models import Author, Book, Genre, QueryParams
+from db import async_database, database, read_model, recommendations
+from db.metrics import TracingConnection, round_trips
+from db.database import book_query_key
+from db.prepared import Statement
+from db.singleflight import SingleFlight
+from passlib.context import CryptContext
 
 TEST_DSN = "host=localhost dbname=test_db user=testuser password=1234"
 
+# Tests drain the recommendation queue themselves instead of racing the
+# background refresher.
+database.RECOMMENDATIONS_REFRESH = False
+
+
+def drain_recommendations():
+    conn = psycopg2.connect(TEST_DSN)
+    try:
+        return recommendations.drain(conn)
+    finally:
+        conn.close()
+
 @pytest.fixture(scope="session", autouse=True)
 def startup_db():
     # runs once before any tests
     conn = psycopg2.connect(TEST_DSN, cursor_factory=RealDictCursor)
     db = Storage(connection=conn)
     db.drop_database()
-    db.create_tables_if_not_exist()
+    upgrade_schema(TEST_DSN)
     yield
     db.close()
 
 def override_get_db():
     conn = psycopg2.connect(TEST_DSN, cursor_factory=RealDictCursor)
     db = Storage(connection=conn)
-    db.create_tables_if_not_exist()
     try:
         yield db
     finally:
@@ -107,5 +141,942 @@ def test_create_book():
     assert "book" in data
     assert data["book"]["title"] == "Dune"
 
+
+def test_search_books():
+    response = client.get("/books/search", params={"q": "dunne"})
+    assert response.status_code == 200
+    titles = [book["title"] for book in response.json()["data"]]
+    assert titles[0] == "Dune"
+
+
+def test_import_books_csv():
+    content = (
+        "title,description,published_year,price,genre_id,author_id\n"
+        "Dune Messiah,Second Dune novel,1969,8.99,1,1\n"
+        "Children of Dune,Third Dune novel,1976,8.99,1,1\n"
+        "Orphaned,No such author,1976,8.99,1,999\n"
+    )
+    response = client.post(
+        "/books/import",
+        files={"csv_file": ("books.csv", content, "text/csv")},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 2
+    assert data["rejected"] == 1
+    assert data["rejected_rows"] == [{"file": "CSV", "index": 2, "detail": "Author not found"}]
+    assert data["rows_per_sec"] > 0
+
+
+def test_books_keyset_pagination():
+    first = client.get("/books", params={"sort_by": "published_year", "limit": 1}).json()
+    assert first["next_cursor"] is not None
+
+    second = client.get(
+        "/books",
+        params={"sort_by": "published_year", "limit": 1, "cursor": first["next_cursor"]},
+    ).json()
+    assert second["data"][0]["published_year"] >= first["data"][0]["published_year"]
+    assert second["data"][0]["id"] != first["data"][0]["id"]
+
+    response = client.get("/books", params={"sort_by": "title; DROP TABLE book"})
+    assert response.status_code == 422
+
+
+@pytest.mark.parametrize("payload,params", [
+    (["id", "asc", 1, "abc"], {}),
+    (["id", "asc", 1, 2**40], {}),
+    (["id", "asc", 1, True], {}),
+    (["price", "asc", "cheap", 1], {"sort_by": "price"}),
+    (["price", "asc", float("nan"), 1], {"sort_by": "price"}),
+    (["published_year", "asc", 1999.5, 1], {"sort_by": "published_year"}),
+    (["title", "asc", 7, 1], {"sort_by": "title"}),
+    (["title", "asc", "a\x00b", 1], {"sort_by": "title"}),
+])
+def test_books_rejects_crafted_cursor(payload, params):
+    cursor = urlsafe_b64encode(json.dumps(payload).encode()).decode()
+    response = client.get("/books", params={**params, "limit": 1, "cursor": cursor})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
+
+
+def test_read_book_conditional():
+    response = client.get("/books/1")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = client.get("/books/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    listing = client.get("/books")
+    response = client.get("/books", headers={"If-None-Match": listing.headers["ETag"]})
+    assert response.status_code == 304
+
+
+def test_read_book_conditional_non_utc_session():
+    def kyiv_db():
+        conn = psycopg2.connect(TEST_DSN, cursor_factory=RealDictCursor, options="-c timezone=Europe/Kyiv")
+        try:
+            yield Storage(connection=conn)
+        finally:
+            conn.close()
+
+    storage_cache.clear()
+    app.dependency_overrides[get_db] = kyiv_db
+    try:
+        response = client.get("/books/1")
+        assert response.status_code == 200
+        assert response.headers["Last-Modified"].endswith(" GMT")
+        response = client.get("/books/1", headers={"If-Modified-Since": response.headers["Last-Modified"]})
+        assert response.status_code == 304
+        assert client.get("/books").status_code == 200
+    finally:
+        app.dependency_overrides[get_db] = override_get_db
+        storage_cache.clear()
+
+
+def test_similar_books():
+    drain_recommendations()
+    response = client.get("/books/1/similar")
+    assert response.status_code == 200
+    similar = response.json()["data"]
+    assert {book["title"] for book in similar} == {"Dune Messiah", "Children of Dune"}
+    assert similar[0]["similarity"] >= similar[1]["similarity"]
+
+    response = client.get("/books/recomendations-genre/1")
+    assert len(response.json()["data"]) == 3
+
+
+def test_book_writes_queue_recommendations():
+    drain_recommendations()
+    book = {"title": "Queued Book", "description": "Queued", "published_year": 1970, "price": 8.99, "genre_id": 1, "author_id": 1}
+    book_id = client.post("/books", json=book).json()["book"]["id"]
+    conn = psycopg2.connect(TEST_DSN)
+
+    def queued():
+        with conn.cursor() as cursor:
+            cursor.execute("""SELECT book_id FROM book_recommendation_queue ORDER BY id""")
+            rows = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        return rows
+
+    try:
+        # The write only queued the book; nothing was recomputed yet.
+        assert queued() == [book_id]
+        assert client.get(f"/books/{book_id}/similar").json()["data"] == []
+        assert drain_recommendations() == 1
+        assert queued() == []
+        assert len(client.get(f"/books/{book_id}/similar").json()["data"]) == 3
+
+        # Only genre, author, year and price changes matter.
+        assert client.put(f"/books/{book_id}", json={**book, "title": "Queued Book 2", "description": "Reworded"}).status_code == 200
+        assert queued() == []
+        assert client.put(f"/books/{book_id}", json={**book, "title": "Queued Book 3", "price": 20.0}).status_code == 200
+        assert queued() == [book_id]
+
+        client.delete(f"/books/{book_id}")
+        assert queued() == [book_id, book_id]
+        drain_recommendations()
+        assert book_id not in [similar["id"] for similar in client.get("/books/1/similar").json()["data"]]
+    finally:
+        conn.close()
+
+
+def test_recommendation_refresher_drains_queue(monkeypatch):
+    monkeypatch.setattr(recommendations, "REFRESH_DELAY", 0)
+    conn = psycopg2.connect(TEST_DSN)
+    with conn.cursor() as cursor:
+        cursor.execute("""INSERT INTO book_recommendation_queue (book_id) VALUES (1), (1)""")
+    conn.commit()
+    conn.close()
+
+    refresher = recommendations.Refresher(TEST_DSN)
+    refresher.start()
+    refresher.wake()
+    deadline = time.monotonic() + 5
+    while refresher.refreshed < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    refresher.stop()
+    assert (refresher.refreshed, refresher.failures) == (1, 0)
+
+
+def test_recommendations_migration_queues_backfill():
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location("migration_0006", "migrations/versions/0006_recommendation_queue.py")
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+
+    conn = psycopg2.connect(TEST_DSN)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""DELETE FROM book_similarity""")
+            cursor.execute("""DELETE FROM book_rank""")
+            migration.op = types.SimpleNamespace(execute=cursor.execute)
+            migration.upgrade()
+            conn.commit()
+            cursor.execute("""SELECT count(DISTINCT book_id) FROM book_recommendation_queue""")
+            assert cursor.fetchone()[0] == 3
+        assert drain_recommendations() == 3
+        with conn.cursor() as cursor:
+            cursor.execute("""SELECT count(DISTINCT book_id) FROM book_similarity""")
+            assert cursor.fetchone()[0] == 3
+            cursor.execute("""SELECT count(*) FROM book_rank""")
+            assert cursor.fetchone()[0] == 3
+    finally:
+        conn.close()
+    storage_cache.clear()
+
+
+def test_stats():
+    catalog = client.get("/stats").json()["data"]
+    assert catalog["book_count"] == 3
+    assert catalog["price_min"] == pytest.approx(8.99)
+
+    genres = client.get("/stats/genre").json()["data"]
+    assert genres == [
+        {"key": 1, "name": "Sci-Fi", "book_count": 3, "price_avg": 9.32, "price_min": pytest.approx(8.99), "price_max": pytest.approx(9.99)}
+    ]
+    assert client.get("/stats/title").status_code == 422
+
+
+def test_book_writes_share_no_row():
+    # An open write transaction holds nothing another book write needs; the
+    # catalog version and stats follow both, and empty statements count for
+    # neither.
+    held = psycopg2.connect(TEST_DSN)
+    conn = psycopg2.connect(TEST_DSN, cursor_factory=RealDictCursor)
+    db = Storage(connection=conn)
+    book = "INSERT INTO book (title, published_year, price, genre_id, author_id) VALUES (%s, 1990, %s, 1, 1)"
+    try:
+        version = db.retrieve_catalog_version()["version"]
+        with conn.cursor() as cursor:
+            cursor.execute("UPDATE book SET price = 0 WHERE false")
+            cursor.execute("DELETE FROM book WHERE false")
+        conn.commit()
+        assert db.retrieve_catalog_version()["version"] == version
+
+        with held.cursor() as cursor:
+            cursor.execute(book, ("Held Book", 50.0))
+        with conn.cursor() as cursor:
+            cursor.execute("SET lock_timeout = '1s'")
+            cursor.execute(book, ("Free Book", 1.0))
+            cursor.execute("UPDATE book SET price = 20.0 WHERE title = 'Free Book'")
+        conn.commit()
+        assert db.retrieve_catalog_version()["version"] == version + 2
+        storage_cache.clear()
+        catalog = db.retrieve_stats("catalog")[0]
+        assert (catalog["book_count"], catalog["price_max"]) == (4, 20.0)
+
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM book WHERE title = 'Free Book'")
+        conn.commit()
+        held.rollback()
+        storage_cache.clear()
+        catalog = db.retrieve_stats("catalog")[0]
+        assert (catalog["book_count"], catalog["price_min"], catalog["price_max"]) == (3, pytest.approx(8.99), pytest.approx(9.99))
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT count(*) AS pending FROM book_stats_delta")
+            assert cursor.fetchone()["pending"] == 0
+    finally:
+        held.close()
+        db.close()
+    storage_cache.clear()
+
+
+def test_verify_access_token_cached():
+    token = oath2.create_access_token({"user_id": 42})
+    exception = HTTPException(status_code=401)
+    hits = oath2.token_cache.hits
+
+    assert oath2.verify_access_token(token, exception).id == 42
+    assert oath2.verify_access_token(token, exception).id == 42
+    assert oath2.token_cache.hits == hits + 1
+
+    with pytest.raises(HTTPException):
+        oath2.verify_access_token(token + "x", exception)
+
+
+def test_verify_and_update_rehashes_old_cost():
+    stored = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("secret")
+
+    verified, new_hash = utils.verify_and_update("secret", stored)
+    assert verified
+    assert new_hash.startswith(f"$2b${utils.BCRYPT_ROUNDS:02d}$")
+    assert utils.verify_and_update("secret", new_hash) == (True, None)
+
+
+def test_hash_pool_recovers_from_broken_executor(monkeypatch):
+    from concurrent.futures.process import BrokenProcessPool
+
+    # Its own loop: asyncio.run would unset the main thread's default loop,
+    # which Mangum's handler relies on.
+    loop = asyncio.new_event_loop()
+    pool = utils.HashPool("thread", 1, 0, 5)
+    broken = MagicMock()
+    broken.submit.side_effect = BrokenProcessPool()
+    pool._executor = broken
+    assert loop.run_until_complete(pool.run(sum, [1, 2])) == 3
+    assert pool._executor is not broken and pool.stats()["pending"] == 0
+
+    # Failed submits give their slot back instead of filling the pool.
+    monkeypatch.setattr(pool, "executor", lambda: broken)
+    for _ in range(pool.limit + 1):
+        with pytest.raises(BrokenProcessPool):
+            loop.run_until_complete(pool.run(sum, [1, 2]))
+    assert pool.stats()["pending"] == 0
+    monkeypatch.undo()
+
+    # A worker dying mid-task fails that call and replaces the executor.
+    def crash():
+        raise BrokenProcessPool()
+
+    with pytest.raises(HTTPException) as error:
+        loop.run_until_complete(pool.run(crash))
+    assert error.value.status_code == 503
+    assert pool._executor is None and pool.stats()["pending"] == 0
+    pool.shutdown()
+    loop.close()
+
+def test_stream_books_matches_listing():
+    db = Storage(connection=psycopg2.connect(TEST_DSN, cursor_factory=RealDictCursor))
+    query = QueryParams(sort_by="title", limit=2)
+    body = b"".join(streaming.json_chunks(db.stream_books(query, 1), query))
+    db.close()
+
+    listing = client.get("/books", params={"sort_by": "title", "limit": 2}).json()
+    assert json.loads(body) == listing
+
+    ndjson = b"".join(streaming.ndjson_chunks([listing["data"]]))
+    assert [json.loads(line) for line in ndjson.splitlines()] == listing["data"]
+
+
+def test_export_books_csv():
+    db = Storage(connection=psycopg2.connect(TEST_DSN, cursor_factory=RealDictCursor))
+    output = io.BytesIO()
+    db.export_books_csv(QueryParams(title="Dune", sort_by="title"), output)
+    db.close()
+
+    rows = list(csv.DictReader(io.StringIO(output.getvalue().decode())))
+    assert [row["title"] for row in rows] == ["Children of Dune", "Dune", "Dune Messiah"]
+
+    compressed = b"".join(streaming.gzip_chunks(chunk for chunk in [output.getvalue()]))
+    assert gzip.decompress(compressed) == output.getvalue()
+
+
+def test_read_model_matches_sql():
+    def wait_fresh(*tables):
+        deadline = time.monotonic() + 10
+        while not model.fresh(*tables) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert model.fresh(*tables)
+
+    model = read_model.ReadModel(TEST_DSN)
+    model.start()
+    db = Storage(connection=psycopg2.connect(TEST_DSN, cursor_factory=RealDictCursor))
+    try:
+        wait_fresh("book", "book_rank", "author", "genre")
+        for query in (
+            QueryParams(sort_by="price", order="desc", limit=2),
+            QueryParams(title="Dune", sort_by="published_year"),
+            QueryParams(genre_id=1, published_year_start=1970, sort_by="id", order="desc"),
+        ):
+            assert model.retrieve_books(query) == db.retrieve_books(query)
+        with pytest.raises(read_model.Unsupported):
+            model.retrieve_books(QueryParams(title="Dune_"))
+        assert model.recommend_books("genre_id", 1) == db.recommend_books_by_genre(1)
+        assert model.check_book_references("Dune", 1, 2) == {"title_exists": True, "author_exists": True, "genre_exists": False}
+
+        # A write in this process keeps book on SQL until its notification is applied.
+        book = db.insert_book(Book(title="Heretics of Dune", description="Fifth Dune novel", published_year=1984, price=10.5, genre_id=1, author_id=1))
+        assert not model.fresh("book")
+        wait_fresh("book")
+        assert model.retrieve_book_by_id(book["id"]) == book
+        db.delete_book(book["id"])
+        wait_fresh("book")
+        assert model.retrieve_book_by_id(book["id"]) is None
+    finally:
+        db.close()
+        model.stop()
+
+# Most statements and connections (opened or checked out) each route may use
+# with a cold cache; the X-DB-* headers report what a request actually did.
+DB_BUDGETS = {
+    "/books/1": (1, 1),
+    "/books?limit=2": (2, 1),
+    "/books/1/similar": (1, 1),
+    "/stats": (1, 1),
+    "/authors": (1, 1),
+}
+
+
+def traced_get_db():
+    conn = psycopg2.connect(TEST_DSN, cursor_factory=RealDictCursor, connection_factory=TracingConnection)
+    db = Storage(connection=conn)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize("path", DB_BUDGETS)
+def test_db_budget(path, monkeypatch):
+    monkeypatch.setattr(metrics, "TRACE_HEADERS", True)
+    monkeypatch.setitem(app.dependency_overrides, get_db, traced_get_db)
+    storage_cache.clear()
+
+    response = client.get(path)
+    assert response.status_code == 200
+    queries, connections = DB_BUDGETS[path]
+    assert 0 < int(response.headers["X-DB-Queries"]) <= queries
+    assert int(response.headers["X-DB-Connections"]) <= connections
+
+
+def test_metrics_endpoint():
+    client.get("/books/1")
+    text = client.get("/metrics").text
+    assert 'http_requests_total{method="GET",route="/books/{book_id}",status="200"}' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/books/{book_id}",le="+Inf"}' in text
+    assert 'storage_method_duration_seconds_count{method="retrieve_book_by_id"}' in text
+
+
+def test_pool_skips_check_for_recent_connection():
+    pool = ConnectionPool(TEST_DSN, maxconn=1, check_after=60, connection_factory=TracingConnection)
+    pool.putconn(pool.getconn())
+    before = round_trips.count
+    connection = pool.getconn()
+    assert round_trips.count == before
+
+    pool.putconn(connection)
+    pool.check_after = 0
+    assert pool.getconn() is connection
+    assert round_trips.count > before
+    pool.closeall()
+
+
+def test_pool_recycles_idle_and_broken_connections():
+    pool = ConnectionPool(TEST_DSN, maxconn=1, max_idle=0.01)
+    idle = pool.getconn()
+    pool.putconn(idle)
+    time.sleep(0.05)
+    fresh = pool.getconn()
+    assert fresh is not idle and idle.closed
+
+    # A backend the server dropped while the connection sat in the pool
+    # fails the SELECT 1 probe and is replaced.
+    pool.putconn(fresh)
+    pool.max_idle = 300
+    admin = psycopg2.connect(TEST_DSN)
+    with admin.cursor() as cursor:
+        cursor.execute("SELECT pg_terminate_backend(%s)", (fresh.info.backend_pid,))
+    admin.close()
+    replacement = pool.getconn()
+    assert replacement is not fresh and not replacement.closed
+
+    pool.putconn(replacement)
+    replacement.close()
+    assert pool.getconn() is not replacement
+    pool.closeall()
+
+
+def test_pool_replaces_every_dropped_connection():
+    # After a server restart every idle connection is dead, not just the
+    # first one handed out.
+    pool = ConnectionPool(TEST_DSN, maxconn=3)
+    idle = [pool.getconn() for _ in range(3)]
+    for connection in idle:
+        pool.putconn(connection)
+    admin = psycopg2.connect(TEST_DSN)
+    with admin.cursor() as cursor:
+        cursor.execute("SELECT pg_terminate_backend(pid) FROM unnest(%s) pid", ([c.info.backend_pid for c in idle],))
+    admin.close()
+
+    connection = pool.getconn()
+    assert connection not in idle
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 AS alive")
+        assert cursor.fetchone()["alive"] == 1
+    assert all(c.closed for c in idle)
+    pool.putconn(connection)
+    pool.closeall()
+
+
+def test_pool_waits_on_bound_then_times_out():
+    pool = ConnectionPool(TEST_DSN, maxconn=1, timeout=0.1)
+    connection = pool.getconn()
+    started = time.monotonic()
+    with pytest.raises(psycopg2.pool.PoolError, match="timed out"):
+        pool.getconn()
+    assert time.monotonic() - started >= 0.1
+
+    # The failed wait does not leak a slot: once the holder returns its
+    # connection, the next caller gets it.
+    threading.Timer(0.05, pool.putconn, (connection,)).start()
+    pool.timeout = 5
+    assert pool.getconn() is connection
+    pool.closeall()
+
+
+def test_lambda_handler():
+    context = types.SimpleNamespace(function_name="test", aws_request_id="1", get_remaining_time_in_millis=lambda: 30000)
+    response = handler(api_gateway_event("GET", "/books", "limit=1"), context)
+    assert response["statusCode"] == 200
+    assert len(json.loads(response["body"])["data"]) == 1
+
+
+def test_books_bulk_upsert_get_delete():
+    rows = [
+        {"title": "Bulk One", "description": "first", "published_year": 2001, "price": 5.0, "genre_id": 1, "author_id": 1},
+        {"title": "Bulk Two", "description": "second", "published_year": 2002, "price": 6.0, "genre_id": 1, "author_id": 1},
+        {"title": "Bulk Three", "description": "third", "published_year": 2003, "price": 7.0, "genre_id": 1, "author_id": 999},
+    ]
+    result = client.put("/books", json=rows).json()
+    assert (result["inserted"], result["updated"], result["rejected"]) == (2, 0, 1)
+    assert result["rejected_rows"] == [{"index": 2, "detail": "Author not found"}]
+    ids = [book["id"] for book in result["books"]]
+
+    rows[0]["price"] = 4.5
+    result = client.put("/books", json=rows[:2] + [rows[1]]).json()
+    assert (result["inserted"], result["updated"], result["unchanged"]) == (0, 1, 1)
+    assert result["rejected_rows"] == [{"index": 2, "detail": "Duplicate title in batch"}]
+
+    batch = client.get("/books/batch", params={"ids": [ids[1], 999999, ids[0]]}).json()
+    assert [book["id"] for book in batch["data"]] == [ids[1], ids[0]]
+    assert batch["data"][1]["price"] == pytest.approx(4.5)
+    assert batch["missing"] == [999999]
+
+    updated = client.put(
+        f"/books/{ids[0]}",
+        json={"title": "Bulk One Revised", "description": "revised", "published_year": 2001, "price": 3.5, "genre_id": 1, "author_id": 1},
+    ).json()["book"]
+    assert (updated["description"], updated["price"]) == ("revised", pytest.approx(3.5))
+
+    assert client.delete("/books", params={"ids": ids + [999999]}).json() == {"deleted": sorted(ids), "missing": [999999]}
+    assert client.get("/books/batch", params={"ids": ids}).json()["data"] == []
+    assert client.delete(f"/books/{ids[0]}").status_code == 404
+
+
+def test_import_rejects_duplicates_across_batches_and_files(monkeypatch):
+    monkeypatch.setattr(main, "IMPORT_BATCH_SIZE", 2)
+    content = (
+        "title,description,published_year,price,genre_id,author_id\n"
+        "Import Dup A,First,1990,5.00,1,1\n"
+        "Import Dup Bad,No such author,1990,5.00,1,999\n"
+        "Import Dup B,Second,1990,5.00,1,1\n"
+        "Import Dup A,Again,1990,5.00,1,1\n"
+    )
+    response = client.post("/books/import", files={"csv_file": ("books.csv", content, "text/csv")})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 2
+    assert data["rejected_rows"] == [
+        {"file": "CSV", "index": 1, "detail": "Author not found"},
+        {"file": "CSV", "index": 3, "detail": "Book with such title already exists"},
+    ]
+
+    book = {"title": "Import Dup Same", "description": "JSON", "published_year": 1990, "price": 5, "genre_id": 1, "author_id": 1}
+    response = client.post(
+        "/books/import",
+        files={
+            "json_file": ("books.json", json.dumps([book]), "application/json"),
+            "csv_file": ("books.csv", "title,description,published_year,price,genre_id,author_id\nImport Dup Same,CSV,1990,5.00,1,1\n", "text/csv"),
+        },
+    )
+    assert response.status_code == 200
+    assert response.json()["count"] == 1
+    assert response.json()["rejected_rows"] == [{"file": "CSV", "index": 0, "detail": "Book with such title already exists"}]
+
+    # A title that slips past validation (a concurrent writer) is a 400, not a 500.
+    from app import importer
+    monkeypatch.setattr(importer, "iter_valid_books", lambda db, sources, report, size: iter([("Import Dup Same", "Raced", 1990, 5, 1, 1)]))
+    response = client.post("/books/import", files={"json_file": ("books.json", "[]", "application/json")})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Book with such title already exists"
+
+    imported = client.get("/books", params={"title": "Import Dup"}).json()["data"]
+    assert sorted(book["title"] for book in imported) == ["Import Dup A", "Import Dup B", "Import Dup Same"]
+    client.delete("/books", params={"ids": [book["id"] for book in imported]})
+
+
+def load_asyncpg_main(monkeypatch):
+    # A second copy of app.main with DATABASE_DRIVER=asyncpg, so reads go
+    # through AsyncStorage.
+    import importlib.util
+
+    monkeypatch.setenv("DATABASE_DRIVER", "asyncpg")
+    spec = importlib.util.find_spec("app.main")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.app.dependency_overrides[oath2.get_current_user_id] = override_get_current_user_id
+    module.app.dependency_overrides[get_db] = override_get_db
+    storage_cache.clear()
+    return module
+
+
+def test_asyncpg_routes(monkeypatch):
+    module = load_asyncpg_main(monkeypatch)
+    acquired = []
+    get_async_pool = async_database.get_async_pool
+
+    async def counting_pool():
+        acquired.append(1)
+        return await get_async_pool()
+
+    monkeypatch.setattr(async_database, "get_async_pool", counting_pool)
+    with TestClient(module.app) as async_client:
+        paths = ("/books", "/books/1", "/books/1/similar", "/books/recomendations-genre/1", "/stats", "/stats/genre", "/authors")
+        for path in paths:
+            storage_cache.clear()
+            expected = client.get(path).json()
+            storage_cache.clear()
+            assert async_client.get(path).json() == expected, path
+        assert len(acquired) == len(paths)
+
+        # Validated writes run on the request's psycopg2 connection only.
+        acquired.clear()
+        book = {"title": "Async Book", "description": "Async", "published_year": 1999, "price": 3.5, "genre_id": 1, "author_id": 1}
+        book_id = async_client.post("/books", json=book).json()["book"]["id"]
+        assert async_client.put(f"/books/{book_id}", json={**book, "title": "Async Book 2"}).json()["book"]["title"] == "Async Book 2"
+        assert acquired == []
+        assert async_client.get(f"/books/{book_id}").json()["data"]["title"] == "Async Book 2"
+        assert async_client.delete(f"/books/{book_id}").status_code == 204
+        assert async_client.get(f"/books/{book_id}").status_code == 404
+        book_id = async_client.post("/books", json=book).json()["book"]["id"]
+        assert async_client.delete("/books", params={"ids": [book_id, book_id + 1000]}).json() == {
+            "deleted": [book_id], "missing": [book_id + 1000],
+        }
+    assert async_database._pool is None
+    # No quiet psycopg2 fallback for methods without an asyncpg version.
+    assert not hasattr(async_database.AsyncStorage(None), "copy_books")
+    storage_cache.clear()
+
+
+def test_asyncpg_requests_overlap_db_waits(monkeypatch):
+    module = load_asyncpg_main(monkeypatch)
+    fetchrow = asyncpg.connection.Connection.fetchrow
+
+    async def slow_fetchrow(self, *args, **kwargs):
+        # A slow network round trip, spent awaiting on the event loop.
+        await asyncio.sleep(0.2)
+        return await fetchrow(self, *args, **kwargs)
+
+    monkeypatch.setattr(asyncpg.connection.Connection, "fetchrow", slow_fetchrow)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+            started = time.perf_counter()
+            responses = await asyncio.gather(*(async_client.get(f"/books/{book_id}") for book_id in range(1, 9)))
+            elapsed = time.perf_counter() - started
+        await async_database.close_async_pool()
+        return responses, elapsed
+
+    responses, elapsed = asyncio.run(scenario())
+    assert {response.status_code for response in responses} <= {200, 404}
+    # Eight 0.2s waits, overlapped rather than one after another.
+    assert elapsed < 0.8
+    storage_cache.clear()
+
+
+def test_async_pool_created_once_under_concurrency(monkeypatch):
+    created = []
+    create_pool = asyncpg.create_pool
+
+    async def slow_create_pool(**kwargs):
+        await asyncio.sleep(0.05)
+        created.append(await create_pool(**kwargs))
+        return created[-1]
+
+    monkeypatch.setattr(asyncpg, "create_pool", slow_create_pool)
+
+    async def scenario():
+        pools = await asyncio.gather(*(async_database.get_async_pool() for _ in range(5)))
+        await async_database.close_async_pool()
+        return pools
+
+    pools = asyncio.run(scenario())
+    assert len(created) == 1 and all(pool is created[0] for pool in pools)
+
+
+def test_async_pool_replaced_on_new_loop():
+    loops = [asyncio.new_event_loop() for _ in range(2)]
+    try:
+        first = loops[0].run_until_complete(async_database.get_async_pool())
+        second = loops[1].run_until_complete(async_database.get_async_pool())
+        assert second is not first
+        assert first.is_closing() and not second.is_closing()
+        loops[1].run_until_complete(async_database.close_async_pool())
+        assert second.is_closing()
+    finally:
+        for loop in loops:
+            loop.close()
+
+
+def test_lru_cache_evicts_and_expires():
+    lru = LRUCache(maxsize=2, ttl=60)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == (True, 1)
+    lru.set("c", 3)
+    # "b" was least recently used.
+    assert lru.get("b") == (False, None)
+    assert lru.get("a") == (True, 1) and lru.get("c") == (True, 3)
+
+    lru = LRUCache(maxsize=2, ttl=0.05)
+    lru.set("short", 1)
+    lru.set("long", 2, ttl=60)
+    time.sleep(0.06)
+    assert lru.get("short") == (False, None)
+    assert lru.get("long") == (True, 2)
+    assert lru.stats()["size"] == 1
+    assert (lru.stats()["hits"], lru.stats()["misses"]) == (1, 1)
+
+
+def test_storage_cache_invalidated_by_writes():
+    conn = psycopg2.connect(TEST_DSN, cursor_factory=RealDictCursor)
+    db = Storage(connection=conn)
+    storage_cache.clear()
+
+    def hits():
+        return storage_cache.stats()["hits"]
+
+    try:
+        authors = db.retrieve_authors()
+        before = hits()
+        assert db.retrieve_authors() == authors and hits() == before + 1
+        db.insert_authors(Author.model_construct(firstname="Cache", lastname="Probe"))
+        assert len(db.retrieve_authors()) == len(authors) + 1
+
+        genres = storage_cache.generation(("genre",))
+        authors = db.retrieve_authors()
+        db.insert_genres(Genre.model_construct(name_genre="Cache Genre"))
+        assert storage_cache.generation(("genre",)) != genres
+        # Other tables' entries survive.
+        before = hits()
+        assert db.retrieve_authors() == authors and hits() == before + 1
+
+        book = Book.model_construct(title="Cache Book", description="d", published_year=2000, price=1.5, genre_id=1, author_id=1)
+        assert db.retrieve_book_for_title("Cache Book") is None
+        book_id = db.insert_book(book)["id"]
+        assert db.retrieve_book_for_title("Cache Book")["id"] == book_id
+        assert db.retrieve_book_by_id(book_id)["price"] == pytest.approx(1.5)
+        db.update_book(book_id, Book.model_construct(**{**book.__dict__, "price": 2.5}))
+        assert db.retrieve_book_by_id(book_id)["price"] == pytest.approx(2.5)
+        db.delete_book(book_id)
+        assert db.retrieve_book_by_id(book_id) is None
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute("""DELETE FROM author WHERE firstname = 'Cache' AND lastname = 'Probe'""")
+            cursor.execute("""DELETE FROM genre WHERE name_genre = 'Cache Genre'""")
+        conn.commit()
+        db.close()
+        storage_cache.clear()
+
+
+def test_cached_reads_copy_and_skip_writes():
+    conn = psycopg2.connect(TEST_DSN, cursor_factory=RealDictCursor)
+    db = Storage(connection=conn)
+    storage_cache.clear()
+    try:
+        db.retrieve_authors().clear()
+        assert db.retrieve_authors()
+        assert db.retrieve_author_by_id(author_id=1) == db.retrieve_author_by_id(1)
+
+        # Reads inside a write see uncommitted rows, which must not be cached.
+        before = storage_cache.stats()
+        db.writing = True
+        db.retrieve_authors()
+        db.writing = False
+        after = storage_cache.stats()
+        assert (after["hits"], after["misses"], after["size"]) == (before["hits"], before["misses"], before["size"])
+    finally:
+        db.close()
+
+
+def test_write_race_is_a_400(monkeypatch):
+    # A row committed by another writer after validation passed.
+    monkeypatch.setattr(Storage, "retrieve_author_for_firstname_and_lastname", lambda self, *args: None)
+    response = client.post("/authors", json={"firstname": "Frank", "lastname": "Herbert"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Author already exists"
+
+    monkeypatch.setattr(Storage, "check_book_references", lambda self, *args: {
+        "title_exists": False, "author_exists": True, "genre_exists": True,
+    })
+    book = {"title": "Dangling", "description": "d", "published_year": 2000, "price": 1.0, "genre_id": 1, "author_id": 2**31 - 1}
+    response = client.post("/books", json=book)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Author not found"
+
+
+def test_cache_stats_counts_hits_and_misses():
+    storage_cache.clear()
+    before = client.get("/cache/stats").json()["storage"]
+    assert client.get("/books/1").status_code == 200
+    assert client.get("/books/1").status_code == 200
+    after = client.get("/cache/stats").json()["storage"]
+    assert (after["hits"] - before["hits"], after["misses"] - before["misses"]) == (1, 1)
+    assert after["size"] >= 1
+
+
+def test_validated_posts_use_one_connection(monkeypatch):
+    connects = []
+    connect = psycopg2.connect
+    monkeypatch.setattr(psycopg2, "connect", lambda *a, **kw: connects.append(a) or connect(*a, **kw))
+
+    def second_checkout():
+        raise AssertionError("validation checked out a second connection")
+
+    monkeypatch.setattr(database, "get_pool", second_checkout)
+    # Resolve the real user dependency so auth's lookup is covered as well.
+    monkeypatch.delitem(app.dependency_overrides, oath2.get_current_user_id)
+    headers = {"Authorization": f"Bearer {oath2.create_access_token({'user_id': 1})}"}
+
+    oath2.user_cache.clear()
+    response = client.post("/authors", json={"firstname": "Single", "lastname": "Connection"}, headers=headers)
+    assert response.status_code == 200
+    assert len(connects) == 1
+
+    oath2.user_cache.clear()
+    response = client.post("/genres", json={"name_genre": "Single Connection"}, headers=headers)
+    assert response.status_code == 200
+    assert len(connects) == 2
+
+    with Storage(connection=connect(TEST_DSN, cursor_factory=RealDictCursor)) as db:
+        author_id = db.retrieve_author_for_firstname_and_lastname("Single", "Connection")["id"]
+        genre_id = db.retrieve_genre_by_title("Single Connection")["id"]
+    oath2.user_cache.clear()
+    book = {
+        "title": "Single Connection", "description": "d", "published_year": 2000,
+        "price": 1.0, "genre_id": genre_id, "author_id": author_id,
+    }
+    response = client.post("/books", json=book, headers=headers)
+    assert response.status_code == 200
+    assert len(connects) == 3
+
+
+def test_prepared_statement_recovers():
+    conn = psycopg2.connect(TEST_DSN, cursor_factory=RealDictCursor, connection_factory=TracingConnection)
+    statement = Statement("test_probe_by_id", "SELECT * FROM prepared_probe WHERE id = $1")
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS prepared_probe")
+        cursor.execute("CREATE TABLE prepared_probe (id int)")
+        cursor.execute("INSERT INTO prepared_probe VALUES (1)")
+        conn.commit()
+
+        statement.execute(cursor, (1,))
+        conn.commit()
+        before = round_trips.count
+        statement.execute(cursor, (1,))
+        assert cursor.fetchone() == {"id": 1}
+        assert round_trips.count == before + 1
+        conn.commit()
+
+        # Result columns changed by a migration, then statements dropped by a pooler.
+        cursor.execute("ALTER TABLE prepared_probe ADD COLUMN note text DEFAULT 'x'")
+        conn.commit()
+        statement.execute(cursor, (1,))
+        assert cursor.fetchone() == {"id": 1, "note": "x"}
+        conn.commit()
+        cursor.execute("DEALLOCATE ALL")
+        conn.commit()
+        statement.execute(cursor, (1,))
+        assert cursor.fetchone() == {"id": 1, "note": "x"}
+
+        cursor.execute("DROP TABLE prepared_probe")
+        conn.commit()
+    conn.close()
+
+
+def test_single_flight_shares_one_query():
+    flights = SingleFlight()
+    release = threading.Event()
+    queries = []
+
+    def query():
+        queries.append(1)
+        release.wait(5)
+        return [{"id": 1}]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do("key", query))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    while flights.calls < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == [[{"id": 1}]] * 4
+    assert len(queries) == 1
+    assert flights.stats()["coalescing_ratio"] == 0.75
+    assert book_query_key(QueryParams(limit=5)) == book_query_key(QueryParams(limit=5, sort_by="id"))
+
+
+def test_coalesced_async_skips_writing_storage():
+    from db.singleflight import coalesced, flights
+
+    class Writer:
+        writing = True
+
+        @coalesced("book")
+        async def read(self):
+            return flights.calls
+
+    calls = flights.calls
+    assert asyncio.run(Writer().read()) == calls
+    assert flights.calls == calls
+
+
+def test_admission_gate_queues_then_rejects():
+    async def scenario():
+        gate = admission.Gate("read", limit=1, queue=1, timeout=0.05)
+        assert await gate.acquire() == 0.0
+        waiter = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(admission.Rejected) as full:
+            await gate.acquire()
+        assert full.value.reason == "queue_full" and full.value.retry_after >= 1
+        gate.release(0.01)
+        await waiter
+        assert gate.active == 1
+        with pytest.raises(admission.Rejected) as late:
+            await gate.acquire()
+        assert late.value.reason == "deadline"
+        gate.release()
+        return gate.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["active"] == 0 and stats["queued"] == 0
+    assert (stats["admitted"], stats["rejected"], stats["timed_out"]) == (2, 1, 1)
+
+
+def test_admission_sheds_saturated_class(monkeypatch):
+    gate = admission.gates["read"]
+    monkeypatch.setattr(gate, "active", gate.limit)
+    monkeypatch.setattr(gate, "queue", 0)
+    response = client.get("/books")
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) >= 1
+    assert client.get("/metrics").status_code == 200
+
+    # Busy exports are shed on their own, not at the expense of reads.
+    monkeypatch.setattr(gate, "active", 0)
+    stream = admission.gates["stream"]
+    monkeypatch.setattr(stream, "active", stream.limit)
+    monkeypatch.setattr(stream, "queue", 0)
+    assert client.get("/books/export").status_code == 429
+    assert client.get("/books", params={"stream": "ndjson"}).status_code == 429
+    assert client.get("/books").status_code == 200
+
+    assert admission.route_class("POST", "/login") == "auth"
+    assert admission.route_class("GET", "/books/search") == "search"
+    assert admission.route_class("GET", "/books/export") == "stream"
+    assert admission.route_class("GET", "/books", b"limit=5&stream=ndjson") == "stream"
+    assert admission.route_class("GET", "/books", b"limit=5") == "read"
+    assert admission.gates["auth"].limit == utils.PASSWORD_HASH_WORKERS + utils.PASSWORD_HASH_QUEUE
+
 if __name__ == "__main__":
     override_get_db()
\ No newline at end of file